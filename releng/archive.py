@@ -0,0 +1,447 @@
+from abc import ABC, abstractmethod
+from bisect import bisect_left, bisect_right
+import bz2
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+import json
+import lzma
+import os
+from pathlib import Path
+import shutil
+import struct
+import subprocess
+import tarfile
+import tempfile
+import urllib.request
+import zlib
+from typing import Callable, Dict, List, Optional, Tuple
+
+from transfer import ContentChangedError, probe_remote_file
+
+
+ARCHIVE_MAGIC = b"FRIDAIDX"
+ARCHIVE_FORMAT = 1
+ARCHIVE_CHUNK_SIZE = 4 * 1024 * 1024
+ARCHIVE_FOOTER = struct.Struct("<QQ8s")
+ARCHIVE_CODEC = "xz"
+ZSTD_CHUNK_SIZE = 32 * 1024 * 1024
+ZSTD_LEVEL = 19
+ZSTD_WINDOW_LOG = 27
+SEVENZIP_LEVEL = 9
+
+
+@dataclass
+class ArchiveEntry:
+    path: str
+    offset: int
+    size: int
+
+
+@dataclass
+class ArchiveChunk:
+    offset: int
+    size: int
+    compressed_offset: int
+    compressed_size: int
+
+
+@dataclass
+class ArchiveDirectory:
+    codec: str
+    entries: List[ArchiveEntry]
+    chunks: List[ArchiveChunk]
+
+
+@dataclass
+class ChunkCodec:
+    name: str
+    chunk_size: int
+    compress: Callable[[bytes], bytes]
+    decompress: Callable[[bytes], bytes]
+
+
+class FileArchiveSource:
+    def __init__(self, path: Path):
+        self.path = path
+        self.size = path.stat().st_size
+
+    def read(self, offset: int, size: int) -> bytes:
+        with self.path.open("rb") as f:
+            f.seek(offset)
+            return f.read(size)
+
+
+class HttpArchiveSource:
+    def __init__(self, url: str):
+        info = probe_remote_file(url)
+        if info.size is None or not info.accepts_ranges:
+            raise UnsupportedSourceError("{} does not support random access".format(url))
+        self.url = url
+        self.size = info.size
+        self.validator = info.validator
+
+    def read(self, offset: int, size: int) -> bytes:
+        request = urllib.request.Request(self.url)
+        request.add_header("Range", "bytes={}-{}".format(offset, offset + size - 1))
+        if self.validator is not None:
+            request.add_header("If-Range", self.validator)
+        with urllib.request.urlopen(request) as response:
+            if response.status != 206:
+                raise ContentChangedError("{} changed while reading it".format(self.url))
+            data = response.read()
+        if len(data) != size:
+            raise ConnectionError("short read from {}".format(self.url))
+        return data
+
+
+class UnsupportedSourceError(Exception):
+    pass
+
+
+class BundleFormat(ABC):
+    name: str
+
+    @abstractmethod
+    def available(self) -> bool:
+        pass
+
+    @abstractmethod
+    def pack(self, root: Path, files: List[str], output: Path, threads: int):
+        pass
+
+    @abstractmethod
+    def unpack(self, archive: Path, destination: Path, threads: int):
+        pass
+
+
+class IndexedBundleFormat(BundleFormat):
+    def __init__(self, codec: str):
+        self.name = "indexed-" + codec
+        self.codec = codec
+
+    def available(self) -> bool:
+        return self.codec in load_chunk_codecs()
+
+    def pack(self, root: Path, files: List[str], output: Path, threads: int):
+        write_indexed_archive(root, files, output, threads, self.codec)
+
+    def unpack(self, archive: Path, destination: Path, threads: int):
+        extract_indexed_archive(FileArchiveSource(archive), destination, max_workers=threads)
+
+
+class TarBundleFormat(BundleFormat):
+    def __init__(self, name: str, compressor: List[str], decompressor: List[str], fallback_mode: Optional[str]):
+        self.name = name
+        self.compressor = compressor
+        self.decompressor = decompressor
+        self.fallback_mode = fallback_mode
+
+    def available(self) -> bool:
+        return shutil.which(self.compressor[0]) is not None or self.fallback_mode is not None
+
+    def pack(self, root: Path, files: List[str], output: Path, threads: int):
+        if shutil.which(self.compressor[0]) is None:
+            with tarfile.open(output, "w:" + self.fallback_mode, format=tarfile.PAX_FORMAT) as archive:
+                add_tar_members(archive, root, files)
+            return
+
+        with output.open("wb") as f:
+            process = subprocess.Popen(expand_codec_command(self.compressor, threads), stdin=subprocess.PIPE, stdout=f)
+            try:
+                with tarfile.open(fileobj=process.stdin, mode="w|", format=tarfile.PAX_FORMAT) as archive:
+                    add_tar_members(archive, root, files)
+            finally:
+                process.stdin.close()
+                status = process.wait()
+        if status != 0:
+            raise ArchiveToolError("{} exited with status {}".format(self.compressor[0], status))
+
+    def unpack(self, archive: Path, destination: Path, threads: int):
+        if shutil.which(self.decompressor[0]) is None:
+            with tarfile.open(archive, "r:" + self.fallback_mode) as source:
+                extract_tar_members(source, destination)
+            return
+
+        with archive.open("rb") as f:
+            process = subprocess.Popen(expand_codec_command(self.decompressor, threads), stdin=f, stdout=subprocess.PIPE)
+            try:
+                with tarfile.open(fileobj=process.stdout, mode="r|") as source:
+                    extract_tar_members(source, destination)
+            finally:
+                process.stdout.close()
+                status = process.wait()
+        if status != 0:
+            raise ArchiveToolError("{} exited with status {}".format(self.decompressor[0], status))
+
+
+class SevenZipBundleFormat(BundleFormat):
+    def __init__(self, level: int = SEVENZIP_LEVEL, sfx: bool = False):
+        self.name = "7z-sfx" if sfx else "7z"
+        self.level = level
+        self.sfx = sfx
+
+    def available(self) -> bool:
+        # The self-extractor we embed is a Windows console program.
+        return shutil.which("7z") is not None and (not self.sfx or os.name == "nt")
+
+    def pack(self, root: Path, files: List[str], output: Path, threads: int):
+        output.unlink(missing_ok=True)
+        switches = ["-mx{}".format(self.level), "-mmt{}".format(threads)]
+        if self.sfx:
+            switches.append("-sfx7zCon.sfx")
+        with tempfile.NamedTemporaryFile(mode="w", encoding="utf-8", suffix=".txt", delete=False) as listfile:
+            listfile.write("\n".join(files))
+        try:
+            subprocess.run(["7z", "a", *switches, str(output.resolve()), "@" + listfile.name],
+                           cwd=root, stdout=subprocess.DEVNULL, check=True)
+        finally:
+            os.unlink(listfile.name)
+
+    def unpack(self, archive: Path, destination: Path, threads: int):
+        if self.sfx:
+            subprocess.run([str(archive), "-o" + str(destination), "-y"], check=True)
+        else:
+            subprocess.run(["7z", "x", "-y", "-mmt{}".format(threads), "-o" + str(destination), str(archive)],
+                           stdout=subprocess.DEVNULL, check=True)
+
+
+class ArchiveToolError(Exception):
+    pass
+
+
+cached_chunk_codecs = None
+
+
+def write_indexed_archive(root: Path, files: List[str], output: Path, max_workers: Optional[int] = None,
+                          codec: str = ARCHIVE_CODEC):
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    chunk_codec = get_chunk_codec(codec)
+    chunk_size = chunk_codec.chunk_size
+
+    entries = []
+    chunks = []
+    pending = []
+    buffer = bytearray()
+    stream_offset = 0
+
+    with output.open("wb") as f, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        f.write(ARCHIVE_MAGIC)
+        window = 2 * max_workers
+
+        def submit(data: bytes):
+            pending.append((len(data), executor.submit(chunk_codec.compress, data)))
+            while len(pending) > window:
+                flush_one()
+
+        def flush_one():
+            size, future = pending.pop(0)
+            compressed = future.result()
+            offset = chunks[-1].offset + chunks[-1].size if chunks else 0
+            chunks.append(ArchiveChunk(offset, size, f.tell(), len(compressed)))
+            f.write(compressed)
+
+        for relpath in sorted(files):
+            entry = ArchiveEntry(relpath, stream_offset, 0)
+            with (root / relpath).open("rb") as source:
+                while True:
+                    data = source.read(chunk_size - len(buffer))
+                    if len(data) == 0:
+                        break
+                    buffer += data
+                    entry.size += len(data)
+                    if len(buffer) == chunk_size:
+                        submit(bytes(buffer))
+                        buffer = bytearray()
+            stream_offset += entry.size
+            entries.append(entry)
+        if buffer:
+            submit(bytes(buffer))
+        while pending:
+            flush_one()
+
+        directory = zlib.compress(serialize_archive_directory(ArchiveDirectory(codec, entries, chunks)), 9)
+        directory_offset = f.tell()
+        f.write(directory)
+        f.write(ARCHIVE_FOOTER.pack(directory_offset, len(directory), ARCHIVE_MAGIC))
+
+
+def read_archive_directory(source) -> ArchiveDirectory:
+    if source.size < len(ARCHIVE_MAGIC) + ARCHIVE_FOOTER.size:
+        raise ValueError("not an indexed archive")
+    directory_offset, directory_size, magic = ARCHIVE_FOOTER.unpack(source.read(source.size - ARCHIVE_FOOTER.size,
+                                                                                ARCHIVE_FOOTER.size))
+    if magic != ARCHIVE_MAGIC:
+        raise ValueError("not an indexed archive")
+    return parse_archive_directory(zlib.decompress(source.read(directory_offset, directory_size)))
+
+
+def extract_indexed_archive(source, destination: Path, prefixes: Optional[List[str]] = None,
+                            max_workers: Optional[int] = None) -> List[str]:
+    directory = read_archive_directory(source)
+    if directory.codec not in load_chunk_codecs():
+        raise UnsupportedSourceError("codec {} is not available".format(directory.codec))
+    entries = select_archive_entries(directory, prefixes)
+
+    for entry in entries:
+        if entry.path.startswith("/") or ".." in entry.path.split("/"):
+            raise ValueError("refusing to extract {}".format(entry.path))
+        path = destination / entry.path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with path.open("wb") as f:
+            f.truncate(entry.size)
+
+    plan = plan_chunk_reads(directory, entries)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for future in [executor.submit(extract_chunk, source, directory, chunk_index, pieces, destination)
+                       for chunk_index, pieces in plan.items()]:
+            future.result()
+
+    return [entry.path for entry in entries]
+
+
+def select_archive_entries(directory: ArchiveDirectory, prefixes: Optional[List[str]]) -> List[ArchiveEntry]:
+    if prefixes is None:
+        return list(directory.entries)
+
+    paths = [entry.path for entry in directory.entries]
+    selected = {}
+    for prefix in prefixes:
+        i = bisect_left(paths, prefix)
+        while i != len(paths) and paths[i].startswith(prefix):
+            selected[i] = directory.entries[i]
+            i += 1
+    return [selected[i] for i in sorted(selected.keys())]
+
+
+def plan_chunk_reads(directory: ArchiveDirectory, entries: List[ArchiveEntry]) -> Dict[int, List[Tuple[ArchiveEntry, int, int]]]:
+    chunk_offsets = [chunk.offset for chunk in directory.chunks]
+    plan = {}
+    for entry in entries:
+        if entry.size == 0:
+            continue
+        end = entry.offset + entry.size
+        first = bisect_right(chunk_offsets, entry.offset) - 1
+        last = bisect_left(chunk_offsets, end) - 1
+        for chunk_index in range(first, last + 1):
+            chunk = directory.chunks[chunk_index]
+            start = max(entry.offset, chunk.offset)
+            stop = min(end, chunk.offset + chunk.size)
+            plan.setdefault(chunk_index, []).append((entry, start, stop))
+    return plan
+
+
+def extract_chunk(source, directory: ArchiveDirectory, chunk_index: int, pieces: List[Tuple[ArchiveEntry, int, int]],
+                  destination: Path):
+    chunk = directory.chunks[chunk_index]
+    data = decompress_chunk(directory.codec, source.read(chunk.compressed_offset, chunk.compressed_size))
+    if len(data) != chunk.size:
+        raise ValueError("chunk {} is corrupted".format(chunk_index))
+
+    for entry, start, stop in pieces:
+        with (destination / entry.path).open("r+b") as f:
+            f.seek(start - entry.offset)
+            f.write(data[start - chunk.offset:stop - chunk.offset])
+
+
+def decompress_chunk(codec: str, data: bytes) -> bytes:
+    return get_chunk_codec(codec).decompress(data)
+
+
+def get_chunk_codec(name: str) -> ChunkCodec:
+    codec = load_chunk_codecs().get(name, None)
+    if codec is None:
+        raise ValueError("unsupported codec: {}".format(name))
+    return codec
+
+
+def load_chunk_codecs() -> Dict[str, ChunkCodec]:
+    global cached_chunk_codecs
+    if cached_chunk_codecs is None:
+        codecs = [
+            ChunkCodec("xz", ARCHIVE_CHUNK_SIZE, lambda data: lzma.compress(data, preset=9), lzma.decompress),
+            ChunkCodec("bz2", ARCHIVE_CHUNK_SIZE, lambda data: bz2.compress(data, 9), bz2.decompress),
+            ChunkCodec("zlib", ARCHIVE_CHUNK_SIZE, lambda data: zlib.compress(data, 9), zlib.decompress),
+        ]
+        zstd_codec = load_zstd_codec()
+        if zstd_codec is not None:
+            codecs.append(zstd_codec)
+        cached_chunk_codecs = {codec.name: codec for codec in codecs}
+    return cached_chunk_codecs
+
+
+def load_zstd_codec() -> Optional[ChunkCodec]:
+    try:
+        from compression import zstd
+        compression_options = {
+            zstd.CompressionParameter.compression_level: ZSTD_LEVEL,
+            zstd.CompressionParameter.enable_long_distance_matching: 1,
+            zstd.CompressionParameter.window_log: ZSTD_WINDOW_LOG,
+        }
+        decompression_options = {zstd.DecompressionParameter.window_log_max: ZSTD_WINDOW_LOG}
+        return ChunkCodec("zstd", ZSTD_CHUNK_SIZE,
+                          lambda data: zstd.compress(data, options=compression_options),
+                          lambda data: zstd.decompress(data, options=decompression_options))
+    except ImportError:
+        pass
+
+    try:
+        import zstandard
+        parameters = zstandard.ZstdCompressionParameters.from_level(ZSTD_LEVEL, enable_ldm=True,
+                                                                    window_log=ZSTD_WINDOW_LOG)
+        return ChunkCodec("zstd", ZSTD_CHUNK_SIZE,
+                          lambda data: zstandard.ZstdCompressor(compression_params=parameters).compress(data),
+                          lambda data: zstandard.ZstdDecompressor(max_window_size=1 << ZSTD_WINDOW_LOG).decompress(data))
+    except ImportError:
+        pass
+
+    return None
+
+
+def serialize_archive_directory(directory: ArchiveDirectory) -> bytes:
+    return json.dumps({
+        "format": ARCHIVE_FORMAT,
+        "codec": directory.codec,
+        "entries": [[entry.path, entry.offset, entry.size] for entry in directory.entries],
+        "chunks": [[chunk.offset, chunk.size, chunk.compressed_offset, chunk.compressed_size] for chunk in directory.chunks],
+    }, separators=(",", ":")).encode('utf-8')
+
+
+def parse_archive_directory(blob: bytes) -> ArchiveDirectory:
+    data = json.loads(blob.decode('utf-8'))
+    if data["format"] != ARCHIVE_FORMAT:
+        raise ValueError("unsupported archive format: {}".format(data["format"]))
+    return ArchiveDirectory(data["codec"],
+                            [ArchiveEntry(*fields) for fields in data["entries"]],
+                            [ArchiveChunk(*fields) for fields in data["chunks"]])
+
+
+def load_bundle_formats() -> Dict[str, BundleFormat]:
+    formats = [IndexedBundleFormat(codec) for codec in ["xz", "zstd", "bz2", "zlib"]]
+    formats += [
+        TarBundleFormat("tar.bz2", ["bzip2", "-9", "-c"], ["bzip2", "-d", "-c"], "bz2"),
+        TarBundleFormat("tar.xz", ["xz", "-9", "-T{threads}", "-c"], ["xz", "-d", "-T{threads}", "-c"], "xz"),
+        TarBundleFormat("tar.zst",
+                        ["zstd", "-{}".format(ZSTD_LEVEL), "--long={}".format(ZSTD_WINDOW_LOG), "-T{threads}", "-q", "-c"],
+                        ["zstd", "-d", "--long={}".format(ZSTD_WINDOW_LOG), "-q", "-c"],
+                        None),
+        SevenZipBundleFormat(),
+        SevenZipBundleFormat(sfx=True),
+    ]
+    return {f.name: f for f in formats}
+
+
+def expand_codec_command(command: List[str], threads: int) -> List[str]:
+    return [arg.format(threads=threads) for arg in command]
+
+
+def add_tar_members(archive: tarfile.TarFile, root: Path, files: List[str]):
+    for relpath in files:
+        archive.add(root / relpath, arcname=relpath, recursive=False)
+
+
+def extract_tar_members(archive: tarfile.TarFile, destination: Path):
+    if hasattr(tarfile, "data_filter"):
+        archive.extractall(destination, filter="data")
+    else:
+        archive.extractall(destination)
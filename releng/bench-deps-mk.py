@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+import argparse
+import re
+import time
+from typing import Callable, Dict, List
+
+from deps import compile_deps_model, tokenize_deps_mk
+
+
+LEGACY_KEY_VALUE_PATTERN = re.compile(r"^([a-z]\w+) = (.*?)(?<!\\)$", re.MULTILINE | re.DOTALL)
+LEGACY_VARIABLE_REF_PATTERN = re.compile(r"\$\((\w+)\)")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lines", help="approximate number of lines to generate", type=int, default=100000)
+    parser.add_argument("--options", help="number of options per package", type=int, default=40)
+    parser.add_argument("--rounds", help="number of timed rounds per parser", type=int, default=3)
+
+    arguments = parser.parse_args()
+
+    deps_mk = generate_deps_mk(arguments.lines, arguments.options)
+    print("Generated {} lines, {} bytes".format(deps_mk.count("\n"), len(deps_mk)))
+
+    legacy = dict(legacy_tokenize(deps_mk))
+    current = dict(tokenize_deps_mk(deps_mk))
+    if legacy != current:
+        mismatches = [k for k in legacy.keys() | current.keys() if legacy.get(k) != current.get(k)]
+        raise ValueError("tokenizers disagree on {} variables, e.g. {}".format(len(mismatches), mismatches[0]))
+
+    print()
+    report("legacy tokenize", lambda: dict(legacy_tokenize(deps_mk)), arguments.rounds)
+    report("tokenize", lambda: dict(tokenize_deps_mk(deps_mk)), arguments.rounds)
+    report("legacy compile", lambda: legacy_compile(deps_mk), arguments.rounds)
+    report("compile", lambda: compile_deps_model(deps_mk, 0, 0, ""), arguments.rounds)
+
+
+def generate_deps_mk(lines: int, options_per_package: int) -> str:
+    chunks = [
+        "frida_deps_version = 20220905\n",
+        "frida_bootstrap_version = 20220130\n",
+        "\n",
+        "frida_base_url = https://github.com/frida\n",
+        "\n",
+    ]
+    line_count = len(chunks)
+
+    i = 0
+    while line_count < lines:
+        name = "pkg{}".format(i)
+        block = [
+            "{}_name = Package {}\n".format(name, i),
+            "{}_version = {:040x}\n".format(name, i),
+            "{}_url = $(frida_base_url)/{}.git\n".format(name, name),
+            "{}_hash = $(NULL)\n".format(name),
+            "{}_recipe = meson\n".format(name),
+            "{}_patches = \\\n\t$(NULL)\n".format(name),
+            "{}_options = \\\n".format(name),
+        ]
+        block += ["\t-Doption{}=$({}_version) \\\n".format(j, name) for j in range(options_per_package)]
+        block += [
+            "\t$(NULL)\n",
+            "{}_deps = \\\n".format(name),
+        ]
+        block += ["\tpkg{} \\\n".format(dep) for dep in range(max(0, i - 3), i)]
+        block += [
+            "\t$(NULL)\n",
+            "{}_deps_for_build = \\\n\t$(NULL)\n".format(name),
+            "\n",
+        ]
+        chunks += block
+        line_count += "".join(block).count("\n")
+        i += 1
+
+    return "".join(chunks)
+
+
+def legacy_tokenize(deps_mk: str):
+    for match in LEGACY_KEY_VALUE_PATTERN.finditer(deps_mk):
+        key, value = match.group(1, 2)
+        value = value \
+                .replace("\\\n", " ") \
+                .replace("\t", " ") \
+                .replace("$(NULL)", "") \
+                .strip()
+        while "  " in value:
+            value = value.replace("  ", " ")
+        yield (key, value)
+
+
+def legacy_compile(deps_mk: str) -> Dict[str, List[str]]:
+    raw_params = dict(legacy_tokenize(deps_mk))
+    expand = lambda v: LEGACY_VARIABLE_REF_PATTERN.sub(lambda match: raw_params.get(match.group(1), ""), v)
+    return {key[:-7]: [expand(raw_params[key[:-7] + "_" + field])
+                       for field in ["name", "version", "url", "hash", "recipe", "patches", "deps", "deps_for_build", "options"]]
+            for key in raw_params.keys() if key.endswith("_recipe")}
+
+
+def report(label: str, operation: Callable[[], object], rounds: int):
+    timings = []
+    for _ in range(rounds):
+        started_at = time.perf_counter()
+        operation()
+        timings.append(time.perf_counter() - started_at)
+    print("{:>16}: best {:8.1f} ms  mean {:8.1f} ms".format(label, min(timings) * 1000, sum(timings) / len(timings) * 1000))
+
+
+if __name__ == '__main__':
+    main()
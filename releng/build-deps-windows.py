@@ -1,8 +1,10 @@
 #!/usr/bin/env python3
 
 import argparse
-from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
 from enum import Enum
+import functools
 import hashlib
 import json
 import os
@@ -11,12 +13,23 @@ import platform
 import shutil
 import subprocess
 import sys
+import tarfile
 import tempfile
+import threading
 import time
-from typing import Callable, Dict, List, Tuple
+from typing import Callable, Dict, List, Optional, Set, TextIO, Tuple
 import urllib.request
 
-from deps import read_dependency_parameters, Bundle, DependencyParameters, PackageSpec
+from archive import ARCHIVE_CODEC, IndexedBundleFormat, SevenZipBundleFormat, load_chunk_codecs
+from bundle import package_layers, serialize_layer_index, store_objects, write_manifest
+from deps import read_dependency_parameters, parse_extra_formats, Bundle, DependencyGraph, DependencyParameters, \
+        ExtraFormat, PackageSpec
+from gitsource import GitFetchMode, GitOptions, checkout_git_revision, clone_git_repository, query_git_head
+from resources import PeakMemorySampler, query_physical_memory
+from scheduler import CoreBudget, Job, JobRunner, MemoryBudget, build_job_graph, compute_job_ranks, estimate_makespan, run_jobs
+from timing import TimingHistory, TimingRecord, TimingRecorder, write_chrome_trace, write_timing_records
+from transfer import DownloadCache, DownloadProgress, IntegrityError, TeeReader, compute_file_sha256, \
+        extract_tarball_stream, format_size
 import winenv
 
 
@@ -43,6 +56,49 @@ class MesonEnv:
     shell_env: ShellEnv
 
 
+@dataclass
+class BuildJob:
+    name: str
+    spec: PackageSpec
+    extra_options: List[str]
+    arch: str
+    config: str
+    runtime: str
+    key: str
+
+
+@dataclass
+class StagingStats:
+    linked: int = 0
+    copied: int = 0
+    deduplicated: int = 0
+
+    def record(self, method: str):
+        setattr(self, method, getattr(self, method) + 1)
+
+    def merge(self, other: 'StagingStats'):
+        self.linked += other.linked
+        self.copied += other.copied
+        self.deduplicated += other.deduplicated
+
+
+@dataclass
+class TreeIndex:
+    root: Path
+    directories: Dict[PurePath, List[str]]
+
+    def files(self) -> List[PurePath]:
+        return [directory / name for directory, names in self.directories.items() for name in names]
+
+    def paths(self) -> Set[str]:
+        result = set([directory.as_posix() for directory in self.directories.keys()])
+        result.update([path.as_posix() for path in self.files()])
+        return result
+
+
+FileSelector = Callable[[str], bool]
+
+
 ARCHITECTURES = {
     PackageRole.TOOL: ['x86'],
     PackageRole.LIBRARY: ['x86_64', 'x86'],
@@ -56,11 +112,33 @@ RUNTIMES = {
     PackageRole.LIBRARY: ['static', 'dynamic'],
 }
 COMPRESSION_LEVEL = 9
+BUILD_CACHE_FORMAT = 1
+MAX_CONCURRENT_FETCHES = 8
+DEFAULT_BUILD_JOBS = min(4, os.cpu_count() or 1)
+STAGING_CONCURRENCY = 8
+DOWNLOAD_CACHE_MAX_SIZE = 2 * 1024 * 1024 * 1024
+BUILD_CACHE_MAX_SIZE = 8 * 1024 * 1024 * 1024
+DEFAULT_JOB_COST = 5 * 60
+DEFAULT_JOB_COSTS = {
+    "v8": 60 * 60,
+}
+DEFAULT_JOB_MEMORY = 1024 * 1024 * 1024
+DEFAULT_JOB_MEMORIES = {
+    "v8": 6 * 1024 * 1024 * 1024,
+}
+MEMORY_BUDGET_FRACTION = 0.8
+BUILD_STEPS = ["setup", "install", "introspect"]
+HISTORY_PHASES = ["sync", "package"]
 
 RELENG_DIR = Path(__file__).parent.resolve()
 ROOT_DIR = RELENG_DIR.parent
 DEPS_DIR = ROOT_DIR / "deps"
 BOOTSTRAP_TOOLCHAIN_DIR = ROOT_DIR / "build" / "fts-toolchain-windows"
+DEPS_OBJECTS_DIR = ROOT_DIR / "build" / "deps-objects"
+DEPS_LAYERS_DIR = ROOT_DIR / "build" / "deps-layers"
+TIMINGS_PATH = ROOT_DIR / "build" / "deps-windows-timings.jsonl"
+TRACE_PATH = ROOT_DIR / "build" / "deps-windows-trace.json"
+TIMING_HISTORY_PATH = ROOT_DIR / "build" / "deps-windows-history.json"
 
 MESON = RELENG_DIR / "meson" / "meson.py"
 NINJA = BOOTSTRAP_TOOLCHAIN_DIR / "bin" / "ninja.exe"
@@ -128,8 +206,13 @@ HOST_DEFINES = {
 
 
 cached_meson_params = {}
+cached_meson_params_lock = threading.Lock()
 cached_target_glib = None
 cached_bootstrap_valac = None
+cached_download_cache = None
+build_cache_lock = threading.Lock()
+
+timings = TimingRecorder()
 
 build_arch = 'x86_64' if platform.machine().endswith("64") else 'x86'
 
@@ -140,6 +223,23 @@ def main():
                         default=None, choices=[name.lower() for name in Bundle.__members__])
     parser.add_argument("--v8", help="whether to include V8 in the SDK",
                         default='enabled', choices=['enabled', 'disabled'])
+    parser.add_argument("--jobs", help="maximum number of package variants to build concurrently",
+                        type=int, default=DEFAULT_BUILD_JOBS)
+    parser.add_argument("--git-fetch", help="how much of each git dependency's history to fetch",
+                        default='full', choices=[name.lower() for name in GitFetchMode.__members__])
+    parser.add_argument("--git-cache", help="directory with bare mirrors to share git objects between checkouts",
+                        default=os.environ.get("FRIDA_GIT_CACHE", None))
+    parser.add_argument("--bundle-codec", help="codec to compress the indexed bundle archives with",
+                        default=ARCHIVE_CODEC, choices=list(load_chunk_codecs().keys()))
+    parser.add_argument("--extra-formats", help="also package these formats besides the installer: "
+                        + ", ".join([name.lower() for name in ExtraFormat.__members__]) + " (comma-separated)",
+                        type=parse_extra_formats, default=set())
+    parser.add_argument("--memory-budget", help="maximum combined peak memory of concurrent build jobs, in GiB",
+                        type=float, default=None)
+    parser.add_argument("--cores", help="number of CPU cores to split between concurrent ninja builds",
+                        type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--plan", help="print the expected critical path and completion time, then exit",
+                        default=False, action='store_true')
 
     arguments = parser.parse_args()
 
@@ -154,19 +254,35 @@ def main():
         packages = [pkg for pkg in packages if pkg[0] != "v8"]
 
     params = read_dependency_parameters(HOST_DEFINES)
+    packages = compute_build_order(packages, params)
+
+    git_options = GitOptions(GitFetchMode[arguments.git_fetch.upper()],
+                             Path(arguments.git_cache).resolve() if arguments.git_cache is not None else None)
+
+    if arguments.memory_budget is not None:
+        memory_budget = int(arguments.memory_budget * 1024 * 1024 * 1024)
+    else:
+        memory_budget = compute_default_memory_budget()
+
+    if arguments.plan:
+        print_build_plan(packages, params, arguments.jobs, memory_budget)
+        return
 
     started_at = time.time()
     sync_ended_at = None
     build_ended_at = None
     packaging_ended_at = None
     try:
-        synchronize(packages, params)
+        with timings.measure("sync"):
+            synchronize(packages, params, git_options)
         sync_ended_at = time.time()
 
-        build(packages, params)
+        with timings.measure("build"):
+            build(packages, params, arguments.jobs, memory_budget=memory_budget, cores=arguments.cores)
         build_ended_at = time.time()
 
-        package(bundle_ids, params)
+        with timings.measure("package"):
+            package(bundle_ids, params, arguments.extra_formats, arguments.bundle_codec)
         packaging_ended_at = time.time()
     except subprocess.CalledProcessError as e:
         print(e, file=sys.stderr)
@@ -193,18 +309,46 @@ def main():
         if packaging_ended_at is not None:
             print("  Packaging: {}".format(format_duration(packaging_ended_at - build_ended_at)))
 
+        records = timings.snapshot()
+        if records:
+            # Never let bookkeeping mask the outcome of the build itself.
+            try:
+                write_timing_records(records, TIMINGS_PATH)
+                write_chrome_trace(records, TRACE_PATH)
+                update_timing_history(records, params)
+                print("")
+                print("Wrote {} timing records to {} and {}".format(len(records), TIMINGS_PATH, TRACE_PATH))
+            except Exception as e:
+                print("Unable to record timings: {}".format(e), file=sys.stderr)
+
+
+def compute_build_order(packages: List[Package], params: DependencyParameters) -> List[Package]:
+    packages_by_name = {pkg[0]: pkg for pkg in packages}
+    names = list(packages_by_name.keys())
+    deps_graph = DependencyGraph.from_parameters(params, names).subgraph(names)
+    return [packages_by_name[name] for name in deps_graph.topological_order()]
+
 
-def synchronize(packages: List[Package], params: DependencyParameters):
+def synchronize(packages: List[Package], params: DependencyParameters, git_options: GitOptions):
     toolchain_state = ensure_bootstrap_toolchain(params.bootstrap_version)
     if toolchain_state == SourceState.MODIFIED:
         wipe_build_state()
 
     check_environment()
 
-    for name, _, _ in packages:
-        pkg_state = grab_and_prepare(name, params.get_package_spec(name), params)
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_FETCHES) as executor:
+        pending = [(name, executor.submit(grab_and_prepare, name, params.get_package_spec(name), params, git_options))
+                   for name, _, _ in packages]
+
+    modified = []
+    for name, future in pending:
+        pkg_state = future.result()
+        print("{name}: {state}".format(name=name, state=pkg_state.name.lower()))
         if pkg_state == SourceState.MODIFIED:
-            wipe_build_state()
+            modified.append(name)
+
+    if modified:
+        invalidate_packages(modified, params)
 
 def check_environment():
     try:
@@ -219,36 +363,39 @@ def check_environment():
             print("ERROR: {} not found on PATH".format(tool), file=sys.stderr)
             sys.exit(1)
 
-def grab_and_prepare(name: str, spec: PackageSpec, params: DependencyParameters) -> SourceState:
+def grab_and_prepare(name: str, spec: PackageSpec, params: DependencyParameters, git_options: GitOptions) -> SourceState:
     assert spec.recipe == 'meson'
-    return grab_and_prepare_package(name, spec)
+    return grab_and_prepare_package(name, spec, git_options)
 
-def grab_and_prepare_package(name: str, spec: PackageSpec) -> SourceState:
+def grab_and_prepare_package(name: str, spec: PackageSpec, git_options: GitOptions) -> SourceState:
     if spec.hash == "":
-        return grab_and_prepare_git_package(name, spec)
+        return grab_and_prepare_git_package(name, spec, git_options)
     else:
         return grab_and_prepare_tarball_package(name, spec)
 
-def grab_and_prepare_git_package(name: str, spec: PackageSpec) -> SourceState:
+def grab_and_prepare_git_package(name: str, spec: PackageSpec, git_options: GitOptions) -> SourceState:
     assert spec.patches == []
 
     source_dir = DEPS_DIR / name
+    source_state = SourceState.PRISTINE
     if source_dir.exists():
-        if query_git_head(source_dir) == spec.version:
-            source_state = SourceState.PRISTINE
-        else:
-            print()
-            print("{name}: synchronizing".format(name=name))
-            perform("git", "fetch", "-q", cwd=source_dir)
-            perform("git", "checkout", "-q", spec.version, cwd=source_dir)
+        head = query_git_head(source_dir)
+        if head is None:
+            print("{name}: discarding broken checkout".format(name=name), flush=True)
+            shutil.rmtree(source_dir)
             source_state = SourceState.MODIFIED
-    else:
-        print()
-        print("{name}: cloning into deps\\{name}".format(name=name))
-        DEPS_DIR.mkdir(parents=True, exist_ok=True)
-        perform("git", "clone", "-q", "--recurse-submodules", spec.url, name, cwd=DEPS_DIR)
-        perform("git", "checkout", "-q", spec.version, cwd=source_dir)
-        source_state = SourceState.PRISTINE
+        elif head != spec.version:
+            print("{name}: synchronizing".format(name=name), flush=True)
+            with timings.measure("fetch", name):
+                checkout_git_revision(source_dir, spec.url, spec.version, git_options)
+            source_state = SourceState.MODIFIED
+
+    if not source_dir.exists():
+        print("{name}: cloning into deps\\{name}".format(name=name), flush=True)
+        with timings.measure("fetch", name):
+            clone_git_repository(source_dir, spec.url, spec.version, git_options)
+
+    print("{name}: ready".format(name=name), flush=True)
 
     return source_state
 
@@ -262,76 +409,57 @@ def grab_and_prepare_tarball_package(name: str, spec: PackageSpec) -> SourceStat
         pass
 
     source_dir = DEPS_DIR / name
-    if source_dir.exists():
-        shutil.rmtree(source_dir)
-        source_state = SourceState.MODIFIED
-    else:
-        source_state = SourceState.PRISTINE
-
-    archive_path = None
-    sha256 = hashlib.sha256()
+    DEPS_DIR.mkdir(parents=True, exist_ok=True)
+    incoming_dir = Path(tempfile.mkdtemp(prefix="." + name + "-incoming-", dir=DEPS_DIR))
     try:
-        print("> Downloading", spec.url)
-
-        with urllib.request.urlopen(spec.url) as response, tempfile.NamedTemporaryFile(delete=False) as archive:
-            archive_path = Path(archive.name)
-            while True:
-                chunk = response.read(65536)
-                if len(chunk) == 0:
-                    break
-                archive.write(chunk)
-                sha256.update(chunk)
-
-        digest = sha256.hexdigest()
-        if digest != spec.hash:
-            raise ValueError("{} tarball is corrupted; its hash is {}".format(name, digest))
-
-        print("> Extracting", spec.url)
-
-        staging_dir = source_dir / "__staging__"
-        staging_dir.mkdir(parents=True)
-
-        uncompress = subprocess.Popen(["7z", "x", "-tgzip", "-so", archive_path],
-                                      stdout=subprocess.PIPE,
-                                      stderr=subprocess.DEVNULL)
-        extract = subprocess.Popen(["7z", "x", "-ttar", "-si"],
-                                   stdin=uncompress.stdout,
-                                   stdout=subprocess.PIPE,
-                                   stderr=subprocess.STDOUT,
-                                   encoding='utf-8',
-                                   cwd=staging_dir)
-        uncompress.stdout.close()
-        output = extract.communicate()[0]
-        if extract.returncode != 0:
-            raise ValueError("{} extraction failed: {}".format(name, output))
-
-        for entry in staging_dir.glob(name + "*/*"):
-            shutil.move(str(entry), source_dir)
-
-        shutil.rmtree(staging_dir)
-    finally:
+        download_cache = get_download_cache()
+        archive_path = download_cache.lookup(spec.hash)
         if archive_path is not None:
+            print("{name}: extracting cached {url}".format(name=name, url=spec.url), flush=True)
+            with timings.measure("extract", name), archive_path.open("rb") as archive:
+                extract_tarball_stream(archive, incoming_dir, name)
+        else:
+            print("{name}: downloading and extracting {url}".format(name=name, url=spec.url), flush=True)
             try:
-                archive_path.unlink()
-            except:
-                pass
-
-    for patch_name in spec.patches:
-        print("> Applying", patch_name)
-        patch_path = Path(RELENG_DIR / "patches" / patch_name)
-        patch_data = patch_path.read_text(encoding='utf-8')
-        p = subprocess.Popen(["patch", "-p1"],
-                             stdin=subprocess.PIPE,
-                             stdout=subprocess.PIPE,
-                             stderr=subprocess.STDOUT,
-                             encoding='utf-8',
-                             cwd=source_dir)
-        output = p.communicate(patch_data)[0]
-        if p.returncode != 0:
-            raise ValueError("unable to apply {}: {}".format(patch_name, output))
+                with timings.measure("fetch", name), \
+                        urllib.request.urlopen(spec.url) as response, download_cache.store(spec.hash) as cache_entry:
+                    progress = DownloadProgress(name, int(response.headers.get("Content-Length", 0)))
+                    stream = TeeReader(response, cache_entry, progress.update)
+                    extract_tarball_stream(stream, incoming_dir, name)
+                    stream.drain()
+            except IntegrityError as e:
+                raise ValueError("{} tarball is corrupted; {}".format(name, e))
+
+        for patch_name in spec.patches:
+            print("{name}: applying {patch}".format(name=name, patch=patch_name), flush=True)
+            patch_path = Path(RELENG_DIR / "patches" / patch_name)
+            patch_data = patch_path.read_text(encoding='utf-8')
+            with timings.measure("patch", name):
+                p = subprocess.Popen(["patch", "-p1"],
+                                     stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.STDOUT,
+                                     encoding='utf-8',
+                                     cwd=incoming_dir)
+                output = p.communicate(patch_data)[0]
+                if p.returncode != 0:
+                    raise ValueError("unable to apply {}: {}".format(patch_name, output))
+
+        version_file.unlink(missing_ok=True)
+        if source_dir.exists():
+            shutil.rmtree(source_dir)
+            source_state = SourceState.MODIFIED
+        else:
+            source_state = SourceState.PRISTINE
+        incoming_dir.rename(source_dir)
+    except:
+        shutil.rmtree(incoming_dir, ignore_errors=True)
+        raise
 
     version_file.write_text(spec.version + "\n", encoding='utf-8')
 
+    print("{name}: ready".format(name=name), flush=True)
+
     return source_state
 
 
@@ -347,32 +475,327 @@ def wipe_build_state():
             shutil.rmtree(path)
 
 
-def build(packages: List[Package], params: DependencyParameters):
+def invalidate_packages(names: List[str], params: DependencyParameters):
+    all_names = [name for name, _, _ in ALL_PACKAGES]
+    deps_graph = DependencyGraph.from_parameters(params, all_names).subgraph(all_names)
+
+    affected = set(names)
+    for name in names:
+        affected.update(deps_graph.reverse_dependencies(name, transitive=True))
+
+    print("*** Invalidating", ", ".join([name for name in deps_graph.topological_order() if name in affected]))
+    for name, role, _ in ALL_PACKAGES:
+        if name in affected:
+            for arch, config, runtime in enumerate_variants(role):
+                uninstall_variant(name, arch, config, runtime)
+
+def uninstall_variant(name: str, arch: str, config: str, runtime: str):
+    prefix = get_prefix_path(arch, config, runtime)
+    manifest_path = get_manifest_path(name, arch, config, runtime)
+    if manifest_path.exists():
+        for entry in manifest_path.read_text(encoding='utf-8').strip().split("\n"):
+            if entry == "":
+                continue
+            path = prefix / entry
+            path.unlink(missing_ok=True)
+            remove_empty_parent_dirs(path, prefix)
+        manifest_path.unlink()
+
+    get_variant_key_path(name, arch, config, runtime).unlink(missing_ok=True)
+
+    build_dir = get_tmp_path(arch, config, runtime) / name
+    if build_dir.exists():
+        shutil.rmtree(build_dir)
+
+def remove_empty_parent_dirs(path: Path, root: Path):
+    directory = path.parent
+    while directory != root and root in directory.parents:
+        try:
+            directory.rmdir()
+        except OSError:
+            break
+        directory = directory.parent
+
+
+def build(packages: List[Package], params: DependencyParameters, max_workers: int, runner: Optional[JobRunner] = None,
+          memory_budget: Optional[int] = None, cores: Optional[int] = None):
+    jobs = plan_build_jobs(packages, params, compute_toolchain_id(params))
+    history = TimingHistory.load(TIMING_HISTORY_PATH)
+    costs = estimate_job_costs(jobs, history)
+    ranks = compute_job_ranks(jobs, costs)
+    priority = lambda job: ranks[job.id]
+    admission = MemoryBudget(memory_budget, estimate_job_memory(jobs, history)) if memory_budget is not None else None
+
+    core_budget = CoreBudget(cores if cores is not None else os.cpu_count() or 1)
+    if runner is None:
+        runner = functools.partial(run_build_job, log_output=max_workers > 1, core_budget=core_budget)
+
+    for job in jobs:
+        b = job.payload
+        uninstall_variant(b.name, b.arch, b.config, b.runtime)
+
+    if jobs:
+        print("Expecting {} build jobs to take about {}".format(len(jobs),
+              format_duration(estimate_makespan(jobs, costs, max_workers, priority, admission))), flush=True)
+        if memory_budget is not None:
+            print("Keeping concurrent build jobs within {} of memory".format(format_size(memory_budget)), flush=True)
+
+    run_jobs(jobs, runner, max_workers, priority, admission, core_budget)
+
+def print_build_plan(packages: List[Package], params: DependencyParameters, max_workers: int,
+                     memory_budget: Optional[int] = None):
+    jobs = plan_build_jobs(packages, params, compute_toolchain_id(params))
+    history = TimingHistory.load(TIMING_HISTORY_PATH)
+    costs = estimate_job_costs(jobs, history)
+    ranks = compute_job_ranks(jobs, costs)
+    demands = estimate_job_memory(jobs, history)
+    admission = MemoryBudget(memory_budget, demands) if memory_budget is not None else None
+
+    print("{} build jobs, highest priority first:".format(len(jobs)))
+    for job in sorted(jobs, key=lambda job: ranks[job.id], reverse=True):
+        print("  {}  {:>12}  {}".format(format_duration(costs[job.id]), format_size(demands[job.id]), job.id))
+
+    length, path = build_job_graph(jobs).critical_path(costs)
+    print("")
+    print("Critical path ({}): {}".format(format_duration(length), " -> ".join(path)))
+    if memory_budget is not None:
+        print("Memory budget: {}".format(format_size(memory_budget)))
+
+    sync_time = history.estimate_phase("sync") or 0.0
+    build_time = estimate_makespan(jobs, costs, max_workers, lambda job: ranks[job.id], admission)
+    packaging_time = history.estimate_phase("package") or 0.0
+    total_time = sync_time + build_time + packaging_time
+    print("")
+    print("       Sync: {}".format(format_duration(sync_time)))
+    print("      Build: {} with {} jobs".format(format_duration(build_time), max_workers))
+    print("  Packaging: {}".format(format_duration(packaging_time)))
+    print("      Total: {}, done at about {}".format(format_duration(total_time),
+                                                     time.strftime("%H:%M", time.localtime(time.time() + total_time))))
+
+def estimate_job_costs(jobs: List[Job], history: TimingHistory) -> Dict[str, float]:
+    costs = {}
+    for job in jobs:
+        b = job.payload
+        if get_build_cache_path(b.key).exists():
+            costs[job.id] = 0.0
+            continue
+        estimate = history.estimate(b.name, b.spec.version, compute_variant_name(b.arch, b.config, b.runtime))
+        costs[job.id] = estimate if estimate is not None else DEFAULT_JOB_COSTS.get(b.name, DEFAULT_JOB_COST)
+    return costs
+
+def estimate_job_memory(jobs: List[Job], history: TimingHistory) -> Dict[str, int]:
+    demands = {}
+    for job in jobs:
+        b = job.payload
+        if get_build_cache_path(b.key).exists():
+            demands[job.id] = 0
+            continue
+        estimate = history.estimate_peak(b.name, compute_variant_name(b.arch, b.config, b.runtime))
+        demands[job.id] = estimate if estimate is not None else DEFAULT_JOB_MEMORIES.get(b.name, DEFAULT_JOB_MEMORY)
+    return demands
+
+def compute_default_memory_budget() -> Optional[int]:
+    physical_memory = query_physical_memory()
+    if physical_memory is None:
+        print("Unable to determine physical memory, so build jobs are not limited by memory; "
+              "install psutil or pass --memory-budget", file=sys.stderr)
+        return None
+    return int(physical_memory * MEMORY_BUDGET_FRACTION)
+
+def update_timing_history(records: List[TimingRecord], params: DependencyParameters):
+    durations = {}
+    completed = []
+    for record in records:
+        if record.name in BUILD_STEPS:
+            key = (record.package, record.variant)
+            durations[key] = durations.get(key, 0.0) + record.duration
+            if record.name == BUILD_STEPS[-1] and record.status == "ok":
+                completed.append(key)
+
+    history = TimingHistory.load(TIMING_HISTORY_PATH)
+    for name, variant in completed:
+        history.record(name, params.get_package_spec(name).version, variant, durations[(name, variant)])
+    for record in records:
+        if record.name in HISTORY_PHASES and record.status == "ok":
+            history.record_phase(record.name, record.duration)
+        if record.details.get("peak_rss") is not None:
+            history.record_peak(record.package, record.variant, record.details["peak_rss"])
+    history.save(TIMING_HISTORY_PATH)
+
+def plan_build_jobs(packages: List[Package], params: DependencyParameters, toolchain_id: str) -> List[Job]:
+    names = [name for name, _, _ in packages]
+    deps_graph = DependencyGraph.from_parameters(params, names).subgraph(names)
+
+    variants = {name: list(enumerate_variants(role)) for name, role, _ in packages}
+
+    keys = {}
+    jobs = []
     for name, role, extra_options in packages:
-        build_package(name, role, params.get_package_spec(name), extra_options)
+        spec = params.get_package_spec(name)
+        for arch, config, runtime in variants[name]:
+            dep_ids = []
+            for dep in deps_graph.dependencies(name):
+                dep_variants = variants[dep]
+                if (arch, config, runtime) in dep_variants:
+                    dep_variants = [(arch, config, runtime)]
+                dep_ids += [compute_job_id(dep, *variant) for variant in dep_variants]
+
+            job_id = compute_job_id(name, arch, config, runtime)
+            key = compute_variant_key(spec, extra_options, toolchain_id, arch, config, runtime,
+                                      [keys[dep_id] for dep_id in dep_ids])
+            keys[job_id] = key
+
+            if get_manifest_path(name, arch, config, runtime).exists() \
+                    and read_variant_key(name, arch, config, runtime) == key:
+                continue
+
+            jobs.append(Job(job_id, dep_ids, BuildJob(name, spec, extra_options, arch, config, runtime, key)))
+    return jobs
+
+def enumerate_variants(role: PackageRole):
+    for arch in ARCHITECTURES[role]:
+        for config in CONFIGURATIONS[role]:
+            for runtime in RUNTIMES[role]:
+                yield (arch, config, runtime)
+
+def compute_job_id(name: str, arch: str, config: str, runtime: str) -> str:
+    return "{}:{}".format(name, compute_variant_name(arch, config, runtime))
+
+def compute_variant_name(arch: str, config: str, runtime: str) -> str:
+    return "{}-{}-{}".format(arch, config.lower(), runtime)
+
+def run_build_job(job: Job, log_output: bool, core_budget: Optional[CoreBudget] = None):
+    b = job.payload
+    ninja_jobs = core_budget.granted(job) if core_budget is not None else None
+    variant = compute_variant_name(b.arch, b.config, b.runtime)
+
+    with timings.measure("restore", b.name, variant):
+        restored = restore_variant_from_cache(b)
+    if restored:
+        print("*** Restored {} from build cache".format(job.id), flush=True)
+        return
+
+    print("*** Building {} with arch={} runtime={} config={} spec={}".format(b.spec.name, b.arch, b.config, b.runtime, b.spec),
+          flush=True)
+
+    assert b.spec.recipe == 'meson'
+    if log_output:
+        log_path = get_tmp_path(b.arch, b.config, b.runtime) / (b.name + ".log")
+        log_path.parent.mkdir(parents=True, exist_ok=True)
+        with log_path.open("w", encoding='utf-8') as log:
+            try:
+                build_using_meson(b.name, b.arch, b.config, b.runtime, b.spec, b.extra_options, log, ninja_jobs)
+            except subprocess.CalledProcessError:
+                print("*** Failed to build {} - see {} for more information".format(job.id, log_path), file=sys.stderr, flush=True)
+                raise
+        print("*** Built {}".format(job.id), flush=True)
+    else:
+        print()
+        build_using_meson(b.name, b.arch, b.config, b.runtime, b.spec, b.extra_options, ninja_jobs=ninja_jobs)
 
-def build_package(name: str, role: PackageRole, spec: PackageSpec, extra_options: List[str]):
-    archs = ARCHITECTURES[role]
-    configs = CONFIGURATIONS[role]
-    runtimes = RUNTIMES[role]
+    assert get_manifest_path(b.name, b.arch, b.config, b.runtime).exists()
 
-    for arch in archs:
-        for config in configs:
-            for runtime in runtimes:
-                manifest_path = get_manifest_path(name, arch, config, runtime)
-                if manifest_path.exists():
-                    continue
+    with timings.measure("cache", b.name, variant):
+        store_variant_in_cache(b)
 
-                print()
-                print("*** Building {} with arch={} runtime={} config={} spec={}".format(spec.name, arch, config, runtime, spec))
+def compute_toolchain_id(params: DependencyParameters) -> str:
+    return ":".join([
+        params.bootstrap_version,
+        Path(winenv.get_msvc_tool_dir()).name,
+        winenv.get_windows_sdk()[1],
+    ])
 
-                assert spec.recipe == 'meson'
-                build_using_meson(name, arch, config, runtime, spec, extra_options)
+def compute_variant_key(spec: PackageSpec, extra_options: List[str], toolchain_id: str,
+                        arch: str, config: str, runtime: str, dep_keys: List[str]) -> str:
+    patches = {}
+    for patch_name in spec.patches:
+        patches[patch_name] = hashlib.sha256((RELENG_DIR / "patches" / patch_name).read_bytes()).hexdigest()
+
+    description = json.dumps({
+        "format": BUILD_CACHE_FORMAT,
+        "spec": asdict(spec),
+        "patches": patches,
+        "extra_options": extra_options,
+        "toolchain": toolchain_id,
+        "variant": [arch, config, runtime],
+        "deps": dep_keys,
+    }, sort_keys=True)
 
-                assert manifest_path.exists()
+    return hashlib.sha256(description.encode('utf-8')).hexdigest()
 
-def build_using_meson(name: str, arch: str, config: str, runtime: str, spec: PackageSpec, extra_options: List[str]):
+def read_variant_key(name: str, arch: str, config: str, runtime: str) -> Optional[str]:
+    try:
+        return get_variant_key_path(name, arch, config, runtime).read_text(encoding='utf-8').strip()
+    except FileNotFoundError:
+        return None
+
+def write_variant_key(b: BuildJob):
+    key_path = get_variant_key_path(b.name, b.arch, b.config, b.runtime)
+    key_path.parent.mkdir(parents=True, exist_ok=True)
+    key_path.write_text(b.key + "\n", encoding='utf-8')
+
+def restore_variant_from_cache(b: BuildJob) -> bool:
+    archive_path = get_build_cache_path(b.key)
+    if not archive_path.exists():
+        return False
+
+    with tarfile.open(archive_path, "r:gz") as archive:
+        if hasattr(tarfile, "data_filter"):
+            archive.extractall(get_prefix_path(b.arch, b.config, b.runtime), filter="data")
+        else:
+            archive.extractall(get_prefix_path(b.arch, b.config, b.runtime))
+    try:
+        os.utime(archive_path)
+    except OSError:
+        pass
+    write_variant_key(b)
+
+    return True
+
+def store_variant_in_cache(b: BuildJob):
+    prefix = get_prefix_path(b.arch, b.config, b.runtime)
+    manifest_path = get_manifest_path(b.name, b.arch, b.config, b.runtime)
+    manifest_lines = manifest_path.read_text(encoding='utf-8').strip().split("\n")
+
+    archive_path = get_build_cache_path(b.key)
+    archive_path.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=archive_path.parent, suffix=".tmp", delete=False) as f:
+        temp_path = Path(f.name)
+        with tarfile.open(fileobj=f, mode="w:gz", compresslevel=1) as archive:
+            for entry in manifest_lines + [manifest_path.relative_to(prefix).as_posix()]:
+                archive.add(prefix / entry, arcname=entry, recursive=False)
+    os.replace(temp_path, archive_path)
+
+    write_variant_key(b)
+
+    evict_build_cache(keep=archive_path)
+
+def evict_build_cache(keep: Optional[Path] = None):
+    with build_cache_lock:
+        entries = []
+        for path in get_build_cache_root().glob("*/*.tar.gz"):
+            try:
+                st = path.stat()
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+
+        total_size = sum([size for _, size, _ in entries])
+        for _, size, path in sorted(entries):
+            if total_size <= BUILD_CACHE_MAX_SIZE:
+                break
+            if path == keep:
+                continue
+            try:
+                path.unlink()
+            except OSError:
+                continue
+            total_size -= size
+
+def build_using_meson(name: str, arch: str, config: str, runtime: str, spec: PackageSpec, extra_options: List[str],
+                      output: Optional[TextIO] = None, ninja_jobs: Optional[int] = None):
     env_dir, shell_env = get_meson_params(arch, config, runtime)
+    variant = compute_variant_name(arch, config, runtime)
 
     source_dir = DEPS_DIR / name
     build_dir = env_dir / name
@@ -383,33 +806,40 @@ def build_using_meson(name: str, arch: str, config: str, runtime: str, spec: Pac
     if build_dir.exists():
         shutil.rmtree(build_dir)
 
-    perform(
-        "py", "-3", MESON,
-        "setup",
-        build_dir,
-        "--prefix", prefix,
-        "--default-library", "static",
-        "--backend", "ninja",
-        "-Doptimization=" + optimization,
-        "-Db_ndebug=" + ndebug,
-        "-Db_vscrt=" + vscrt_from_configuration_and_runtime(config, runtime),
-        *spec.options,
-        *extra_options,
-        cwd=source_dir,
-        env=shell_env
-    )
-
-    perform(NINJA, "install", cwd=build_dir, env=shell_env)
+    with timings.measure("setup", name, variant):
+        perform(
+            "py", "-3", MESON,
+            "setup",
+            build_dir,
+            "--prefix", prefix,
+            "--default-library", "static",
+            "--backend", "ninja",
+            "-Doptimization=" + optimization,
+            "-Db_ndebug=" + ndebug,
+            "-Db_vscrt=" + vscrt_from_configuration_and_runtime(config, runtime),
+            *spec.options,
+            *extra_options,
+            cwd=source_dir,
+            env=shell_env,
+            output=output
+        )
+
+    ninja_options = ["-j", str(ninja_jobs)] if ninja_jobs is not None else []
+    sampler = PeakMemorySampler()
+    with timings.measure("install", name, variant) as details:
+        perform(NINJA, "install", *ninja_options, cwd=build_dir, env=shell_env, output=output, sampler=sampler)
+        details["peak_rss"] = sampler.peak
 
     manifest_lines = []
-    install_locations = json.loads(subprocess.check_output([
-            "py", "-3", MESON,
-            "introspect",
-            "--installed"
-        ],
-        cwd=build_dir,
-        encoding='utf-8',
-        env=shell_env))
+    with timings.measure("introspect", name, variant):
+        install_locations = json.loads(subprocess.check_output([
+                "py", "-3", MESON,
+                "introspect",
+                "--installed"
+            ],
+            cwd=build_dir,
+            encoding='utf-8',
+            env=shell_env))
     for installed_path in install_locations.values():
         manifest_lines.append(Path(installed_path).relative_to(prefix).as_posix())
     manifest_lines.sort()
@@ -422,10 +852,11 @@ def get_meson_params(arch: str, config: str, runtime: str) -> Tuple[EnvDir, Shel
 
     identifier = ":".join([arch, config, runtime])
 
-    params = cached_meson_params.get(identifier, None)
-    if params is None:
-        params = generate_meson_params(arch, config, runtime)
-        cached_meson_params[identifier] = params
+    with cached_meson_params_lock:
+        params = cached_meson_params.get(identifier, None)
+        if params is None:
+            params = generate_meson_params(arch, config, runtime)
+            cached_meson_params[identifier] = params
 
     return params
 
@@ -625,15 +1056,22 @@ def detect_bootstrap_valac() -> str:
     return cached_bootstrap_valac
 
 
-def package(bundle_ids: List[Bundle], params: DependencyParameters):
-    with tempfile.TemporaryDirectory(prefix="frida-deps") as tempdir:
+def package(bundle_ids: List[Bundle], params: DependencyParameters, extra_formats: Set[ExtraFormat] = set(),
+            codec: str = ARCHIVE_CODEC):
+    # Stage next to the prefixes so that files can be hard-linked rather than copied.
+    with tempfile.TemporaryDirectory(prefix="frida-deps", dir=ROOT_DIR / "build") as tempdir:
         tempdir = Path(tempdir)
 
         toolchain_filename = "toolchain-windows-x86.exe"
         toolchain_path = ROOT_DIR / "build" / toolchain_filename
+        toolchain_manifest_path = ROOT_DIR / "build" / "toolchain-windows-x86.files.json"
+        toolchain_archive_path = ROOT_DIR / "build" / "toolchain-windows-x86.bundle"
 
         sdk_filename = "sdk-windows-any.exe"
         sdk_path = ROOT_DIR / "build" / sdk_filename
+        sdk_manifest_path = ROOT_DIR / "build" / "sdk-windows-any.files.json"
+        sdk_index_path = ROOT_DIR / "build" / "sdk-windows-any.layers.json"
+        sdk_archive_path = ROOT_DIR / "build" / "sdk-windows-any.bundle"
 
         print("About to assemble:")
         if Bundle.TOOLCHAIN in bundle_ids:
@@ -645,83 +1083,172 @@ def package(bundle_ids: List[Bundle], params: DependencyParameters):
         print("Determining what to include...")
 
         prefixes_dir = get_prefix_root()
+        prefixes_index = index_tree(prefixes_dir)
 
         toolchain_files = []
         toolchain_mixin_files = []
         if Bundle.TOOLCHAIN in bundle_ids:
-            for root, dirs, files in os.walk(get_prefix_path('x86', 'Release', 'static')):
-                relpath = PurePath(root).relative_to(prefixes_dir)
-                all_files = [relpath / f for f in files]
-                toolchain_files += [f for f in all_files if file_is_vala_toolchain_related(f) or \
-                        f.name in ["pkg-config.exe", "glib-genmarshal", "glib-mkenums"] or \
-                        f.parent.name == "manifest"]
+            toolchain_prefix = get_prefix_path('x86', 'Release', 'static').relative_to(prefixes_dir)
+            toolchain_files = select_files(prefixes_index, toolchain_prefix, compile_toolchain_selector)
             toolchain_files.sort()
 
-            for root, dirs, files in os.walk(BOOTSTRAP_TOOLCHAIN_DIR):
-                relpath = PurePath(root).relative_to(BOOTSTRAP_TOOLCHAIN_DIR)
-                all_files = [relpath / f for f in files]
-                toolchain_mixin_files += [f for f in all_files if not (file_is_vala_toolchain_related(f) or \
-                        f.parent.name == "manifest")]
+            toolchain_mixin_files = select_files(index_tree(BOOTSTRAP_TOOLCHAIN_DIR), PurePath(),
+                                                 compile_toolchain_mixin_selector)
             toolchain_mixin_files.sort()
 
         sdk_built_files = []
         if Bundle.SDK in bundle_ids:
-            for prefix in prefixes_dir.glob("*-static"):
-                for root, dirs, files in os.walk(prefix):
-                    relpath = PurePath(root).relative_to(prefixes_dir)
-                    all_files = [relpath / f for f in files]
-                    sdk_built_files += [f for f in all_files if file_is_sdk_related(f)]
-                sdk_built_files += [f.relative_to(prefixes_dir) for f in \
-                        (prefix.parent / (prefix.name[:-7] + "-dynamic") / "lib").glob("**/*.a")]
+            static_prefixes = [directory for directory in prefixes_index.directories.keys()
+                               if len(directory.parts) == 1 and directory.name.endswith("-static")]
+            for prefix in static_prefixes:
+                sdk_built_files += select_files(prefixes_index, prefix, compile_sdk_selector)
+                sdk_built_files += select_files(prefixes_index, PurePath(prefix.name[:-7] + "-dynamic") / "lib",
+                                                compile_static_library_selector)
             sdk_built_files.sort()
 
-        print("Copying files...")
+        print("Staging files...")
+        staging_stats = StagingStats()
         if Bundle.TOOLCHAIN in bundle_ids:
             toolchain_tempdir = tempdir / "toolchain-windows"
-            copy_files(BOOTSTRAP_TOOLCHAIN_DIR, toolchain_mixin_files, toolchain_tempdir)
-            copy_files(prefixes_dir, toolchain_files, toolchain_tempdir, transform_toolchain_dest)
-            fix_manifests(toolchain_tempdir)
-            (toolchain_tempdir / "VERSION.txt").write_text(params.deps_version + "\n", encoding='utf-8')
+            with timings.measure("stage", "toolchain-windows"):
+                staging_stats.merge(copy_files(BOOTSTRAP_TOOLCHAIN_DIR, toolchain_mixin_files, toolchain_tempdir))
+                staging_stats.merge(copy_files(prefixes_dir, toolchain_files, toolchain_tempdir, transform_toolchain_dest))
+                fix_manifests(toolchain_tempdir)
+                (toolchain_tempdir / "VERSION.txt").write_text(params.deps_version + "\n", encoding='utf-8')
+                toolchain_manifest = write_manifest(toolchain_tempdir, params.deps_version)
 
         if Bundle.SDK in bundle_ids:
             sdk_tempdir = tempdir / "sdk-windows"
-            copy_files(prefixes_dir, sdk_built_files, sdk_tempdir, transform_sdk_dest)
-            fix_manifests(sdk_tempdir)
-            (sdk_tempdir / "VERSION.txt").write_text(params.deps_version + "\n", encoding='utf-8')
+            with timings.measure("stage", "sdk-windows"):
+                staging_stats.merge(copy_files(prefixes_dir, sdk_built_files, sdk_tempdir, transform_sdk_dest))
+                fix_manifests(sdk_tempdir)
+                (sdk_tempdir / "VERSION.txt").write_text(params.deps_version + "\n", encoding='utf-8')
+                sdk_manifest = write_manifest(sdk_tempdir, params.deps_version)
+
+        print("Staged {} linked, {} copied, {} deduplicated".format(staging_stats.linked, staging_stats.copied,
+                                                                staging_stats.deduplicated))
 
         print("Compressing...")
-        compression_switches = ["a", "-mx{}".format(COMPRESSION_LEVEL), "-sfx7zCon.sfx"]
+        threads = os.cpu_count() or 1
+        installer_format = SevenZipBundleFormat(COMPRESSION_LEVEL, sfx=True)
 
         if Bundle.TOOLCHAIN in bundle_ids:
-            toolchain_path.unlink(missing_ok=True)
-            perform("7z", *compression_switches, "-r", toolchain_path, "toolchain-windows", cwd=tempdir)
+            with timings.measure("compress", "toolchain-windows"):
+                installer_format.pack(tempdir, ["toolchain-windows/" + f for f in list_files(toolchain_tempdir)],
+                                      toolchain_path, threads)
 
         if Bundle.SDK in bundle_ids:
-            sdk_path.unlink(missing_ok=True)
-            perform("7z", *compression_switches, "-r", sdk_path, "sdk-windows", cwd=tempdir)
+            with timings.measure("compress", "sdk-windows"):
+                installer_format.pack(tempdir, ["sdk-windows/" + f for f in list_files(sdk_tempdir)], sdk_path, threads)
+
+        if ExtraFormat.INDEXED in extra_formats:
+            print("Writing indexed archives...")
+            indexed_format = IndexedBundleFormat(codec)
+
+            if Bundle.TOOLCHAIN in bundle_ids:
+                with timings.measure("index", "toolchain-windows"):
+                    indexed_format.pack(toolchain_tempdir, list_files(toolchain_tempdir), toolchain_archive_path, threads)
+
+            if Bundle.SDK in bundle_ids:
+                with timings.measure("index", "sdk-windows"):
+                    indexed_format.pack(sdk_tempdir, list_files(sdk_tempdir), sdk_archive_path, threads)
+
+        if ExtraFormat.DELTA in extra_formats:
+            print("Storing delta objects...")
+            if Bundle.TOOLCHAIN in bundle_ids:
+                with timings.measure("objects", "toolchain-windows"):
+                    store_objects(toolchain_tempdir, toolchain_manifest, DEPS_OBJECTS_DIR)
+                shutil.copyfile(toolchain_tempdir / "FILES.json", toolchain_manifest_path)
+
+            if Bundle.SDK in bundle_ids:
+                with timings.measure("objects", "sdk-windows"):
+                    store_objects(sdk_tempdir, sdk_manifest, DEPS_OBJECTS_DIR)
+                shutil.copyfile(sdk_tempdir / "FILES.json", sdk_manifest_path)
+
+        if ExtraFormat.LAYERS in extra_formats and Bundle.SDK in bundle_ids:
+            print("Packaging SDK layers...")
+            with timings.measure("layers", "sdk-windows"):
+                sdk_index = package_layers(sdk_tempdir, params.deps_version, DEPS_LAYERS_DIR)
+            sdk_index_path.write_bytes(serialize_layer_index(sdk_index))
 
         print("All done.")
 
 def fix_manifests(root: Path):
-    for manifest_path in root.glob("**/manifest/*.pkg"):
+    index = index_tree(root)
+    existing = index.paths()
+    manifest_paths = [directory / name for directory, names in index.directories.items() if directory.name == "manifest"
+                      for name in names if name.endswith(".pkg")]
+    for manifest_relpath in manifest_paths:
+        manifest_path = root / manifest_relpath
         manifest_lines = []
 
-        prefix = manifest_path.parent.parent
+        prefix = manifest_relpath.parent.parent
         for entry in manifest_path.read_text(encoding='utf-8').strip().split("\n"):
-            if prefix.joinpath(entry).exists():
+            if (prefix / entry).as_posix() in existing:
                 manifest_lines.append(entry)
 
             if entry.startswith("lib/") and entry.endswith(".a"):
                 dynamic_entry = "lib-dynamic/" + entry[4:]
-                if prefix.joinpath(dynamic_entry).exists():
+                if (prefix / dynamic_entry).as_posix() in existing:
                     manifest_lines.append(dynamic_entry)
 
         if len(manifest_lines) > 0:
             manifest_lines.sort()
+            # Staged files may be hard links into the prefixes, so replace rather than modify in place.
+            manifest_path.unlink()
             manifest_path.write_text("\n".join(manifest_lines), encoding='utf-8')
         else:
             manifest_path.unlink()
 
+def compile_sdk_selector(directory: PurePath) -> FileSelector:
+    parts = directory.parts
+    if len(parts) < 2:
+        return lambda name: file_is_sdk_related(directory / name)
+
+    subdir = parts[1]
+    if subdir == "bin":
+        is_release_static = parts[0].endswith("-release-static")
+        return lambda name: is_release_static and name.startswith("v8-mksnapshot-")
+
+    if subdir == "lib" and "vala" in parts[1:]:
+        return lambda name: False
+
+    in_lib = subdir == "lib"
+    in_share = "share" in parts
+    in_vala_vapi_directory = is_vala_toolchain_vapi_directory(directory)
+
+    def select(name: str) -> bool:
+        if in_lib and ("vala" in name or "vapigen" in name):
+            return False
+
+        stem, suffix = os.path.splitext(name)
+
+        if suffix == ".h" and stem.startswith("vala"):
+            return False
+
+        if suffix in [".vapi", ".deps"]:
+            return not in_vala_vapi_directory
+
+        return not in_share and name != "share"
+
+    return select
+
+def compile_toolchain_selector(directory: PurePath) -> FileSelector:
+    if directory.name == "manifest":
+        return lambda name: True
+    in_vala_vapi_directory = is_vala_toolchain_vapi_directory(directory)
+    extra_names = {"pkg-config.exe", "glib-genmarshal", "glib-mkenums"}
+    return lambda name: file_is_vala_toolchain_related(name, in_vala_vapi_directory) or name in extra_names
+
+def compile_toolchain_mixin_selector(directory: PurePath) -> FileSelector:
+    if directory.name == "manifest":
+        return lambda name: False
+    in_vala_vapi_directory = is_vala_toolchain_vapi_directory(directory)
+    return lambda name: not file_is_vala_toolchain_related(name, in_vala_vapi_directory)
+
+def compile_static_library_selector(directory: PurePath) -> FileSelector:
+    return lambda name: name.endswith(".a")
+
 def file_is_sdk_related(candidate: PurePath) -> bool:
     parts = candidate.parts
     subdir = parts[1]
@@ -744,15 +1271,15 @@ def file_is_sdk_related(candidate: PurePath) -> bool:
 
     return "share" not in parts
 
-def file_is_vala_toolchain_related(candidate: PurePath) -> bool:
-    if candidate.suffix in [".vapi", ".deps"]:
-        return is_vala_toolchain_vapi_directory(candidate.parent)
-    return candidate.name.startswith("valac-") and candidate.suffix == ".exe"
+def file_is_vala_toolchain_related(name: str, in_vala_vapi_directory: bool) -> bool:
+    stem, suffix = os.path.splitext(name)
+    if suffix in [".vapi", ".deps"]:
+        return in_vala_vapi_directory
+    return stem.startswith("valac-") and suffix == ".exe"
 
 def is_vala_toolchain_vapi_directory(directory: PurePath) -> bool:
     parts = directory.parts[-3:]
     if len(parts) != 3:
-        print("D parts:", parts)
         return False
     return parts[0] == "share" and \
         parts[1].startswith("vala-") and \
@@ -823,6 +1350,14 @@ def ensure_bootstrap_toolchain(bootstrap_version: str) -> SourceState:
 
     return source_state
 
+def get_download_cache() -> DownloadCache:
+    global cached_download_cache
+    if cached_download_cache is None:
+        directory = os.environ.get("FRIDA_DOWNLOAD_CACHE", None)
+        cached_download_cache = DownloadCache(Path(directory) if directory is not None else ROOT_DIR / "build" / "download-cache",
+                                              DOWNLOAD_CACHE_MAX_SIZE)
+    return cached_download_cache
+
 def get_prefix_root() -> Path:
     return ROOT_DIR / "build" / "fts-windows"
 
@@ -832,6 +1367,15 @@ def get_prefix_path(arch: str, config: str, runtime: str) -> Path:
 def get_manifest_path(name: str, arch: str, config: str, runtime: str) -> Path:
     return get_prefix_path(arch, config, runtime) / "manifest" / (name + ".pkg")
 
+def get_variant_key_path(name: str, arch: str, config: str, runtime: str) -> Path:
+    return get_tmp_path(arch, config, runtime) / (name + ".key")
+
+def get_build_cache_root() -> Path:
+    return ROOT_DIR / "build" / "fts-cache-windows"
+
+def get_build_cache_path(key: str) -> Path:
+    return get_build_cache_root() / key[:2] / (key + ".tar.gz")
+
 def get_tmp_root() -> Path:
     return ROOT_DIR / "build" / "fts-tmp-windows"
 
@@ -851,20 +1395,102 @@ def vscrt_from_configuration_and_runtime(config: str, runtime: str) -> str:
     return result
 
 
-def perform(*args, **kwargs):
-    print(">", " ".join([str(arg) for arg in args]))
-    return subprocess.run(args, check=True, **kwargs)
+def perform(*args, output: Optional[TextIO] = None, sampler: Optional[PeakMemorySampler] = None, **kwargs):
+    command_line = " ".join([str(arg) for arg in args])
+    if output is None:
+        print(">", command_line)
+    else:
+        output.write("> " + command_line + "\n")
+        output.flush()
+        kwargs.update(stdout=output, stderr=subprocess.STDOUT)
+
+    if sampler is None:
+        return subprocess.run(args, check=True, **kwargs)
+
+    with sampler.watch(subprocess.Popen(args, **kwargs)) as process:
+        status = process.wait()
+    if status != 0:
+        raise subprocess.CalledProcessError(status, args)
+    return subprocess.CompletedProcess(args, status)
+
+def list_files(root: Path) -> List[str]:
+    return [path.as_posix() for path in index_tree(root).files()]
+
+def index_tree(root: Path) -> TreeIndex:
+    directories = {}
+    pending = [PurePath()]
+    while pending:
+        reldir = pending.pop()
+        names = []
+        with os.scandir(root / reldir) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(reldir / entry.name)
+                else:
+                    names.append(entry.name)
+        directories[reldir] = names
+    return TreeIndex(root, directories)
+
+def select_files(index: TreeIndex, under: PurePath, compile_selector: Callable[[PurePath], FileSelector]) -> List[PurePath]:
+    selectors = {directory: compile_selector(directory) for directory in index.directories.keys()
+                 if directory == under or under in directory.parents}
+    return [directory / name for directory, select in selectors.items() for name in index.directories[directory]
+            if select(name)]
+
+def copy_files(fromdir: Path, files: List[PurePath], todir: Path, transformdest: Callable[[PurePath], PurePath] = transform_identity) -> StagingStats:
+    pairs = [(fromdir / filename, todir / transformdest(filename)) for filename in files]
+    for dstdir in sorted(set([dst.parent for _, dst in pairs])):
+        dstdir.mkdir(parents=True, exist_ok=True)
 
-def query_git_head(repo_path: str) -> str:
-    return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=repo_path, encoding='utf-8').strip()
+    originals = {}
+    duplicates = []
+    identical = find_identical_files([src for src, _ in pairs])
+    first_dst_by_src = {}
+    for src, dst in pairs:
+        canonical = identical.get(src, src)
+        if canonical in first_dst_by_src:
+            duplicates.append((first_dst_by_src[canonical], dst))
+        else:
+            first_dst_by_src[canonical] = dst
+            originals[dst] = src
+
+    stats = StagingStats()
+    with ThreadPoolExecutor(max_workers=STAGING_CONCURRENCY) as executor:
+        for method in executor.map(lambda item: stage_file(item[1], item[0]), originals.items()):
+            stats.record(method)
+    for existing_dst, dst in duplicates:
+        stage_file(existing_dst, dst)
+        stats.deduplicated += 1
+    return stats
+
+def find_identical_files(paths: List[Path]) -> Dict[Path, Path]:
+    by_size = {}
+    for path in paths:
+        by_size.setdefault(path.stat().st_size, []).append(path)
+
+    candidates = [path for group in by_size.values() if len(group) > 1 for path in group]
+    with ThreadPoolExecutor(max_workers=STAGING_CONCURRENCY) as executor:
+        digests = dict(zip(candidates, executor.map(compute_file_sha256, candidates)))
+
+    result = {}
+    canonical_by_digest = {}
+    for path in candidates:
+        key = (path.stat().st_size, digests[path])
+        canonical = canonical_by_digest.setdefault(key, path)
+        if canonical != path:
+            result[path] = canonical
+    return result
 
-def copy_files(fromdir: Path, files: List[PurePath], todir: Path, transformdest: Callable[[PurePath], PurePath] = transform_identity):
-    for filename in files:
-        src = fromdir / filename
-        dst = todir / transformdest(filename)
-        dstdir = dst.parent
-        dstdir.mkdir(parents=True, exist_ok=True)
-        shutil.copyfile(src, dst)
+def stage_file(src: Path, dst: Path) -> str:
+    dst.unlink(missing_ok=True)
+    try:
+        os.link(src, dst)
+        return "linked"
+    except OSError:
+        pass
+    # On Windows, Python >= 3.12 copies via CopyFile2, which block-clones on ReFS and Dev Drive volumes.
+    shutil.copy2(src, dst)
+    return "copied"
 
 def format_duration(duration_in_seconds: float) -> str:
     hours, remainder = divmod(duration_in_seconds, 3600)
@@ -0,0 +1,264 @@
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+import gzip
+import json
+import os
+from pathlib import Path, PurePosixPath
+import shutil
+import tarfile
+import tempfile
+from typing import BinaryIO, Callable, ContextManager, Dict, List, Optional, Tuple
+
+from transfer import HashingWriter, compute_file_sha256
+
+
+MANIFEST_NAME = "FILES.json"
+VERSION_NAME = "VERSION.txt"
+LAYERS_NAME = "LAYERS.json"
+SUBSET_NAME = "SUBSET.json"
+
+
+@dataclass
+class FileEntry:
+    sha256: str
+    size: int
+
+
+@dataclass
+class BundleManifest:
+    version: str
+    files: Dict[str, FileEntry]
+
+
+@dataclass
+class Layer:
+    id: str
+    variant: str
+    package: Optional[str]
+    size: int
+
+
+@dataclass
+class LayerIndex:
+    version: str
+    layers: List[Layer]
+
+
+ObjectFetcher = Callable[[str], ContextManager[BinaryIO]]
+
+
+def scan_tree(root: Path) -> Dict[str, FileEntry]:
+    files = {}
+    pending = [root]
+    while pending:
+        directory = pending.pop()
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(Path(entry.path))
+                    continue
+                relpath = PurePosixPath(*Path(entry.path).relative_to(root).parts).as_posix()
+                if relpath == MANIFEST_NAME:
+                    continue
+                files[relpath] = FileEntry(compute_file_sha256(Path(entry.path)), entry.stat().st_size)
+    return dict(sorted(files.items()))
+
+
+def write_manifest(root: Path, version: str) -> BundleManifest:
+    manifest = BundleManifest(version, scan_tree(root))
+    (root / MANIFEST_NAME).write_bytes(serialize_manifest(manifest))
+    return manifest
+
+
+def read_manifest(root: Path) -> BundleManifest:
+    return parse_manifest((root / MANIFEST_NAME).read_bytes())
+
+
+def serialize_manifest(manifest: BundleManifest) -> bytes:
+    return json.dumps({
+        "version": manifest.version,
+        "files": {path: [entry.sha256, entry.size] for path, entry in manifest.files.items()},
+    }, indent=0).encode('utf-8')
+
+
+def parse_manifest(blob: bytes) -> BundleManifest:
+    data = json.loads(blob.decode('utf-8'))
+    return BundleManifest(data["version"],
+                          {path: FileEntry(sha256, size) for path, (sha256, size) in data["files"].items()})
+
+
+def compute_delta(old: BundleManifest, new: BundleManifest) -> Tuple[List[str], List[str]]:
+    changed = [path for path, entry in new.files.items() if old.files.get(path) != entry]
+    removed = [path for path in old.files.keys() if path not in new.files]
+    return (changed, removed)
+
+
+def store_objects(root: Path, manifest: BundleManifest, objects_dir: Path) -> int:
+    stored = 0
+    for relpath, entry in manifest.files.items():
+        object_path = objects_dir / compute_object_path(entry.sha256)
+        if object_path.exists():
+            continue
+        object_path.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=object_path.parent, suffix=".tmp", delete=False) as f:
+            with (root / relpath).open("rb") as source, gzip.GzipFile(fileobj=f, mode="wb", mtime=0) as sink:
+                shutil.copyfileobj(source, sink)
+        os.replace(f.name, object_path)
+        stored += 1
+    return stored
+
+
+def compute_object_path(sha256: str) -> str:
+    return "{}/{}.gz".format(sha256[:2], sha256)
+
+
+def apply_delta(root: Path, old: BundleManifest, new: BundleManifest, fetch_object: ObjectFetcher, max_workers: int = 8):
+    _, removed = compute_delta(old, new)
+    # Check every file's contents, so that local modifications and files left by an interrupted update get repaired.
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        stale = [path for path, matches in zip(new.files.keys(),
+                                               executor.map(lambda item: file_matches_entry(root / item[0], item[1]),
+                                                            new.files.items()))
+                 if not matches]
+
+        # VERSION.txt and then the manifest go last, so that an interrupted update is never taken for a complete one.
+        immediate = [path for path in stale if path != VERSION_NAME]
+        for future in [executor.submit(install_object, root, path, new.files[path], fetch_object) for path in immediate]:
+            future.result()
+
+    remove_files(root, removed)
+
+    if VERSION_NAME in stale:
+        install_object(root, VERSION_NAME, new.files[VERSION_NAME], fetch_object)
+
+    (root / MANIFEST_NAME).write_bytes(serialize_manifest(new))
+
+
+def file_matches_entry(path: Path, entry: FileEntry) -> bool:
+    try:
+        return path.stat().st_size == entry.size and compute_file_sha256(path) == entry.sha256
+    except FileNotFoundError:
+        return False
+
+
+def install_object(root: Path, relpath: str, entry: FileEntry, fetch_object: ObjectFetcher):
+    path = root / relpath
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=path.parent, prefix=path.name, suffix=".tmp", delete=False) as f:
+        temp_path = Path(f.name)
+        writer = HashingWriter(f)
+        try:
+            with fetch_object(entry.sha256) as response, gzip.GzipFile(fileobj=response, mode="rb") as source:
+                shutil.copyfileobj(source, writer)
+        except:
+            f.close()
+            temp_path.unlink(missing_ok=True)
+            raise
+
+    digest = writer.sha256.hexdigest()
+    if digest != entry.sha256:
+        temp_path.unlink(missing_ok=True)
+        raise ValueError("{} is corrupted; expected SHA-256 {}, got {}".format(relpath, entry.sha256, digest))
+
+    os.replace(temp_path, path)
+
+
+def package_layers(root: Path, version: str, output_dir: Path) -> LayerIndex:
+    layers = []
+    output_dir.mkdir(parents=True, exist_ok=True)
+    for variant, package, files in plan_layers(root):
+        with tempfile.NamedTemporaryFile(dir=output_dir, suffix=".tmp", delete=False) as f:
+            writer = HashingWriter(f)
+            write_layer_archive(root, files, writer)
+        layer_id = writer.sha256.hexdigest()
+        layer_path = output_dir / compute_layer_path(layer_id)
+        os.replace(f.name, layer_path)
+        layers.append(Layer(layer_id, variant, package, layer_path.stat().st_size))
+    return LayerIndex(version, layers)
+
+
+def plan_layers(root: Path) -> List[Tuple[str, Optional[str], List[str]]]:
+    result = []
+    for variant_dir in sorted([entry for entry in root.iterdir() if entry.is_dir()]):
+        variant = variant_dir.name
+        unowned = set([relpath for relpath in scan_tree(variant_dir).keys()])
+        manifest_dir = variant_dir / "manifest"
+        for manifest_path in sorted(manifest_dir.glob("*.pkg")):
+            files = ["manifest/" + manifest_path.name]
+            files += [entry for entry in manifest_path.read_text(encoding='utf-8').strip().split("\n")
+                      if entry in unowned]
+            unowned.difference_update(files)
+            result.append((variant, manifest_path.stem, [variant + "/" + relpath for relpath in sorted(files)]))
+        if unowned:
+            result.append((variant, None, [variant + "/" + relpath for relpath in sorted(unowned)]))
+    return result
+
+
+def write_layer_archive(root: Path, files: List[str], output: BinaryIO):
+    with gzip.GzipFile(filename="", fileobj=output, mode="wb", mtime=0) as compressed, \
+            tarfile.open(fileobj=compressed, mode="w", format=tarfile.PAX_FORMAT) as archive:
+        for relpath in files:
+            path = root / relpath
+            info = tarfile.TarInfo(relpath)
+            info.size = path.stat().st_size
+            info.mode = 0o644
+            with path.open("rb") as f:
+                archive.addfile(info, f)
+
+
+def extract_layer(fileobj: BinaryIO, destination: Path) -> List[str]:
+    files = []
+    try:
+        with tarfile.open(fileobj=fileobj, mode="r|gz") as archive:
+            for member in archive:
+                if not member.isfile():
+                    continue
+                if hasattr(tarfile, "data_filter"):
+                    member = tarfile.data_filter(member, str(destination))
+                path = destination / member.name
+                path.parent.mkdir(parents=True, exist_ok=True)
+                # Stage each file so that a truncated download never leaves a partial file in place.
+                with tempfile.NamedTemporaryFile(dir=path.parent, prefix=path.name, suffix=".tmp", delete=False) as f:
+                    temp_path = Path(f.name)
+                    try:
+                        shutil.copyfileobj(archive.extractfile(member), f)
+                    except:
+                        f.close()
+                        temp_path.unlink(missing_ok=True)
+                        raise
+                os.chmod(temp_path, member.mode)
+                os.replace(temp_path, path)
+                files.append(member.name)
+    except:
+        remove_files(destination, files)
+        raise
+    return files
+
+
+def compute_layer_path(layer_id: str) -> str:
+    return layer_id + ".tar.gz"
+
+
+def serialize_layer_index(index: LayerIndex) -> bytes:
+    return json.dumps({
+        "version": index.version,
+        "layers": [[layer.id, layer.variant, layer.package, layer.size] for layer in index.layers],
+    }, indent=0).encode('utf-8')
+
+
+def parse_layer_index(blob: bytes) -> LayerIndex:
+    data = json.loads(blob.decode('utf-8'))
+    return LayerIndex(data["version"], [Layer(*fields) for fields in data["layers"]])
+
+
+def remove_files(root: Path, relpaths: List[str]):
+    for relpath in relpaths:
+        path = root / relpath
+        path.unlink(missing_ok=True)
+        directory = path.parent
+        while directory != root:
+            try:
+                directory.rmdir()
+            except OSError:
+                break
+            directory = directory.parent
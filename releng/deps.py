@@ -1,31 +1,83 @@
 #!/usr/bin/env python3
+from __future__ import annotations
 import argparse
 import base64
-from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, replace
 from enum import Enum
+import hashlib
 import json
 import os
-from pathlib import Path
+from pathlib import Path, PurePosixPath
 import platform
+import random
 import re
 import shutil
 import subprocess
 import sys
 import tempfile
+import threading
 import time
-from typing import Dict, List, Tuple
+from typing import Dict, Iterator, List, Optional, Set, Tuple
 import urllib.request
 
+from archive import HttpArchiveSource, UnsupportedSourceError, extract_indexed_archive, load_bundle_formats
+from bundle import LAYERS_NAME, MANIFEST_NAME, SUBSET_NAME, VERSION_NAME, Layer, \
+        apply_delta, compute_delta, compute_layer_path, compute_object_path, extract_layer, \
+        parse_layer_index, parse_manifest, read_manifest, remove_files, serialize_layer_index
+from transfer import ConnectionPool, ContentChangedError, DownloadCache, DownloadProgress, download_file, format_size, \
+        probe_urls
+from upload import create_upload_backend, upload_file
+
 
 BUNDLE_URL = "https://build.frida.re/deps/{version}/{filename}"
+BUNDLE_OBJECT_URL = "https://build.frida.re/deps/objects/{path}"
+BUNDLE_LAYER_URL = "https://build.frida.re/deps/layers/{path}"
+BUNDLE_SUFFIX_FORMATS = {
+    ".exe": "7z-sfx",
+    ".tar.bz2": "tar.bz2",
+}
+DEFAULT_DOWNLOAD_CONNECTIONS = 4
+LAYER_CACHE_MAX_SIZE = 4 * 1024 * 1024 * 1024
+STATUS_CONNECTIONS = 16
+BUMP_CONNECTIONS = 8
+DEFAULT_GITHUB_API_URL = "https://api.github.com"
+WAIT_MIN_INTERVAL = 10
+WAIT_MAX_INTERVAL = 5 * 60
+WAIT_BACKOFF_FACTOR = 1.5
+WAIT_JITTER = 0.1
 
 RELENG_DIR = Path(__file__).parent.resolve()
 DEPS_MK_PATH = RELENG_DIR / "deps.mk"
 ROOT_DIR = RELENG_DIR.parent
 BUILD_DIR = ROOT_DIR / "build"
-
-CONFIG_KEY_VALUE_PATTERN = re.compile(r"^([a-z]\w+) = (.*?)(?<!\\)$", re.MULTILINE | re.DOTALL)
-CONFIG_VARIABLE_REF_PATTERN = re.compile(r"\$\((\w+)\)")
+DEPS_MODEL_PATH = BUILD_DIR / "deps-mk-model.json"
+LAYER_CACHE_DIR = BUILD_DIR / "deps-layer-cache"
+DEPS_MODEL_FORMAT = 2
+
+BUNDLE_TARGETS = {
+    "toolchain": [
+        "windows-x86",
+        "macos-x86_64", "macos-arm64",
+        "linux-x86", "linux-x86_64", "linux-arm64",
+        "freebsd-x86_64", "freebsd-arm64",
+    ],
+    "sdk": [
+        "windows-any",
+        "macos-x86_64", "macos-arm64", "macos-arm64e",
+        "ios-arm64", "ios-arm64e", "ios-x86_64",
+        "android-x86", "android-x86_64", "android-arm", "android-arm64",
+        "linux-x86", "linux-x86_64", "linux-arm", "linux-armbe8", "linux-armhf", "linux-arm64",
+        "linux-mips", "linux-mipsel", "linux-mips64", "linux-mips64el",
+        "freebsd-x86_64", "freebsd-arm64",
+        "qnx-armeabi",
+    ],
+}
+
+CONFIG_ASSIGNMENT_SEPARATOR = " = "
+CONFIG_VARIABLE_REF_START = "$("
+CONFIG_VARIABLE_REF_END = ")"
+CONFIG_NULL_REF = "$(NULL)"
 
 
 class Bundle(Enum):
@@ -33,6 +85,12 @@ class Bundle(Enum):
     SDK = 2,
 
 
+class ExtraFormat(Enum):
+    DELTA = 1,
+    INDEXED = 2,
+    LAYERS = 3,
+
+
 @dataclass
 class PackageSpec:
     name: str
@@ -56,31 +114,279 @@ class DependencyParameters:
         return self.packages[name.replace("-", "_")]
 
 
+@dataclass
+class DepsModel:
+    mtime: int
+    size: int
+    digest: str
+    raw_params: Dict[str, str]
+    packages: Dict[str, PackageSpec]
+    references: Dict[str, List[str]]
+
+
+class VariableResolver:
+    def __init__(self, raw_params: Dict[str, str]):
+        self.raw_params = raw_params
+        self.values: Dict[str, str] = {}
+        self.references: Dict[str, Set[str]] = {}
+        self.pending: Dict[str, None] = {}
+
+    def resolve(self, name: str) -> str:
+        value = self.values.get(name, None)
+        if value is not None:
+            return value
+
+        if name in self.pending:
+            chain = list(self.pending.keys())
+            cycle = chain[chain.index(name):] + [name]
+            raise ValueError("recursive variable reference: " + " -> ".join(cycle))
+
+        self.pending[name] = None
+        try:
+            references = set()
+            value = self.expand(self.raw_params.get(name, ""), references)
+        finally:
+            del self.pending[name]
+
+        self.values[name] = value
+        self.references[name] = references
+        return value
+
+    def expand(self, v: str, references: Optional[Set[str]] = None) -> str:
+        pieces = v.split(CONFIG_VARIABLE_REF_START)
+        if len(pieces) == 1:
+            return v
+
+        result = [pieces[0]]
+        for piece in pieces[1:]:
+            end = piece.find(CONFIG_VARIABLE_REF_END)
+            name = piece[:end]
+            if end != -1 and is_variable_name(name):
+                result.append(self.resolve(name))
+                result.append(piece[end + len(CONFIG_VARIABLE_REF_END):])
+                if references is not None:
+                    references.add(name)
+                    references.update(self.references[name])
+            else:
+                result.append(CONFIG_VARIABLE_REF_START)
+                result.append(piece)
+        return "".join(result)
+
+
+class DependencyGraph:
+    def __init__(self, edges: Dict[str, List[str]]):
+        self.edges: Dict[str, List[str]] = {}
+        self.reverse_edges: Dict[str, List[str]] = {}
+        for name in edges.keys():
+            self.edges[name] = []
+            self.reverse_edges[name] = []
+        for name, deps in edges.items():
+            for dep in deps:
+                if dep not in self.edges:
+                    raise KeyError("{} depends on unknown package {}".format(name, dep))
+                if dep not in self.edges[name]:
+                    self.edges[name].append(dep)
+                    self.reverse_edges[dep].append(name)
+
+    @staticmethod
+    def from_parameters(params: DependencyParameters,
+                        roots: Optional[List[str]] = None,
+                        include_deps_for_build: bool = True) -> DependencyGraph:
+        if roots is None:
+            roots = [identifier_to_package_name(identifier) for identifier in params.packages.keys()]
+
+        edges = {}
+        pending = list(roots)
+        while pending:
+            name = pending.pop(0)
+            if name in edges:
+                continue
+            spec = params.get_package_spec(name)
+            deps = spec.deps + spec.deps_for_build if include_deps_for_build else spec.deps
+            edges[name] = deps
+            pending += deps
+
+        ordered_edges = {name: edges[name] for name in roots}
+        ordered_edges.update(edges)
+        return DependencyGraph(ordered_edges)
+
+    @property
+    def nodes(self) -> List[str]:
+        return list(self.edges.keys())
+
+    def dependencies(self, name: str, transitive: bool = False) -> List[str]:
+        return self._walk(name, self.edges, transitive)
+
+    def reverse_dependencies(self, name: str, transitive: bool = False) -> List[str]:
+        return self._walk(name, self.reverse_edges, transitive)
+
+    def subgraph(self, names: List[str]) -> DependencyGraph:
+        selected = set(names)
+        return DependencyGraph({name: [dep for dep in deps if dep in selected]
+                                for name, deps in self.edges.items() if name in selected})
+
+    def find_cycle(self) -> Optional[List[str]]:
+        state = {}
+        for root in self.edges.keys():
+            if root in state:
+                continue
+            path = [root]
+            iterators = [iter(self.edges[root])]
+            state[root] = 'visiting'
+            while iterators:
+                dep = next(iterators[-1], None)
+                if dep is None:
+                    state[path.pop()] = 'done'
+                    iterators.pop()
+                elif state.get(dep) == 'visiting':
+                    return path[path.index(dep):] + [dep]
+                elif dep not in state:
+                    state[dep] = 'visiting'
+                    path.append(dep)
+                    iterators.append(iter(self.edges[dep]))
+        return None
+
+    def topological_order(self) -> List[str]:
+        return [name for generation in self.generations() for name in generation]
+
+    def generations(self) -> List[List[str]]:
+        position = {name: i for i, name in enumerate(self.edges.keys())}
+        remaining = {name: len(deps) for name, deps in self.edges.items()}
+
+        result = []
+        ready = [name for name, count in remaining.items() if count == 0]
+        while ready:
+            result.append(ready)
+            next_ready = []
+            for name in ready:
+                for dependent in self.reverse_edges[name]:
+                    remaining[dependent] -= 1
+                    if remaining[dependent] == 0:
+                        next_ready.append(dependent)
+            ready = sorted(next_ready, key=position.get)
+
+        if sum([len(generation) for generation in result]) != len(self.edges):
+            raise DependencyCycleError(self.find_cycle())
+
+        return result
+
+    def critical_path(self, costs: Optional[Dict[str, float]] = None) -> Tuple[float, List[str]]:
+        totals = {}
+        predecessors = {}
+        for name in self.topological_order():
+            cost = costs.get(name, 0.0) if costs is not None else 1.0
+            best = max(self.edges[name], key=lambda dep: totals[dep], default=None)
+            totals[name] = cost + (totals[best] if best is not None else 0.0)
+            predecessors[name] = best
+
+        if len(totals) == 0:
+            return (0.0, [])
+
+        name = max(totals.keys(), key=lambda n: totals[n])
+        length = totals[name]
+        path = []
+        while name is not None:
+            path.append(name)
+            name = predecessors[name]
+        path.reverse()
+
+        return (length, path)
+
+    def _walk(self, name: str, edges: Dict[str, List[str]], transitive: bool) -> List[str]:
+        if not transitive:
+            return list(edges[name])
+
+        result = []
+        seen = set([name])
+        pending = list(edges[name])
+        while pending:
+            current = pending.pop(0)
+            if current in seen:
+                continue
+            seen.add(current)
+            result.append(current)
+            pending += edges[current]
+        return result
+
+
+class DependencyCycleError(Exception):
+    def __init__(self, cycle: List[str]):
+        super().__init__("dependency cycle: " + " -> ".join(cycle))
+        self.cycle = cycle
+
+
+cached_deps_model = None
+
+
 def main():
     parser = argparse.ArgumentParser()
     subparsers = parser.add_subparsers()
 
     bundle_choices = [name.lower() for name in Bundle.__members__]
+    extra_formats_help = "also use these formats besides the installer: " \
+            + ", ".join([name.lower() for name in ExtraFormat.__members__]) + " (comma-separated)"
 
     command = subparsers.add_parser("sync", help="ensure prebuilt dependencies are up-to-date")
     command.add_argument("bundle", help="bundle to synchronize", choices=bundle_choices)
     command.add_argument("os_arch", help="OS/arch")
     command.add_argument("location", help="filesystem location")
-    command.set_defaults(func=lambda args: sync(Bundle[args.bundle.upper()], args.os_arch, Path(args.location)))
+    command.add_argument("--connections", help="number of parallel connections to download with",
+                         type=int, default=DEFAULT_DOWNLOAD_CONNECTIONS)
+    command.add_argument("--packages", help="only fetch these packages and their dependencies (comma-separated)",
+                         type=parse_list_argument)
+    command.add_argument("--variants", help="only fetch these variants, e.g. x64-Release (comma-separated)",
+                         type=parse_list_argument)
+    command.add_argument("--prefixes", help="only extract paths starting with these, e.g. x64-Release/include/ (comma-separated)",
+                         type=parse_list_argument)
+    command.add_argument("--extra-formats", help=extra_formats_help, type=parse_extra_formats, default=set())
+    command.set_defaults(func=lambda args: sync(Bundle[args.bundle.upper()], args.os_arch, Path(args.location),
+                                                args.connections, args.packages, args.variants, args.prefixes,
+                                                args.extra_formats))
 
     command = subparsers.add_parser("roll", help="build and upload prebuilt dependencies if needed")
     command.add_argument("bundle", help="bundle to roll", choices=bundle_choices)
     command.add_argument("os_arch", help="OS/arch")
     command.add_argument("--activate", default=False, action='store_true')
-    command.set_defaults(func=lambda args: roll(Bundle[args.bundle.upper()], args.os_arch, args.activate))
+    command.add_argument("--extra-formats", help=extra_formats_help, type=parse_extra_formats, default=set())
+    command.set_defaults(func=lambda args: roll(Bundle[args.bundle.upper()], args.os_arch, args.activate,
+                                                args.extra_formats))
 
     command = subparsers.add_parser("wait", help="wait for prebuilt dependencies if needed")
     command.add_argument("bundle", help="bundle to wait for", choices=bundle_choices)
     command.add_argument("os_arch", help="OS/arch")
-    command.set_defaults(func=lambda args: wait(Bundle[args.bundle.upper()], args.os_arch))
+    command.add_argument("more", help="additional bundle and OS/arch pairs to wait for", nargs='*')
+    command.add_argument("--timeout", help="give up after this many seconds", type=float)
+    command.set_defaults(func=lambda args: wait(parse_bundle_pairs([args.bundle, args.os_arch] + args.more),
+                                                args.timeout))
+
+    command = subparsers.add_parser("status", help="show which prebuilt dependencies are available")
+    command.add_argument("--bundles", help="bundles to check (comma-separated)", type=parse_list_argument,
+                         default=list(BUNDLE_TARGETS.keys()))
+    command.add_argument("--os-arches", help="OS/arch targets to check instead of the defaults (comma-separated)",
+                         type=parse_list_argument)
+    command.add_argument("--format", help="output format", choices=["tsv", "json"], default="tsv")
+    command.set_defaults(func=lambda args: status([Bundle[name.upper()] for name in args.bundles], args.os_arches,
+                                                  args.format))
 
     command = subparsers.add_parser("bump", help="bump dependency versions")
-    command.set_defaults(func=lambda args: bump())
+    command.add_argument("--api-url", help="GitHub API base URL",
+                         default=os.environ.get("FRIDA_GITHUB_API_URL", DEFAULT_GITHUB_API_URL))
+    command.add_argument("--commit-per-package", help="make one commit per bumped package",
+                         default=False, action='store_true')
+    command.set_defaults(func=lambda args: bump(args.api_url, args.commit_per_package))
+
+    command = subparsers.add_parser("benchmark", help="compare bundle formats on a prefix tree")
+    command.add_argument("tree", help="prefix tree to compress, e.g. an unpacked SDK")
+    command.add_argument("--formats", help="formats to compare (comma-separated)", type=parse_list_argument,
+                         default=list(load_bundle_formats().keys()))
+    command.add_argument("--threads", help="number of threads each format may use",
+                         type=int, default=os.cpu_count() or 1)
+    command.add_argument("--format", help="output format", choices=["tsv", "json"], default="tsv")
+    command.set_defaults(func=lambda args: benchmark(Path(args.tree), args.formats, args.threads, args.format))
+
+    command = subparsers.add_parser("graph", help="show dependency build order")
+    command.add_argument("packages", help="packages to include along with their dependencies", nargs='*')
+    command.set_defaults(func=lambda args: graph(args.packages if args.packages else None))
 
     args = parser.parse_args()
     if 'func' in args:
@@ -90,53 +396,281 @@ def main():
         sys.exit(1)
 
 
-def sync(bundle: Bundle, os_arch: str, location: Path):
+def parse_bundle_pairs(values: List[str]) -> List[Tuple[Bundle, str]]:
+    if len(values) % 2 != 0:
+        raise ValueError("expected bundle and OS/arch pairs, got: " + " ".join(values))
+    return [(Bundle[values[i].upper()], values[i + 1]) for i in range(0, len(values), 2)]
+
+
+def parse_list_argument(v: str) -> List[str]:
+    return [item.strip() for item in v.split(",") if item.strip() != ""]
+
+
+def parse_extra_formats(v: str) -> Set[ExtraFormat]:
+    return set([ExtraFormat[name.upper()] for name in parse_list_argument(v)])
+
+
+def sync(bundle: Bundle, os_arch: str, location: Path, connections: int = DEFAULT_DOWNLOAD_CONNECTIONS,
+         packages: Optional[List[str]] = None, variants: Optional[List[str]] = None,
+         prefixes: Optional[List[str]] = None, extra_formats: Set[ExtraFormat] = set()):
+    if (packages is not None or variants is not None) and ExtraFormat.LAYERS not in extra_formats:
+        raise ValueError("--packages and --variants need the layers format")
+    if prefixes is not None and ExtraFormat.INDEXED not in extra_formats:
+        raise ValueError("--prefixes needs the indexed format")
+    if prefixes is not None and bundle == Bundle.SDK and ExtraFormat.LAYERS in extra_formats:
+        # Layers are whole packages, so they cannot honour a path filter.
+        raise ValueError("--prefixes cannot be combined with SDK layers; use --packages and --variants instead")
+
     params = read_dependency_parameters()
     version = params.deps_version
 
     bundle_nick = bundle.name.lower() if bundle != Bundle.SDK else bundle.name
 
+    (url, filename, suffix) = compute_bundle_parameters(bundle, os_arch, version)
+    (manifest_url, manifest_filename) = compute_bundle_manifest_parameters(bundle, os_arch, version)
+    (index_url, index_filename) = compute_bundle_index_parameters(bundle, os_arch, version)
+    (archive_url, archive_filename) = compute_bundle_archive_parameters(bundle, os_arch, version)
+
+    local_bundle = location.parent / filename
+
+    if bundle == Bundle.SDK and ExtraFormat.LAYERS in extra_formats and not local_bundle.exists():
+        selector = LayerSelector(params, packages, variants)
+        if sync_layers(bundle_nick, location, version, index_url, selector, connections):
+            return
+
     if location.exists():
         try:
             cached_version = (location / "VERSION.txt").read_text(encoding='utf-8').strip()
-            if cached_version == version:
+            if cached_version == version and subset_covers(location, prefixes) and not (location / LAYERS_NAME).exists():
                 return
         except:
             pass
+        if ExtraFormat.DELTA in extra_formats and not local_bundle.exists() \
+                and sync_delta(bundle_nick, location, manifest_url):
+            return
         shutil.rmtree(location)
 
-    (url, filename, suffix) = compute_bundle_parameters(bundle, os_arch, version)
+    if ExtraFormat.INDEXED in extra_formats and not local_bundle.exists() \
+            and sync_indexed(bundle_nick, location, archive_url, prefixes, connections):
+        return
 
-    local_bundle = location.parent / filename
     if local_bundle.exists():
         print("Deploying local {}...".format(bundle_nick), flush=True)
         archive_path = local_bundle
         archive_is_temporary = False
     else:
         print("Downloading {}...".format(bundle_nick), flush=True)
-        with urllib.request.urlopen(url) as response, tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as archive:
-            shutil.copyfileobj(response, archive)
-            archive_path = Path(archive.name)
-            archive_is_temporary = True
+        archive_path = location.parent / ("download-" + filename)
+        archive_is_temporary = True
+        stats = download_file(url, archive_path, connections, DownloadProgress(bundle_nick).report)
+        print("Downloaded {} in {:.1f}s ({}/s)".format(format_size(stats.transferred), stats.elapsed,
+                                                       format_size(stats.throughput)),
+              flush=True)
         print("Extracting {}...".format(bundle_nick), flush=True)
 
     try:
-        # XXX: This is Windows-only for now, as we use setup-env.sh to do the heavy lifting on other platforms.
-        subprocess.run([
-            archive_path,
-            "-o" + str(location.parent),
-            "-y"
-        ], check=True)
+        bundle_format = load_bundle_formats()[BUNDLE_SUFFIX_FORMATS[suffix]]
+        bundle_format.unpack(archive_path, location.parent, os.cpu_count() or 1)
     finally:
         if archive_is_temporary:
             archive_path.unlink()
 
 
-def roll(bundle: Bundle, os_arch: str, activate: bool):
+def sync_delta(bundle_nick: str, location: Path, manifest_url: str) -> bool:
+    try:
+        old_manifest = read_manifest(location)
+    except:
+        return False
+
+    try:
+        with urllib.request.urlopen(manifest_url) as response:
+            new_manifest = parse_manifest(response.read())
+    except urllib.request.HTTPError as e:
+        if e.code in (403, 404):
+            return False
+        raise
+
+    changed, removed = compute_delta(old_manifest, new_manifest)
+    print("Updating {} from {} to {} ({} changed, {} removed)...".format(bundle_nick, old_manifest.version,
+                                                                         new_manifest.version, len(changed), len(removed)),
+          flush=True)
+    try:
+        apply_delta(location, old_manifest, new_manifest, fetch_bundle_object)
+    except Exception as e:
+        print("Unable to update {} incrementally ({}), falling back to a full download".format(bundle_nick, e), flush=True)
+        return False
+
+    return True
+
+
+def fetch_bundle_object(sha256: str):
+    return urllib.request.urlopen(BUNDLE_OBJECT_URL.format(path=compute_object_path(sha256)))
+
+
+def sync_indexed(bundle_nick: str, location: Path, archive_url: str, prefixes: Optional[List[str]],
+                 connections: int) -> bool:
+    try:
+        source = HttpArchiveSource(archive_url)
+    except urllib.request.HTTPError as e:
+        if e.code in (403, 404):
+            return False
+        raise
+    except UnsupportedSourceError:
+        return False
+
+    if prefixes is not None:
+        print("Extracting {} from {}...".format(", ".join(prefixes), bundle_nick), flush=True)
+    else:
+        print("Extracting {}...".format(bundle_nick), flush=True)
+
+    started_at = time.time()
+    incoming = location.parent / (".{}-incoming".format(location.name))
+    if incoming.exists():
+        shutil.rmtree(incoming)
+    try:
+        files = extract_indexed_archive(source, incoming, prefixes + [VERSION_NAME] if prefixes is not None else None,
+                                        connections)
+        if prefixes is not None:
+            (incoming / MANIFEST_NAME).unlink(missing_ok=True)
+            (incoming / SUBSET_NAME).write_text(json.dumps(prefixes), encoding='utf-8')
+        if location.exists():
+            shutil.rmtree(location)
+        os.rename(incoming, location)
+    except UnsupportedSourceError:
+        shutil.rmtree(incoming, ignore_errors=True)
+        return False
+    except ContentChangedError as e:
+        shutil.rmtree(incoming, ignore_errors=True)
+        print("Unable to extract {} ({}), falling back to a full download".format(bundle_nick, e), flush=True)
+        return False
+    except:
+        shutil.rmtree(incoming, ignore_errors=True)
+        raise
+
+    print("Extracted {} files in {:.1f}s".format(len(files), time.time() - started_at), flush=True)
+
+    return True
+
+
+def subset_covers(location: Path, prefixes: Optional[List[str]]) -> bool:
+    try:
+        installed = json.loads((location / SUBSET_NAME).read_text(encoding='utf-8'))
+    except FileNotFoundError:
+        return True
+    if prefixes is None:
+        return False
+    return all([any([prefix.startswith(candidate) for candidate in installed]) for prefix in prefixes])
+
+
+class LayerSelector:
+    def __init__(self, params: DependencyParameters, packages: Optional[List[str]], variants: Optional[List[str]]):
+        if packages is not None:
+            self.packages = set(DependencyGraph.from_parameters(params, packages, include_deps_for_build=False).nodes)
+        else:
+            self.packages = None
+        self.variants = set(variants) if variants is not None else None
+
+    def __call__(self, layer: Layer) -> bool:
+        if self.variants is not None and layer.variant not in self.variants:
+            return False
+        if self.packages is not None and layer.package is not None and layer.package not in self.packages:
+            return False
+        return True
+
+
+def sync_layers(bundle_nick: str, location: Path, version: str, index_url: str, selector: LayerSelector,
+                connections: int) -> bool:
+    state_path = location / LAYERS_NAME
+    try:
+        cached_version = (location / VERSION_NAME).read_text(encoding='utf-8').strip()
+    except:
+        cached_version = None
+    if cached_version == version and not state_path.exists() and subset_covers(location, None):
+        return True
+
+    try:
+        state = json.loads(state_path.read_text(encoding='utf-8'))
+        index = parse_layer_index(state["index"].encode('utf-8'))
+        installed = state["installed"]
+    except:
+        index = None
+        installed = {}
+
+    if index is None or index.version != version:
+        try:
+            with urllib.request.urlopen(index_url) as response:
+                index = parse_layer_index(response.read())
+        except urllib.request.HTTPError as e:
+            if e.code in (403, 404):
+                return False
+            raise
+
+    wanted = [layer for layer in index.layers if selector(layer)]
+    wanted_ids = set([layer.id for layer in wanted])
+
+    if cached_version == version and wanted_ids.issubset(installed.keys()):
+        return True
+    if location.exists() and not state_path.exists():
+        shutil.rmtree(location)
+
+    location.mkdir(parents=True, exist_ok=True)
+    (location / VERSION_NAME).unlink(missing_ok=True)
+    (location / MANIFEST_NAME).unlink(missing_ok=True)
+
+    for layer_id in [layer_id for layer_id in installed.keys() if layer_id not in wanted_ids]:
+        remove_files(location, installed.pop(layer_id))
+
+    missing = [layer for layer in wanted if layer.id not in installed]
+    cache = DownloadCache(LAYER_CACHE_DIR, LAYER_CACHE_MAX_SIZE)
+    cached = [layer for layer in missing if cache.entry_path(layer.id).exists()]
+    print("Fetching {} of {} {} layers ({} cached, {} to download)...".format(
+              len(missing), len(index.layers), bundle_nick, len(cached),
+              format_size(sum([layer.size for layer in missing if layer not in cached]))),
+          flush=True)
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, connections)) as executor:
+            futures = [(layer, executor.submit(install_layer, layer, location, cache)) for layer in missing]
+            failures = []
+            for layer, future in futures:
+                try:
+                    installed[layer.id] = future.result()
+                except Exception as e:
+                    failures.append(e)
+            if failures:
+                raise failures[0]
+    finally:
+        state = {
+            "index": serialize_layer_index(index).decode('utf-8'),
+            "installed": installed,
+        }
+        state_path.write_text(json.dumps(state), encoding='utf-8')
+
+    (location / VERSION_NAME).write_text(version + "\n", encoding='utf-8')
+
+    return True
+
+
+def install_layer(layer: Layer, location: Path, cache: DownloadCache) -> List[str]:
+    path = cache.lookup(layer.id)
+    if path is None:
+        with urllib.request.urlopen(BUNDLE_LAYER_URL.format(path=compute_layer_path(layer.id))) as response, \
+                cache.store(layer.id) as f:
+            shutil.copyfileobj(response, f)
+        path = cache.entry_path(layer.id)
+
+    with path.open("rb") as f:
+        return extract_layer(f, location)
+
+
+def roll(bundle: Bundle, os_arch: str, activate: bool, extra_formats: Set[ExtraFormat] = set()):
     params = read_dependency_parameters()
     version = params.deps_version
 
     (public_url, filename, suffix) = compute_bundle_parameters(bundle, os_arch, version)
+    (public_manifest_url, manifest_filename) = compute_bundle_manifest_parameters(bundle, os_arch, version)
+    (public_index_url, index_filename) = compute_bundle_index_parameters(bundle, os_arch, version)
+    (public_archive_url, archive_filename) = compute_bundle_archive_parameters(bundle, os_arch, version)
 
     # First do a quick check to avoid hitting S3 in most cases.
     request = urllib.request.Request(public_url)
@@ -148,47 +682,77 @@ def roll(bundle: Bundle, os_arch: str, activate: bool):
         if e.code != 404:
             return
 
-    if platform.system() == 'Windows':
-        s3cmd = [
-            "py", "-3",
-            Path(sys.executable).parent / "Scripts" / "s3cmd"
-        ]
-    else:
-        s3cmd = ["s3cmd"]
-
-    s3_url = "s3://build.frida.re/deps/{version}/{filename}".format(version=version, filename=filename)
+    backend = create_upload_backend()
+    key = "deps/{version}/{filename}".format(version=version, filename=filename)
 
     # We will most likely need to build, but let's check S3 to be certain.
-    if "404" not in subprocess.run(s3cmd + ["info", s3_url], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, encoding='utf-8').stdout:
+    if backend.exists(key):
         return
 
     artifact = BUILD_DIR / filename
     if artifact.exists():
         artifact.unlink()
+    manifest = BUILD_DIR / manifest_filename
+    manifest.unlink(missing_ok=True)
+    index = BUILD_DIR / index_filename
+    index.unlink(missing_ok=True)
+    indexed_archive = BUILD_DIR / archive_filename
+    indexed_archive.unlink(missing_ok=True)
 
     if os_arch.startswith("windows-"):
-        subprocess.run([
-                           "py", "-3", RELENG_DIR / "build-deps-windows.py",
-                           "--bundle=" + bundle.name.lower(),
-                       ],
-                       check=True)
+        build_command = [
+            "py", "-3", RELENG_DIR / "build-deps-windows.py",
+            "--bundle=" + bundle.name.lower(),
+            "--extra-formats=" + ",".join(sorted([f.name.lower() for f in extra_formats])),
+        ]
     else:
         if platform.system().endswith("BSD"):
             gnu_make = "gmake"
         else:
             gnu_make = "make"
-        subprocess.run([
-                           gnu_make,
-                           "-C", ROOT_DIR,
-                           "-f", "Makefile.{}.mk".format(bundle.name.lower()),
-                           "FRIDA_HOST=" + os_arch,
-                       ],
-                       check=True)
+        build_command = [
+            gnu_make,
+            "-C", ROOT_DIR,
+            "-f", "Makefile.{}.mk".format(bundle.name.lower()),
+            "FRIDA_HOST=" + os_arch,
+        ]
+
+    # Upload the artifact while it is being written, re-sending any parts that change before the build exits.
+    build_process = subprocess.Popen(build_command)
+    poll_build = lambda: None if build_process.poll() is None else build_process.returncode == 0
+    try:
+        stats = upload_file(backend, artifact, key, poll_build)
+    except Exception as e:
+        build_process.wait()
+        if build_process.returncode != 0:
+            raise subprocess.CalledProcessError(build_process.returncode, build_command)
+        print("Streaming upload failed ({}), retrying as a single upload".format(e), flush=True)
+        backend.put_file(artifact, key)
+    else:
+        print("Uploaded {} ({} parts, {} re-sent), {:.1f}s after the build finished".format(
+                  format_size(stats.size), stats.parts, stats.reuploaded_parts, stats.trailing),
+              flush=True)
+
+    # Objects go first so that a published manifest never refers to missing objects.
+    if manifest.exists():
+        backend.sync_directory(BUILD_DIR / "deps-objects", "deps/objects/")
+        backend.put_file(manifest, "deps/{version}/{filename}".format(version=version, filename=manifest_filename))
 
-    subprocess.run(s3cmd + ["put", artifact, s3_url], check=True)
+    if indexed_archive.exists():
+        backend.put_file(indexed_archive, "deps/{version}/{filename}".format(version=version, filename=archive_filename))
+
+    if index.exists():
+        backend.sync_directory(BUILD_DIR / "deps-layers", "deps/layers/")
+        backend.put_file(index, "deps/{version}/{filename}".format(version=version, filename=index_filename))
 
     # Use the shell for Windows compatibility, where npm generates a .bat script.
     subprocess.run("cfcli purge " + public_url, shell=True, check=True)
+    if manifest.exists():
+        subprocess.run("cfcli purge " + public_manifest_url, shell=True, check=True)
+    if index.exists():
+        subprocess.run("cfcli purge " + public_index_url, shell=True, check=True)
+    if indexed_archive.exists():
+        subprocess.run("cfcli purge " + public_archive_url, shell=True, check=True)
 
     if activate:
         deps_content = DEPS_MK_PATH.read_text(encoding='utf-8')
@@ -197,33 +761,113 @@ def roll(bundle: Bundle, os_arch: str, activate: bool):
         DEPS_MK_PATH.write_bytes(deps_content.encode('utf-8'))
 
 
-def wait(bundle: Bundle, os_arch: str):
+def wait(targets: List[Tuple[Bundle, str]], timeout: Optional[float] = None):
     params = read_dependency_parameters()
-    (url, filename, suffix) = compute_bundle_parameters(bundle, os_arch, params.deps_version)
+    urls = [compute_bundle_parameters(bundle, os_arch, params.deps_version)[0] for bundle, os_arch in targets]
 
-    request = urllib.request.Request(url)
-    request.get_method = lambda: "HEAD"
     started_at = time.time()
+    deadline = started_at + timeout if timeout is not None else None
+    with ThreadPoolExecutor(max_workers=len(urls)) as executor:
+        for future in [executor.submit(wait_for_url, url, started_at, deadline) for url in urls]:
+            future.result()
+
+    if len(urls) > 1:
+        print("All {} bundles available after {}s".format(len(urls), int(time.time() - started_at)), flush=True)
+
+
+def wait_for_url(url: str, started_at: float, deadline: Optional[float]):
+    interval = WAIT_MIN_INTERVAL
+    validator = None
     while True:
+        request = urllib.request.Request(url, method="HEAD")
+        retry_after = None
         try:
             with urllib.request.urlopen(request) as r:
+                if time.time() - started_at >= 1:
+                    print("Available: {}  Elapsed: {}".format(url, int(time.time() - started_at)), flush=True)
                 return
         except urllib.request.HTTPError as e:
-            if e.code != 404:
+            if e.code == 404:
+                current_validator = e.headers.get("ETag", None) or e.headers.get("Last-Modified", None)
+                if validator is not None and current_validator != validator:
+                    interval = WAIT_MIN_INTERVAL
+                validator = current_validator
+            elif e.code in (429, 503):
+                retry_after = e.headers.get("Retry-After", None)
+            else:
                 return
-        print("Waiting for: {}  Elapsed: {}  Retrying in 5 minutes...".format(url, int(time.time() - started_at)), flush=True)
-        time.sleep(5 * 60)
+        except (urllib.request.URLError, OSError) as e:
+            print("Waiting for: {}  Error: {}".format(url, e), flush=True)
 
+        delay = interval * random.uniform(1 - WAIT_JITTER, 1 + WAIT_JITTER)
+        if retry_after is not None and retry_after.isdigit():
+            delay = max(delay, float(retry_after))
+        if deadline is not None:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise TimeoutError("timed out waiting for " + url)
+            delay = min(delay, remaining)
 
-def bump():
+        print("Waiting for: {}  Elapsed: {}  Retrying in {}s...".format(url, int(time.time() - started_at), int(delay)),
+              flush=True)
+        time.sleep(delay)
+        interval = min(interval * WAIT_BACKOFF_FACTOR, WAIT_MAX_INTERVAL)
+
+
+def status(bundles: List[Bundle], os_arches: Optional[List[str]], output_format: str):
+    params = read_dependency_parameters()
+    version = params.deps_version
+
+    targets = []
+    for bundle in bundles:
+        for os_arch in (os_arches if os_arches is not None else BUNDLE_TARGETS[bundle.name.lower()]):
+            targets.append((bundle, os_arch))
+
+    urls = [compute_bundle_parameters(bundle, os_arch, version)[0] for bundle, os_arch in targets]
+    rows = []
+    for (bundle, os_arch), result in zip(targets, probe_urls(urls, STATUS_CONNECTIONS)):
+        if result.status == 200:
+            state = "available"
+        elif result.status == 404:
+            state = "missing"
+        else:
+            state = "error"
+        rows.append({
+            "bundle": bundle.name.lower(),
+            "os_arch": os_arch,
+            "version": version,
+            "state": state,
+            "status": result.status,
+            "size": result.size,
+            "validator": result.validator,
+            "error": result.error,
+            "url": result.url,
+        })
+
+    if output_format == "json":
+        json.dump(rows, sys.stdout, indent=2)
+        print("")
+    else:
+        columns = ["bundle", "os_arch", "version", "state", "status", "size", "url"]
+        print("\t".join(columns))
+        for row in rows:
+            print("\t".join([str(row[column]) if row[column] is not None else "-" for column in columns]))
+
+
+@dataclass
+class BumpCandidate:
+    identifier: str
+    pkg: PackageSpec
+    repo_name: str
+    branch_name: str
+
+
+def bump(api_url: str = DEFAULT_GITHUB_API_URL, commit_per_package: bool = False):
     params = read_dependency_parameters()
 
-    auth_blob = base64.b64encode(":".join([
-                                              os.environ["GH_USERNAME"],
-                                              os.environ["GH_TOKEN"]
-                                          ]).encode('utf-8')).decode('utf-8')
-    auth_header = "Basic " + auth_blob
+    headers = compute_github_headers(os.environ)
 
+    candidates = []
     for identifier, pkg in params.packages.items():
         if pkg.hash != "":
             continue
@@ -232,34 +876,152 @@ def bump():
         if not url.startswith("https://github.com/frida/"):
             continue
 
-        print(f"*** Checking {pkg.name}")
-
         repo_name = url.split("/")[-1][:-4]
         branch_name = "next" if repo_name == "capstone" else "main"
+        candidates.append(BumpCandidate(identifier, pkg, repo_name, branch_name))
 
-        url = f"https://api.github.com/repos/frida/{repo_name}/commits/main"
-        request = urllib.request.Request(url)
-        request.add_header("Authorization", auth_header)
-        with urllib.request.urlopen(request) as r:
-            response = json.load(r)
+    pool = ConnectionPool()
+    with ThreadPoolExecutor(max_workers=BUMP_CONNECTIONS) as executor:
+        latest_versions = list(executor.map(lambda c: query_latest_commit(pool, api_url, c, headers), candidates))
 
-        latest = response['sha']
+    outdated = []
+    for candidate, latest in zip(candidates, latest_versions):
+        pkg = candidate.pkg
+        print(f"*** Checking {pkg.name}")
         if pkg.version == latest:
             print(f"\tup-to-date")
         else:
             print(f"\toutdated")
             print(f"\t\tcurrent: {pkg.version}")
             print(f"\t\t latest: {latest}")
+            outdated.append((candidate, latest))
+        print("")
+
+    if not outdated:
+        return
 
-            deps_content = DEPS_MK_PATH.read_text(encoding='utf-8')
-            deps_content = re.sub(f"^{identifier}_version = (.+)$", f"{identifier}_version = {latest}",
-                                  deps_content, flags=re.MULTILINE)
+    deps_content = DEPS_MK_PATH.read_text(encoding='utf-8')
+    if commit_per_package:
+        for candidate, latest in outdated:
+            deps_content = apply_version_bumps(deps_content, {candidate.identifier: latest})
             DEPS_MK_PATH.write_bytes(deps_content.encode('utf-8'))
+            commit_deps_mk(f"deps: Bump {candidate.pkg.name} to {latest[:7]}")
+    else:
+        deps_content = apply_version_bumps(deps_content, {candidate.identifier: latest for candidate, latest in outdated})
+        DEPS_MK_PATH.write_bytes(deps_content.encode('utf-8'))
+        if len(outdated) == 1:
+            candidate, latest = outdated[0]
+            message = f"deps: Bump {candidate.pkg.name} to {latest[:7]}"
+        else:
+            message = "\n".join([f"deps: Bump {len(outdated)} packages", ""] +
+                                 [f"- {candidate.pkg.name} to {latest[:7]}" for candidate, latest in outdated])
+        commit_deps_mk(message)
+
+
+def compute_github_headers(env: Dict[str, str]) -> Dict[str, str]:
+    headers = {
+        "Accept": "application/vnd.github+json",
+        "User-Agent": "frida-deps",
+    }
+    token = env.get("GH_TOKEN", None)
+    if token is not None:
+        username = env.get("GH_USERNAME", None)
+        if username is not None:
+            auth_blob = base64.b64encode(":".join([username, token]).encode('utf-8')).decode('utf-8')
+            headers["Authorization"] = "Basic " + auth_blob
+        else:
+            headers["Authorization"] = "Bearer " + token
+    return headers
+
+
+def query_latest_commit(pool: ConnectionPool, api_url: str, candidate: BumpCandidate, headers: Dict[str, str]) -> str:
+    url = f"{api_url}/repos/frida/{candidate.repo_name}/commits/{candidate.branch_name}"
+    response, body = pool.request("GET", url, headers)
+    if response.status != 200:
+        raise ValueError(f"unable to query {url}: HTTP {response.status}")
+    return json.loads(body.decode('utf-8'))['sha']
+
+
+def apply_version_bumps(deps_content: str, versions: Dict[str, str]) -> str:
+    def replace(match):
+        identifier = match.group(1)
+        if identifier not in versions:
+            return match.group(0)
+        return f"{identifier}_version = {versions[identifier]}"
+
+    return re.sub(r"^(\w+)_version = (.+)$", replace, deps_content, flags=re.MULTILINE)
+
+
+def commit_deps_mk(message: str):
+    subprocess.run(["git", "add", "releng/deps.mk"], cwd=ROOT_DIR, check=True)
+    subprocess.run(["git", "commit", "-m", message], cwd=ROOT_DIR, check=True)
+
+
+def benchmark(tree: Path, format_names: List[str], threads: int, output_format: str):
+    formats = load_bundle_formats()
+    unknown = [name for name in format_names if name not in formats]
+    if unknown:
+        raise ValueError("unknown formats: " + ", ".join(unknown))
 
-            subprocess.run(["git", "add", "releng/deps.mk"], cwd=ROOT_DIR, check=True)
-            subprocess.run(["git", "commit", "-m" f"deps: Bump {pkg.name} to {latest[:7]}"], cwd=ROOT_DIR, check=True)
+    files = sorted([PurePosixPath(*path.relative_to(tree).parts).as_posix()
+                    for path in tree.rglob("*") if path.is_file() and not path.is_symlink()])
+    original_size = sum([(tree / relpath).stat().st_size for relpath in files])
+    print("Benchmarking {} files, {}".format(len(files), format_size(original_size)), file=sys.stderr, flush=True)
 
+    rows = []
+    BUILD_DIR.mkdir(parents=True, exist_ok=True)
+    for name in format_names:
+        bundle_format = formats[name]
+        if not bundle_format.available():
+            print("Skipping {}: not available".format(name), file=sys.stderr, flush=True)
+            continue
+
+        with tempfile.TemporaryDirectory(prefix="deps-benchmark-", dir=BUILD_DIR) as scratch:
+            archive_path = Path(scratch) / "bundle"
+            unpacked_dir = Path(scratch) / "unpacked"
+            unpacked_dir.mkdir()
+
+            started_at = time.time()
+            bundle_format.pack(tree, files, archive_path, threads)
+            compress_time = time.time() - started_at
+
+            started_at = time.time()
+            bundle_format.unpack(archive_path, unpacked_dir, threads)
+            decompress_time = time.time() - started_at
+
+            compressed_size = archive_path.stat().st_size
+            unpacked_count = len([path for path in unpacked_dir.rglob("*") if path.is_file()])
+            if unpacked_count != len(files):
+                raise ValueError("{} round-tripped {} of {} files".format(name, unpacked_count, len(files)))
+
+        rows.append({
+            "format": name,
+            "compress_time": round(compress_time, 3),
+            "decompress_time": round(decompress_time, 3),
+            "size": compressed_size,
+            "ratio": round(original_size / compressed_size, 3) if compressed_size != 0 else None,
+        })
+
+    if output_format == "json":
+        json.dump(rows, sys.stdout, indent=2)
         print("")
+    else:
+        columns = ["format", "compress_time", "decompress_time", "size", "ratio"]
+        print("\t".join(columns))
+        for row in rows:
+            print("\t".join([str(row[column]) if row[column] is not None else "-" for column in columns]))
+
+
+def graph(roots: Optional[List[str]]):
+    params = read_dependency_parameters()
+    deps_graph = DependencyGraph.from_parameters(params, roots)
+
+    for i, generation in enumerate(deps_graph.generations()):
+        print("{:>3}: {}".format(i + 1, " ".join(generation)))
+
+    length, path = deps_graph.critical_path()
+    print("")
+    print("Critical path ({} steps): {}".format(int(length), " -> ".join(path)))
 
 
 def compute_bundle_parameters(bundle: Bundle, os_arch: str, version: str) -> Tuple[str, str, str]:
@@ -269,32 +1031,40 @@ def compute_bundle_parameters(bundle: Bundle, os_arch: str, version: str) -> Tup
     return (url, filename, suffix)
 
 
+def compute_bundle_manifest_parameters(bundle: Bundle, os_arch: str, version: str) -> Tuple[str, str]:
+    filename = "{}-{}.files.json".format(bundle.name.lower(), os_arch)
+    url = BUNDLE_URL.format(version=version, filename=filename)
+    return (url, filename)
+
+
+def compute_bundle_archive_parameters(bundle: Bundle, os_arch: str, version: str) -> Tuple[str, str]:
+    filename = "{}-{}.bundle".format(bundle.name.lower(), os_arch)
+    url = BUNDLE_URL.format(version=version, filename=filename)
+    return (url, filename)
+
+
+def compute_bundle_index_parameters(bundle: Bundle, os_arch: str, version: str) -> Tuple[str, str]:
+    filename = "{}-{}.layers.json".format(bundle.name.lower(), os_arch)
+    url = BUNDLE_URL.format(version=version, filename=filename)
+    return (url, filename)
+
+
 def read_dependency_parameters(host_defines: Dict[str, str] = {}) -> DependencyParameters:
-    raw_params = host_defines.copy()
-    for match in CONFIG_KEY_VALUE_PATTERN.finditer(DEPS_MK_PATH.read_text(encoding='utf-8')):
-        key, value = match.group(1, 2)
-        value = value \
-                .replace("\\\n", " ") \
-                .replace("\t", " ") \
-                .replace("$(NULL)", "") \
-                .strip()
-        while "  " in value:
-            value = value.replace("  ", " ")
-        raw_params[key] = value
+    model = load_deps_model()
 
+    raw_params = model.raw_params
+    overlay = {k: v for k, v in host_defines.items() if k not in raw_params}
+    if overlay:
+        raw_params = {**overlay, **raw_params}
+
+    resolver = VariableResolver(raw_params)
     packages = {}
-    for key in [k for k in raw_params.keys() if k.endswith("_recipe")]:
-        name = key[:-7]
-        packages[name] = PackageSpec(
-                parse_string_value(raw_params[name + "_name"], raw_params),
-                parse_string_value(raw_params[name + "_version"], raw_params),
-                parse_string_value(raw_params[name + "_url"], raw_params),
-                parse_string_value(raw_params[name + "_hash"], raw_params),
-                parse_string_value(raw_params[name + "_recipe"], raw_params),
-                parse_array_value(raw_params[name + "_patches"], raw_params),
-                parse_array_value(raw_params[name + "_deps"], raw_params),
-                parse_array_value(raw_params[name + "_deps_for_build"], raw_params),
-                parse_array_value(raw_params[name + "_options"], raw_params))
+    for name, spec in model.packages.items():
+        if not overlay.keys().isdisjoint(model.references[name]):
+            spec = compile_package_spec(name, resolver)
+        else:
+            spec = copy_package_spec(spec)
+        packages[name] = spec
 
     return DependencyParameters(
             raw_params["frida_deps_version"],
@@ -302,12 +1072,146 @@ def read_dependency_parameters(host_defines: Dict[str, str] = {}) -> DependencyP
             packages)
 
 
-def parse_string_value(v: str, raw_params: Dict[str, str]) -> str:
-    return CONFIG_VARIABLE_REF_PATTERN.sub(lambda match: raw_params.get(match.group(1), ""), v)
+def load_deps_model() -> DepsModel:
+    global cached_deps_model
+
+    st = DEPS_MK_PATH.stat()
+
+    model = cached_deps_model
+    if model is None:
+        model = read_deps_model_cache()
+    if model is not None and (model.mtime, model.size) == (st.st_mtime_ns, st.st_size):
+        cached_deps_model = model
+        return model
+
+    with DEPS_MK_PATH.open("rb") as f:
+        st = os.fstat(f.fileno())
+        data = f.read()
+    digest = hashlib.sha256(data).hexdigest()
+
+    if model is not None and model.digest == digest:
+        model.mtime = st.st_mtime_ns
+        model.size = st.st_size
+    else:
+        model = compile_deps_model(data.decode('utf-8'), st.st_mtime_ns, st.st_size, digest)
+    write_deps_model_cache(model)
+
+    cached_deps_model = model
+    return model
+
+
+def compile_deps_model(deps_mk: str, mtime: int, size: int, digest: str) -> DepsModel:
+    raw_params = dict(tokenize_deps_mk(deps_mk))
+
+    resolver = VariableResolver(raw_params)
+    packages = {}
+    references = {}
+    for key in [k for k in raw_params.keys() if k.endswith("_recipe")]:
+        name = key[:-7]
+        refs = set()
+        packages[name] = compile_package_spec(name, resolver, refs)
+        references[name] = sorted(refs)
+
+    return DepsModel(mtime, size, digest, raw_params, packages, references)
+
+
+def copy_package_spec(spec: PackageSpec) -> PackageSpec:
+    # The model is shared by every caller, so hand out specs that are safe to modify.
+    return replace(spec,
+                   patches=list(spec.patches),
+                   deps=list(spec.deps),
+                   deps_for_build=list(spec.deps_for_build),
+                   options=list(spec.options))
+
+
+def compile_package_spec(name: str, resolver: VariableResolver, references: Optional[Set[str]] = None) -> PackageSpec:
+    raw_params = resolver.raw_params
+    return PackageSpec(
+            resolver.expand(raw_params[name + "_name"], references),
+            resolver.expand(raw_params[name + "_version"], references),
+            resolver.expand(raw_params[name + "_url"], references),
+            resolver.expand(raw_params[name + "_hash"], references),
+            resolver.expand(raw_params[name + "_recipe"], references),
+            parse_array_value(raw_params[name + "_patches"], resolver, references),
+            parse_array_value(raw_params[name + "_deps"], resolver, references),
+            parse_array_value(raw_params[name + "_deps_for_build"], resolver, references),
+            parse_array_value(raw_params[name + "_options"], resolver, references))
+
+
+def read_deps_model_cache() -> Optional[DepsModel]:
+    try:
+        blob = json.loads(DEPS_MODEL_PATH.read_text(encoding='utf-8'))
+        if blob["format"] != DEPS_MODEL_FORMAT:
+            return None
+        return DepsModel(
+                blob["mtime"],
+                blob["size"],
+                blob["digest"],
+                blob["raw_params"],
+                {name: PackageSpec(**spec) for name, spec in blob["packages"].items()},
+                blob["references"])
+    except:
+        return None
+
+
+def write_deps_model_cache(model: DepsModel):
+    blob = asdict(model)
+    blob["format"] = DEPS_MODEL_FORMAT
+    # Not a NamedTemporaryFile, as that would leave the cache readable only by its owner.
+    temp_path = DEPS_MODEL_PATH.parent / "{}.{}-{}.tmp".format(DEPS_MODEL_PATH.name, os.getpid(), threading.get_ident())
+    try:
+        DEPS_MODEL_PATH.parent.mkdir(parents=True, exist_ok=True)
+        with temp_path.open("w", encoding='utf-8') as f:
+            json.dump(blob, f)
+        os.replace(temp_path, DEPS_MODEL_PATH)
+    except OSError:
+        temp_path.unlink(missing_ok=True)
+
+
+def identifier_to_package_name(identifier: str) -> str:
+    return identifier.replace("_", "-")
+
+
+def tokenize_deps_mk(deps_mk: str) -> Iterator[Tuple[str, str]]:
+    key = None
+    words = []
+    for line in deps_mk.splitlines():
+        if key is None:
+            candidate, separator, line = line.partition(CONFIG_ASSIGNMENT_SEPARATOR)
+            if separator == "" or not is_assignable_variable_name(candidate):
+                continue
+            key = candidate
+
+        continued = line.endswith("\\")
+        if continued:
+            line = line[:-1]
+
+        for word in line.split():
+            if CONFIG_NULL_REF in word:
+                word = word.replace(CONFIG_NULL_REF, "")
+                if word == "":
+                    continue
+            words.append(word)
+
+        if not continued:
+            yield (key, " ".join(words))
+            key = None
+            words = []
+
+    if key is not None:
+        yield (key, " ".join(words))
+
+
+def is_assignable_variable_name(candidate: str) -> bool:
+    return len(candidate) >= 2 and "a" <= candidate[0] <= "z" and is_variable_name(candidate)
+
+
+def is_variable_name(candidate: str) -> bool:
+    return candidate != "" and candidate.replace("_", "a").isalnum()
 
 
-def parse_array_value(v: str, raw_params: Dict[str, str]) -> List[str]:
-    v = parse_string_value(v, raw_params)
+def parse_array_value(v: str, resolver: VariableResolver, references: Optional[Set[str]] = None) -> List[str]:
+    v = resolver.expand(v, references)
     if v == "":
         return []
     return v.split(" ")
@@ -0,0 +1,120 @@
+from dataclasses import dataclass
+from enum import Enum
+import hashlib
+from pathlib import Path, PurePath
+import shutil
+import subprocess
+import tempfile
+from typing import List, Optional
+
+
+class GitFetchMode(Enum):
+    FULL = 1,
+    SHALLOW = 2,
+    BLOBLESS = 3,
+
+
+@dataclass
+class GitOptions:
+    fetch_mode: GitFetchMode = GitFetchMode.FULL
+    cache_dir: Optional[Path] = None
+
+
+def clone_git_repository(repo_dir: Path, url: str, commit: str, options: GitOptions):
+    repo_dir.parent.mkdir(parents=True, exist_ok=True)
+    incoming_dir = Path(tempfile.mkdtemp(prefix="." + repo_dir.name + "-incoming-", dir=repo_dir.parent))
+    try:
+        run_git("init", "-q", cwd=incoming_dir)
+        run_git("remote", "add", "origin", url, cwd=incoming_dir)
+        checkout_git_revision(incoming_dir, url, commit, options)
+        incoming_dir.rename(repo_dir)
+    except:
+        shutil.rmtree(incoming_dir, ignore_errors=True)
+        raise
+
+
+def checkout_git_revision(repo_dir: Path, url: str, commit: str, options: GitOptions):
+    if options.cache_dir is not None:
+        mirror_dir = ensure_git_mirror(url, commit, options.cache_dir)
+        link_git_alternates(repo_dir, mirror_dir)
+        remote = str(mirror_dir)
+        flags = []
+    else:
+        remote = "origin"
+        flags = compute_git_fetch_flags(options.fetch_mode)
+
+    if not git_has_commit(repo_dir, commit):
+        fetch_git_commit(repo_dir, remote, commit, flags)
+
+    run_git("checkout", "-q", commit, cwd=repo_dir)
+    run_git("submodule", "update", "-q", "--init", "--recursive",
+            *[flag for flag in compute_git_fetch_flags(options.fetch_mode) if flag.startswith("--depth")],
+            cwd=repo_dir)
+
+
+def ensure_git_mirror(url: str, commit: str, cache_dir: Path) -> Path:
+    url_digest = hashlib.sha256(url.encode('utf-8')).hexdigest()[:12]
+    mirror_dir = cache_dir / "{}-{}.git".format(PurePath(url).stem, url_digest)
+
+    if not mirror_dir.exists():
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        staging_dir = Path(tempfile.mkdtemp(prefix=mirror_dir.name, dir=cache_dir))
+        run_git("init", "-q", "--bare", cwd=staging_dir)
+        run_git("remote", "add", "origin", url, cwd=staging_dir)
+        try:
+            staging_dir.rename(mirror_dir)
+        except OSError:
+            shutil.rmtree(staging_dir)
+
+    if not git_has_commit(mirror_dir, commit):
+        fetch_git_commit(mirror_dir, "origin", commit, [])
+        run_git("update-ref", "refs/pins/" + commit, commit, cwd=mirror_dir)
+
+    return mirror_dir
+
+
+def link_git_alternates(repo_dir: Path, mirror_dir: Path):
+    alternates_path = repo_dir / ".git" / "objects" / "info" / "alternates"
+    mirror_objects = str(mirror_dir / "objects")
+    try:
+        if mirror_objects in alternates_path.read_text(encoding='utf-8').split("\n"):
+            return
+    except FileNotFoundError:
+        pass
+    alternates_path.parent.mkdir(parents=True, exist_ok=True)
+    with alternates_path.open("a", encoding='utf-8') as f:
+        f.write(mirror_objects + "\n")
+
+
+def fetch_git_commit(repo_dir: Path, remote: str, commit: str, flags: List[str]):
+    try:
+        run_git("fetch", "-q", *flags, remote, commit, cwd=repo_dir)
+    except subprocess.CalledProcessError:
+        # Not all servers let us fetch an arbitrary commit, so fall back to its full history.
+        run_git("fetch", "-q", *[flag for flag in flags if not flag.startswith("--depth")], remote, cwd=repo_dir)
+
+
+def compute_git_fetch_flags(mode: GitFetchMode) -> List[str]:
+    if mode == GitFetchMode.SHALLOW:
+        return ["--depth=1"]
+    if mode == GitFetchMode.BLOBLESS:
+        return ["--filter=blob:none"]
+    return []
+
+
+def git_has_commit(repo_dir: Path, commit: str) -> bool:
+    return subprocess.run(["git", "cat-file", "-e", commit + "^{commit}"], cwd=repo_dir,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0
+
+
+def query_git_head(repo_dir: Path) -> Optional[str]:
+    result = subprocess.run(["git", "rev-parse", "HEAD"], cwd=repo_dir, stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL, encoding='utf-8')
+    if result.returncode != 0:
+        return None
+    return result.stdout.strip()
+
+
+def run_git(*args, cwd: Path):
+    print(">", " ".join(["git"] + [str(arg) for arg in args]), flush=True)
+    subprocess.run(["git", *args], cwd=cwd, check=True)
@@ -0,0 +1,167 @@
+from contextlib import contextmanager
+import ctypes
+import subprocess
+import sys
+import threading
+from typing import Iterator, Optional
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+MEMORY_SAMPLE_INTERVAL = 1.0
+
+
+class PeakMemorySampler:
+    def __init__(self, interval: float = MEMORY_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.peak: Optional[int] = None
+
+    @contextmanager
+    def watch(self, process: subprocess.Popen) -> Iterator[subprocess.Popen]:
+        with process:
+            if psutil is not None:
+                stop = threading.Event()
+                thread = threading.Thread(target=self._sample, args=(process.pid, stop), daemon=True)
+                thread.start()
+                try:
+                    yield process
+                finally:
+                    stop.set()
+                    thread.join()
+            elif sys.platform == "win32":
+                job = JobObject.adopt(process)
+                try:
+                    yield process
+                finally:
+                    if job is not None:
+                        self.peak = job.query_peak_memory()
+                        job.close()
+            else:
+                yield process
+
+    def _sample(self, pid: int, stop: threading.Event):
+        try:
+            root = psutil.Process(pid)
+        except psutil.Error:
+            return
+
+        while not stop.is_set():
+            try:
+                processes = [root] + root.children(recursive=True)
+            except psutil.Error:
+                return
+            total = 0
+            for process in processes:
+                try:
+                    total += process.memory_info().rss
+                except psutil.Error:
+                    pass
+            self.peak = max(self.peak or 0, total)
+            stop.wait(self.interval)
+
+
+class JobObject:
+    def __init__(self, handle: int):
+        self.handle = handle
+
+    @staticmethod
+    def adopt(process: subprocess.Popen) -> Optional["JobObject"]:
+        kernel32 = ctypes.WinDLL("kernel32", use_last_error=True)
+        kernel32.CreateJobObjectW.restype = ctypes.c_void_p
+        kernel32.OpenProcess.restype = ctypes.c_void_p
+
+        handle = kernel32.CreateJobObjectW(None, None)
+        if not handle:
+            return None
+        job = JobObject(handle)
+
+        # Children inherit the job, so this covers every compiler that ninja spawns.
+        process_handle = kernel32.OpenProcess(PROCESS_SET_QUOTA | PROCESS_TERMINATE, False, process.pid)
+        assigned = process_handle and kernel32.AssignProcessToJobObject(ctypes.c_void_p(handle),
+                                                                        ctypes.c_void_p(process_handle))
+        if process_handle:
+            kernel32.CloseHandle(ctypes.c_void_p(process_handle))
+        if not assigned:
+            job.close()
+            return None
+        return job
+
+    def query_peak_memory(self) -> Optional[int]:
+        info = JobObjectExtendedLimitInformation()
+        if not ctypes.windll.kernel32.QueryInformationJobObject(ctypes.c_void_p(self.handle),
+                                                               JOB_OBJECT_EXTENDED_LIMIT_INFORMATION_CLASS,
+                                                               ctypes.byref(info), ctypes.sizeof(info), None):
+            return None
+        return info.PeakJobMemoryUsed
+
+    def close(self):
+        ctypes.windll.kernel32.CloseHandle(ctypes.c_void_p(self.handle))
+
+
+PROCESS_TERMINATE = 0x0001
+PROCESS_SET_QUOTA = 0x0100
+JOB_OBJECT_EXTENDED_LIMIT_INFORMATION_CLASS = 9
+
+
+class IoCounters(ctypes.Structure):
+    _fields_ = [(name, ctypes.c_uint64) for name in [
+        "ReadOperationCount",
+        "WriteOperationCount",
+        "OtherOperationCount",
+        "ReadTransferCount",
+        "WriteTransferCount",
+        "OtherTransferCount",
+    ]]
+
+
+class JobObjectBasicLimitInformation(ctypes.Structure):
+    _fields_ = [
+        ("PerProcessUserTimeLimit", ctypes.c_int64),
+        ("PerJobUserTimeLimit", ctypes.c_int64),
+        ("LimitFlags", ctypes.c_uint32),
+        ("MinimumWorkingSetSize", ctypes.c_size_t),
+        ("MaximumWorkingSetSize", ctypes.c_size_t),
+        ("ActiveProcessLimit", ctypes.c_uint32),
+        ("Affinity", ctypes.c_size_t),
+        ("PriorityClass", ctypes.c_uint32),
+        ("SchedulingClass", ctypes.c_uint32),
+    ]
+
+
+class JobObjectExtendedLimitInformation(ctypes.Structure):
+    _fields_ = [
+        ("BasicLimitInformation", JobObjectBasicLimitInformation),
+        ("IoInfo", IoCounters),
+        ("ProcessMemoryLimit", ctypes.c_size_t),
+        ("JobMemoryLimit", ctypes.c_size_t),
+        ("PeakProcessMemoryUsed", ctypes.c_size_t),
+        ("PeakJobMemoryUsed", ctypes.c_size_t),
+    ]
+
+
+class MemoryStatusEx(ctypes.Structure):
+    _fields_ = [
+        ("dwLength", ctypes.c_uint32),
+        ("dwMemoryLoad", ctypes.c_uint32),
+        ("ullTotalPhys", ctypes.c_uint64),
+        ("ullAvailPhys", ctypes.c_uint64),
+        ("ullTotalPageFile", ctypes.c_uint64),
+        ("ullAvailPageFile", ctypes.c_uint64),
+        ("ullTotalVirtual", ctypes.c_uint64),
+        ("ullAvailVirtual", ctypes.c_uint64),
+        ("ullAvailExtendedVirtual", ctypes.c_uint64),
+    ]
+
+
+def query_physical_memory() -> Optional[int]:
+    if psutil is not None:
+        return psutil.virtual_memory().total
+    if sys.platform == "win32":
+        status = MemoryStatusEx()
+        status.dwLength = ctypes.sizeof(status)
+        if ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+            return status.ullTotalPhys
+    return None
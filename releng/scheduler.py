@@ -0,0 +1,153 @@
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+import heapq
+import os
+from typing import Any, Callable, Dict, List, Optional
+
+from deps import DependencyCycleError, DependencyGraph
+
+
+@dataclass
+class Job:
+    id: str
+    deps: List[str] = field(default_factory=list)
+    payload: Any = None
+
+
+JobRunner = Callable[[Job], None]
+JobPriority = Callable[[Job], float]
+JobAdmission = Callable[[Job, List[Job]], bool]
+
+
+class MemoryBudget:
+    def __init__(self, budget: int, demands: Dict[str, int]):
+        self.budget = budget
+        self.demands = demands
+
+    def __call__(self, job: Job, running: List[Job]) -> bool:
+        in_use = sum([self.demands.get(other.id, 0) for other in running])
+        return in_use + self.demands.get(job.id, 0) <= self.budget
+
+
+class CoreBudget:
+    def __init__(self, cores: int):
+        self.cores = cores
+        self.grants: Dict[str, int] = {}
+
+    def grant(self, job: Job, running: List[Job], ready: List[Job], free_slots: int) -> int:
+        in_use = sum([self.grants.get(other.id, 0) for other in running])
+        # Leave room for the ready jobs that could start alongside this one, but let a lone job use everything.
+        contenders = 1 + min(len(ready), max(0, free_slots - 1))
+        share = max(1, (self.cores - in_use) // contenders)
+        self.grants[job.id] = share
+        return share
+
+    def release(self, job: Job):
+        self.grants.pop(job.id, None)
+
+    def granted(self, job: Job) -> Optional[int]:
+        return self.grants.get(job.id, None)
+
+
+def run_jobs(jobs: List[Job], runner: JobRunner, max_workers: Optional[int] = None,
+             priority: Optional[JobPriority] = None, admission: Optional[JobAdmission] = None,
+             cores: Optional[CoreBudget] = None):
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+
+    jobs_by_id = {job.id: job for job in jobs}
+    job_graph = build_job_graph(jobs)
+
+    remaining = {job_id: len(job_graph.dependencies(job_id)) for job_id in job_graph.nodes}
+    ready = [jobs_by_id[job_id] for job_id, count in remaining.items() if count == 0]
+    running: Dict[Future, Job] = {}
+    failure = None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while ready or running:
+            while ready and len(running) < max_workers:
+                job = pop_next_job(ready, priority, admission, list(running.values()))
+                if job is None:
+                    break
+                if cores is not None:
+                    cores.grant(job, list(running.values()), ready, max_workers - len(running))
+                running[executor.submit(runner, job)] = job
+
+            done, _ = wait(running.keys(), return_when=FIRST_COMPLETED)
+            for future in done:
+                job = running.pop(future)
+                if cores is not None:
+                    cores.release(job)
+
+                error = future.exception()
+                if error is not None:
+                    if failure is None:
+                        failure = error
+                    continue
+
+                for dependent in job_graph.reverse_dependencies(job.id):
+                    remaining[dependent] -= 1
+                    if remaining[dependent] == 0:
+                        ready.append(jobs_by_id[dependent])
+
+            if failure is not None:
+                ready = []
+
+    if failure is not None:
+        raise failure
+
+
+def build_job_graph(jobs: List[Job]) -> DependencyGraph:
+    job_ids = set([job.id for job in jobs])
+    job_graph = DependencyGraph({job.id: [dep for dep in job.deps if dep in job_ids] for job in jobs})
+    cycle = job_graph.find_cycle()
+    if cycle is not None:
+        raise DependencyCycleError(cycle)
+    return job_graph
+
+
+def pop_next_job(ready: List[Job], priority: Optional[JobPriority], admission: Optional[JobAdmission] = None,
+                 running: Optional[List[Job]] = None) -> Optional[Job]:
+    candidates = ready
+    if admission is not None and running:
+        candidates = [job for job in ready if admission(job, running)]
+    if not candidates:
+        return None
+    job = max(candidates, key=priority) if priority is not None else candidates[0]
+    ready.remove(job)
+    return job
+
+
+def compute_job_ranks(jobs: List[Job], costs: Dict[str, float]) -> Dict[str, float]:
+    job_graph = build_job_graph(jobs)
+    ranks = {}
+    for job_id in reversed(job_graph.topological_order()):
+        ranks[job_id] = costs.get(job_id, 0.0) + max([ranks[dependent] for dependent in job_graph.reverse_dependencies(job_id)],
+                                                     default=0.0)
+    return ranks
+
+
+def estimate_makespan(jobs: List[Job], costs: Dict[str, float], max_workers: int,
+                      priority: Optional[JobPriority] = None, admission: Optional[JobAdmission] = None) -> float:
+    jobs_by_id = {job.id: job for job in jobs}
+    job_graph = build_job_graph(jobs)
+
+    remaining = {job_id: len(job_graph.dependencies(job_id)) for job_id in job_graph.nodes}
+    ready = [jobs_by_id[job_id] for job_id, count in remaining.items() if count == 0]
+    running = []
+    now = 0.0
+
+    while ready or running:
+        while ready and len(running) < max_workers:
+            job = pop_next_job(ready, priority, admission, [jobs_by_id[job_id] for _, job_id in running])
+            if job is None:
+                break
+            heapq.heappush(running, (now + costs.get(job.id, 0.0), job.id))
+
+        now, job_id = heapq.heappop(running)
+        for dependent in job_graph.reverse_dependencies(job_id):
+            remaining[dependent] -= 1
+            if remaining[dependent] == 0:
+                ready.append(jobs_by_id[dependent])
+
+    return now
@@ -0,0 +1,154 @@
+import os
+from pathlib import Path
+import tarfile
+import tempfile
+import unittest
+
+from bundle import VERSION_NAME, apply_delta, compute_layer_path, compute_object_path, extract_layer, package_layers, \
+        read_manifest, store_objects, write_manifest
+
+
+def read_tree(root: Path):
+    return {path.relative_to(root).as_posix(): path.read_bytes() for path in root.rglob("*") if path.is_file()}
+
+
+class DeltaTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        root = Path(self.tempdir.name)
+        self.objects_dir = root / "objects"
+        self.fetched = []
+        self.failing = set()
+
+        self.old_tree = root / "old"
+        self.old_manifest = self.make_tree(self.old_tree, "20260101", {
+            "x64/lib/glib-2.0.lib": b"glib 2.78",
+            "x64/lib/zlib.lib": b"zlib 1.3",
+            "x64/lib/libffi.lib": b"libffi 3.4",
+        })
+        self.new_tree = root / "new"
+        self.new_manifest = self.make_tree(self.new_tree, "20260202", {
+            "x64/lib/glib-2.0.lib": b"glib 2.80",
+            "x64/lib/zlib.lib": b"zlib 1.3",
+            "x64/include/pcre2.h": b"#define PCRE2",
+        })
+
+        self.location = root / "location"
+        self.make_tree(self.location, "20260101", {
+            "x64/lib/glib-2.0.lib": b"glib 2.78",
+            "x64/lib/zlib.lib": b"zlib 1.3",
+            "x64/lib/libffi.lib": b"libffi 3.4",
+        })
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def make_tree(self, root: Path, version: str, files: dict):
+        for relpath, data in files.items():
+            path = root / relpath
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(data)
+        (root / VERSION_NAME).write_text(version + "\n", encoding='utf-8')
+        manifest = write_manifest(root, version)
+        store_objects(root, manifest, self.objects_dir)
+        return manifest
+
+    def fetch_object(self, sha256: str):
+        if sha256 in self.failing:
+            raise OSError("connection reset")
+        self.fetched.append(sha256)
+        return (self.objects_dir / compute_object_path(sha256)).open("rb")
+
+    def test_only_changed_files_are_fetched(self):
+        apply_delta(self.location, self.old_manifest, self.new_manifest, self.fetch_object)
+
+        self.assertEqual(read_tree(self.location), read_tree(self.new_tree))
+        self.assertEqual(read_manifest(self.location), self.new_manifest)
+        self.assertEqual(sorted(self.fetched), sorted([self.new_manifest.files[path].sha256 for path in
+                                                       ["x64/lib/glib-2.0.lib", "x64/include/pcre2.h", VERSION_NAME]]))
+        self.assertFalse((self.location / "x64" / "lib" / "libffi.lib").exists())
+
+    def test_local_modifications_of_the_same_size_are_repaired(self):
+        (self.location / "x64" / "lib" / "zlib.lib").write_bytes(b"zlib 1.2")
+
+        apply_delta(self.location, self.old_manifest, self.new_manifest, self.fetch_object)
+
+        self.assertEqual((self.location / "x64" / "lib" / "zlib.lib").read_bytes(), b"zlib 1.3")
+
+    def test_interrupted_update_is_not_mistaken_for_a_complete_one(self):
+        self.failing.add(self.new_manifest.files[VERSION_NAME].sha256)
+
+        with self.assertRaises(OSError):
+            apply_delta(self.location, self.old_manifest, self.new_manifest, self.fetch_object)
+
+        self.assertEqual((self.location / VERSION_NAME).read_text(encoding='utf-8'), "20260101\n")
+        self.assertEqual(read_manifest(self.location), self.old_manifest)
+        self.assertEqual((self.location / "x64" / "lib" / "glib-2.0.lib").read_bytes(), b"glib 2.80")
+
+        self.failing.clear()
+        self.fetched.clear()
+        apply_delta(self.location, read_manifest(self.location), self.new_manifest, self.fetch_object)
+
+        self.assertEqual(read_tree(self.location), read_tree(self.new_tree))
+        self.assertEqual(self.fetched, [self.new_manifest.files[VERSION_NAME].sha256])
+        self.assertEqual(list(self.location.glob("**/*.tmp")), [])
+
+
+
+class LayerTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        root = Path(self.tempdir.name)
+
+        self.tree = root / "tree"
+        files = {
+            "x64-Release/manifest/glib.pkg": b"lib/glib-2.0.lib\nlib/gio-2.0.lib",
+            "x64-Release/lib/glib-2.0.lib": os.urandom(100000),
+            "x64-Release/lib/gio-2.0.lib": os.urandom(100000),
+            "x64-Release/manifest/zlib.pkg": b"lib/zlib.lib",
+            "x64-Release/lib/zlib.lib": b"zlib 1.3",
+            "x64-Release/share/README": b"unowned",
+        }
+        for relpath, data in files.items():
+            (self.tree / relpath).parent.mkdir(parents=True, exist_ok=True)
+            (self.tree / relpath).write_bytes(data)
+
+        self.layers_dir = root / "layers"
+        self.destination = root / "sdk"
+        self.destination.mkdir()
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_layers_reassemble_the_tree(self):
+        index = package_layers(self.tree, "20260101", self.layers_dir)
+
+        self.assertEqual([(layer.variant, layer.package) for layer in index.layers],
+                         [("x64-Release", "glib"), ("x64-Release", "zlib"), ("x64-Release", None)])
+        for layer in index.layers:
+            with (self.layers_dir / compute_layer_path(layer.id)).open("rb") as f:
+                extract_layer(f, self.destination)
+        self.assertEqual(read_tree(self.destination), read_tree(self.tree))
+
+    def test_unchanged_packages_keep_their_layer_ids(self):
+        old_index = package_layers(self.tree, "20260101", self.layers_dir)
+        (self.tree / "x64-Release" / "lib" / "zlib.lib").write_bytes(b"zlib 1.3.1")
+        new_index = package_layers(self.tree, "20260202", self.layers_dir)
+
+        self.assertEqual(old_index.layers[0].id, new_index.layers[0].id)
+        self.assertNotEqual(old_index.layers[1].id, new_index.layers[1].id)
+
+    def test_truncated_layer_is_rolled_back(self):
+        index = package_layers(self.tree, "20260101", self.layers_dir)
+        path = self.layers_dir / compute_layer_path(index.layers[0].id)
+        path.write_bytes(path.read_bytes()[:-50000])
+
+        with self.assertRaises(tarfile.ReadError):
+            with path.open("rb") as f:
+                extract_layer(f, self.destination)
+
+        self.assertEqual(list(self.destination.iterdir()), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,661 @@
+import contextlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import io
+import json
+import os
+from pathlib import Path
+import re
+import stat
+import sys
+import tempfile
+import threading
+import unittest
+from unittest import mock
+import urllib.request
+
+from archive import write_indexed_archive
+from bundle import package_layers, serialize_layer_index
+import deps
+from deps import DEPS_MK_PATH, BumpCandidate, DependencyCycleError, DependencyGraph, DependencyParameters, \
+        PackageSpec, VariableResolver, compute_github_headers, query_latest_commit, read_dependency_parameters, \
+        sync_indexed, sync_layers, tokenize_deps_mk, wait_for_url
+from transfer import ConnectionPool
+
+
+class GitHubRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.authorizations.append(self.headers.get("Authorization"))
+        if self.path == "/repos/frida/glib/commits/main":
+            body = json.dumps({"sha": "0123456789abcdef0123456789abcdef01234567"}).encode('utf-8')
+            self.send_response(200)
+        else:
+            body = b"{}"
+            self.send_response(404)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class BumpTest(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), GitHubRequestHandler)
+        self.server.authorizations = []
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.api_url = "http://127.0.0.1:{}".format(self.server.server_address[1])
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def candidate(self, repo_name: str) -> BumpCandidate:
+        spec = PackageSpec(repo_name, "", "https://github.com/frida/{}.git".format(repo_name), "", "meson",
+                           [], [], [], [])
+        return BumpCandidate(repo_name, spec, repo_name, "main")
+
+    def test_token_without_username_uses_bearer_auth(self):
+        headers = compute_github_headers({"GH_TOKEN": "secret"})
+
+        sha = query_latest_commit(ConnectionPool(), self.api_url, self.candidate("glib"), headers)
+
+        self.assertEqual(sha, "0123456789abcdef0123456789abcdef01234567")
+        self.assertEqual(self.server.authorizations, ["Bearer secret"])
+
+    def test_token_with_username_uses_basic_auth(self):
+        headers = compute_github_headers({"GH_USERNAME": "frida", "GH_TOKEN": "secret"})
+
+        query_latest_commit(ConnectionPool(), self.api_url, self.candidate("glib"), headers)
+
+        self.assertEqual(self.server.authorizations, ["Basic ZnJpZGE6c2VjcmV0"])
+
+    def test_anonymous_requests_are_unauthenticated(self):
+        query_latest_commit(ConnectionPool(), self.api_url, self.candidate("glib"), compute_github_headers({}))
+
+        self.assertEqual(self.server.authorizations, [None])
+
+    def test_unknown_repository_is_an_error(self):
+        with self.assertRaises(ValueError):
+            query_latest_commit(ConnectionPool(), self.api_url, self.candidate("nope"), compute_github_headers({}))
+
+
+SAMPLE_DEPS_MK = """frida_deps_version = 20260101
+frida_bootstrap_version = 20250101
+
+frida_base_url = https://github.com/frida
+
+zlib_name = zlib
+zlib_version = 1.3
+zlib_url = $(frida_base_url)/zlib.git
+zlib_hash = $(NULL)
+zlib_recipe = meson
+zlib_patches = \\
+\t$(NULL)
+zlib_options = \\
+\t$(NULL)
+zlib_deps = \\
+\t$(NULL)
+zlib_deps_for_build = \\
+\t$(NULL)
+
+glib_name = GLib
+glib_version = 2.80
+glib_url = $(frida_base_url)/glib.git
+glib_hash = $(NULL)
+glib_recipe = meson
+glib_patches = \\
+\t$(NULL)
+glib_options = \\
+\t-Dtarget=$(host_os) \\
+\t$(NULL)
+glib_deps = \\
+\tzlib \\
+\t$(NULL)
+glib_deps_for_build = \\
+\t$(NULL)
+"""
+
+
+class DepsModelTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        root = Path(self.tempdir.name)
+        self.deps_mk_path = root / "deps.mk"
+        self.model_path = root / "build" / "deps-mk-model.json"
+        self.deps_mk_path.write_text(SAMPLE_DEPS_MK, encoding='utf-8')
+        for patcher in [mock.patch.object(deps, "DEPS_MK_PATH", self.deps_mk_path),
+                        mock.patch.object(deps, "DEPS_MODEL_PATH", self.model_path),
+                        mock.patch.object(deps, "cached_deps_model", None)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(self.tempdir.cleanup)
+
+    def read(self, host_defines={}):
+        with mock.patch.object(deps, "compile_deps_model", wraps=deps.compile_deps_model) as compile_model:
+            params = read_dependency_parameters(host_defines)
+        return (params, compile_model.call_count)
+
+    def forget_in_memory_model(self):
+        deps.cached_deps_model = None
+
+    def test_model_is_compiled_once_and_cached_on_disk(self):
+        params, compiled = self.read()
+        self.assertEqual(compiled, 1)
+        self.assertEqual(params.deps_version, "20260101")
+        self.assertEqual(params.get_package_spec("glib").url, "https://github.com/frida/glib.git")
+        self.assertEqual(params.get_package_spec("glib").deps, ["zlib"])
+
+        self.forget_in_memory_model()
+        params, compiled = self.read()
+        self.assertEqual(compiled, 0)
+        self.assertEqual(params.get_package_spec("zlib").version, "1.3")
+
+    def test_cache_has_normal_permissions(self):
+        self.read()
+
+        reference = self.model_path.parent / "reference"
+        reference.write_text("", encoding='utf-8')
+        self.assertEqual(stat.S_IMODE(self.model_path.stat().st_mode), stat.S_IMODE(reference.stat().st_mode))
+        self.assertEqual([path.name for path in self.model_path.parent.iterdir() if path.name.endswith(".tmp")], [])
+
+    def test_touching_deps_mk_revalidates_by_digest(self):
+        self.read()
+        st = self.deps_mk_path.stat()
+        os.utime(self.deps_mk_path, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+
+        self.forget_in_memory_model()
+        _, compiled = self.read()
+
+        self.assertEqual(compiled, 0)
+        self.assertEqual(json.loads(self.model_path.read_text(encoding='utf-8'))["mtime"], st.st_mtime_ns + 10 ** 9)
+
+    def test_edits_of_the_same_size_are_detected(self):
+        self.read()
+        st = self.deps_mk_path.stat()
+        self.deps_mk_path.write_text(SAMPLE_DEPS_MK.replace("zlib_version = 1.3", "zlib_version = 1.4"), encoding='utf-8')
+        os.utime(self.deps_mk_path, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+
+        params, compiled = self.read()
+
+        self.assertEqual(compiled, 1)
+        self.assertEqual(params.get_package_spec("zlib").version, "1.4")
+
+    def test_edits_that_change_the_size_are_detected(self):
+        self.read()
+        st = self.deps_mk_path.stat()
+        self.deps_mk_path.write_text(SAMPLE_DEPS_MK.replace("zlib_version = 1.3", "zlib_version = 1.3.1"),
+                                     encoding='utf-8')
+        os.utime(self.deps_mk_path, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+        params, compiled = self.read()
+
+        self.assertEqual(compiled, 1)
+        self.assertEqual(params.get_package_spec("zlib").version, "1.3.1")
+
+    def test_corrupt_cache_is_recompiled(self):
+        self.read()
+        self.model_path.write_text("{", encoding='utf-8')
+
+        self.forget_in_memory_model()
+        _, compiled = self.read()
+
+        self.assertEqual(compiled, 1)
+
+    def test_host_defines_fill_in_undefined_variables_only(self):
+        params = read_dependency_parameters({"host_os": "windows", "frida_base_url": "https://example.com"})
+
+        self.assertEqual(params.get_package_spec("glib").options, ["-Dtarget=windows"])
+        self.assertEqual(params.get_package_spec("glib").url, "https://github.com/frida/glib.git")
+        self.assertEqual(read_dependency_parameters().get_package_spec("glib").options, ["-Dtarget="])
+
+    def test_callers_get_their_own_specs(self):
+        first = read_dependency_parameters()
+        first.get_package_spec("glib").options.append("-Dextra=true")
+        first.get_package_spec("glib").deps.clear()
+
+        second = read_dependency_parameters()
+
+        self.assertEqual(second.get_package_spec("glib").options, ["-Dtarget="])
+        self.assertEqual(second.get_package_spec("glib").deps, ["zlib"])
+
+
+class TokenizerTest(unittest.TestCase):
+    def test_continued_values_are_joined(self):
+        deps_mk = "\n".join([
+            "glib_options = \\",
+            "\t-Dselinux=disabled \\",
+            "\t-Dtests=false \\",
+            "\t$(NULL)",
+            "glib_deps = $(NULL)",
+            "glib_options += -Diconv=external",
+            "MAKE_J ?= -j 8",
+            "",
+        ])
+
+        self.assertEqual(list(tokenize_deps_mk(deps_mk)), [
+            ("glib_options", "-Dselinux=disabled -Dtests=false"),
+            ("glib_deps", ""),
+        ])
+
+    def test_crlf_line_endings_are_handled(self):
+        deps_mk = DEPS_MK_PATH.read_bytes().decode('utf-8').replace("\r\n", "\n")
+
+        lf = dict(tokenize_deps_mk(deps_mk))
+        crlf = dict(tokenize_deps_mk(deps_mk.replace("\n", "\r\n")))
+
+        self.assertEqual(crlf, lf)
+        self.assertTrue(crlf["glib_options"].startswith("-Dselinux=disabled -Dxattr=false"))
+
+    def test_unterminated_continuation_still_yields_the_value(self):
+        self.assertEqual(list(tokenize_deps_mk("zlib_options = -Da=b \\")), [("zlib_options", "-Da=b")])
+
+
+class VariableResolverTest(unittest.TestCase):
+    def test_references_are_expanded_transitively(self):
+        resolver = VariableResolver({
+            "frida_base_url": "https://github.com/$(org)",
+            "org": "$(org_prefix)frida",
+            "org_prefix": "",
+            "glib_url": "$(frida_base_url)/glib.git",
+        })
+
+        references = set()
+        self.assertEqual(resolver.expand("$(glib_url) and $(org)", references),
+                         "https://github.com/frida/glib.git and frida")
+        self.assertEqual(references, {"glib_url", "frida_base_url", "org", "org_prefix"})
+
+    def test_undefined_variables_expand_to_nothing(self):
+        self.assertEqual(VariableResolver({}).expand("-Dos=$(host_os)"), "-Dos=")
+
+    def test_non_variable_references_are_left_alone(self):
+        resolver = VariableResolver({"cc": "gcc"})
+
+        self.assertEqual(resolver.expand("$(shell echo $(cc)) $(unterminated"), "$(shell echo gcc) $(unterminated")
+
+    def test_recursive_references_are_reported(self):
+        resolver = VariableResolver({"a": "$(b)", "b": "x$(c)", "c": "$(a)"})
+
+        with self.assertRaises(ValueError) as context:
+            resolver.expand("$(a)")
+
+        self.assertIn("a -> b -> c -> a", str(context.exception))
+
+
+class DependencyGraphTest(unittest.TestCase):
+    def setUp(self):
+        self.graph = DependencyGraph({
+            "json-glib": ["glib"],
+            "glib": ["zlib", "libffi", "pcre2"],
+            "zlib": [],
+            "libffi": [],
+            "pcre2": [],
+            "libsoup": ["glib", "zlib"],
+        })
+
+    def test_generations_respect_dependencies_and_declaration_order(self):
+        self.assertEqual(self.graph.generations(), [
+            ["zlib", "libffi", "pcre2"],
+            ["glib"],
+            ["json-glib", "libsoup"],
+        ])
+        self.assertEqual(self.graph.topological_order(), ["zlib", "libffi", "pcre2", "glib", "json-glib", "libsoup"])
+
+    def test_dependencies_can_be_walked_transitively(self):
+        self.assertEqual(self.graph.dependencies("libsoup"), ["glib", "zlib"])
+        self.assertEqual(self.graph.dependencies("libsoup", transitive=True), ["glib", "zlib", "libffi", "pcre2"])
+        self.assertEqual(self.graph.reverse_dependencies("zlib", transitive=True), ["glib", "libsoup", "json-glib"])
+
+    def test_critical_path_follows_the_most_expensive_chain(self):
+        self.assertEqual(self.graph.critical_path(), (3.0, ["zlib", "glib", "json-glib"]))
+        self.assertEqual(self.graph.critical_path({"pcre2": 50.0, "glib": 100.0, "libsoup": 30.0, "json-glib": 10.0}),
+                         (180.0, ["pcre2", "glib", "libsoup"]))
+        self.assertEqual(DependencyGraph({}).critical_path(), (0.0, []))
+
+    def test_subgraph_drops_edges_to_excluded_nodes(self):
+        subgraph = self.graph.subgraph(["glib", "json-glib", "zlib"])
+
+        self.assertEqual(subgraph.nodes, ["json-glib", "glib", "zlib"])
+        self.assertEqual(subgraph.dependencies("glib"), ["zlib"])
+
+    def test_cycles_are_reported(self):
+        graph = DependencyGraph({"a": ["c"], "b": ["a"], "c": ["b"], "d": []})
+
+        self.assertEqual(graph.find_cycle(), ["a", "c", "b", "a"])
+        with self.assertRaises(DependencyCycleError) as context:
+            graph.topological_order()
+        self.assertEqual(context.exception.cycle, ["a", "c", "b", "a"])
+        self.assertIsNone(self.graph.find_cycle())
+
+    def test_unknown_dependencies_are_rejected(self):
+        with self.assertRaises(KeyError):
+            DependencyGraph({"glib": ["zlib"]})
+
+    def test_graph_is_derived_from_package_specs(self):
+        def spec(name: str, deps: list, deps_for_build: list = []) -> PackageSpec:
+            return PackageSpec(name, "1.0", "", "", "meson", [], deps, deps_for_build, [])
+
+        params = DependencyParameters("20260101", "20250101", {
+            "glib": spec("glib", ["zlib"], ["meson"]),
+            "zlib": spec("zlib", []),
+            "meson": spec("meson", []),
+            "json_glib": spec("json-glib", ["glib"]),
+        })
+
+        graph = DependencyGraph.from_parameters(params, ["json-glib"])
+        self.assertEqual(graph.topological_order(), ["zlib", "meson", "glib", "json-glib"])
+
+        runtime_graph = DependencyGraph.from_parameters(params, ["json-glib"], include_deps_for_build=False)
+        self.assertEqual(sorted(runtime_graph.nodes), ["glib", "json-glib", "zlib"])
+
+
+
+class ArchiveRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_HEAD(self):
+        self.reply(200, b"", len(self.server.blob))
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.reads += 1
+            if self.server.reads > self.server.reads_before_change:
+                self.server.etag = "\"v2\""
+        blob = self.server.blob
+        match = re.fullmatch(r"bytes=(\d+)-(\d+)", self.headers.get("Range", ""))
+        if match is None or self.headers.get("If-Range", self.server.etag) != self.server.etag:
+            self.reply(200, blob, len(blob))
+            return
+        start, end = int(match.group(1)), int(match.group(2))
+        self.reply(206, blob[start:end + 1], end + 1 - start,
+                   {"Content-Range": "bytes {}-{}/{}".format(start, end, len(blob))})
+
+    def reply(self, status: int, body: bytes, length: int, headers: dict = {}):
+        self.send_response(status)
+        self.send_header("Content-Length", str(length))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", self.server.etag)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class SyncIndexedTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        root = Path(self.tempdir.name)
+
+        tree = root / "tree"
+        files = {
+            "VERSION.txt": b"20260202\n",
+            "x64-Release/lib/glib-2.0.lib": b"glib 2.80",
+        }
+        for relpath, data in files.items():
+            (tree / relpath).parent.mkdir(parents=True, exist_ok=True)
+            (tree / relpath).write_bytes(data)
+        archive_path = root / "sdk.idx"
+        write_indexed_archive(tree, list(files.keys()), archive_path, codec="zlib")
+
+        self.location = root / "sdk-windows"
+        self.location.mkdir()
+        (self.location / "VERSION.txt").write_text("20260101\n", encoding='utf-8')
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), ArchiveRequestHandler)
+        self.server.lock = threading.Lock()
+        self.server.blob = archive_path.read_bytes()
+        self.server.etag = "\"v1\""
+        self.server.reads = 0
+        self.server.reads_before_change = 1000
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.url = "http://127.0.0.1:{}/sdk.idx".format(self.server.server_address[1])
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        self.tempdir.cleanup()
+
+    def test_archive_is_extracted_in_place(self):
+        self.assertTrue(sync_indexed("SDK", self.location, self.url, None, 2))
+
+        self.assertEqual((self.location / "VERSION.txt").read_text(encoding='utf-8'), "20260202\n")
+        self.assertEqual((self.location / "x64-Release" / "lib" / "glib-2.0.lib").read_bytes(), b"glib 2.80")
+
+    def test_archive_replaced_while_extracting_falls_back_to_a_full_download(self):
+        # The footer and the directory are read before the first chunk.
+        self.server.reads_before_change = 2
+
+        with mock.patch("builtins.print"):
+            self.assertFalse(sync_indexed("SDK", self.location, self.url, None, 2))
+
+        self.assertEqual(sorted([path.name for path in self.location.parent.iterdir()]), ["sdk-windows", "sdk.idx", "tree"])
+        self.assertEqual((self.location / "VERSION.txt").read_text(encoding='utf-8'), "20260101\n")
+
+
+
+class SyncLayersTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.root = Path(self.tempdir.name)
+        self.tree = self.root / "tree"
+        self.layers_dir = self.root / "layers"
+        files = {
+            "x64-Release/manifest/glib.pkg": b"lib/glib-2.0.lib",
+            "x64-Release/lib/glib-2.0.lib": b"glib 2.80",
+            "x64-Release/manifest/zlib.pkg": b"lib/zlib.lib",
+            "x64-Release/lib/zlib.lib": b"zlib 1.3",
+        }
+        for relpath, data in files.items():
+            (self.tree / relpath).parent.mkdir(parents=True, exist_ok=True)
+            (self.tree / relpath).write_bytes(data)
+        self.publish("20260101")
+
+        self.fetched = []
+        urlopen = urllib.request.urlopen
+
+        def record_urlopen(url, *args, **kwargs):
+            self.fetched.append(url)
+            return urlopen(url, *args, **kwargs)
+
+        patchers = [
+            mock.patch.object(deps, "BUNDLE_LAYER_URL", self.layers_dir.as_uri() + "/{path}"),
+            mock.patch.object(deps, "LAYER_CACHE_DIR", self.root / "cache"),
+            mock.patch.object(urllib.request, "urlopen", record_urlopen),
+            mock.patch("builtins.print"),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def publish(self, version: str):
+        index = package_layers(self.tree, version, self.layers_dir)
+        (self.layers_dir / (version + ".json")).write_bytes(serialize_layer_index(index))
+
+    def sync(self, location: Path, version: str, selector=lambda layer: True) -> bool:
+        self.fetched.clear()
+        return sync_layers("SDK", location, version, (self.layers_dir / (version + ".json")).as_uri(), selector, 2)
+
+    def fetched_layers(self):
+        return sorted([url for url in self.fetched if url.endswith(".tar.gz")])
+
+    def test_only_selected_packages_are_installed(self):
+        location = self.root / "sdk"
+
+        self.assertTrue(self.sync(location, "20260101", lambda layer: layer.package == "zlib"))
+
+        self.assertTrue((location / "x64-Release" / "lib" / "zlib.lib").exists())
+        self.assertFalse((location / "x64-Release" / "lib" / "glib-2.0.lib").exists())
+        self.assertEqual((location / "VERSION.txt").read_text(encoding='utf-8'), "20260101\n")
+        self.assertEqual(len(self.fetched_layers()), 1)
+
+    def test_unchanged_layers_are_kept_across_versions(self):
+        location = self.root / "sdk"
+        self.sync(location, "20260101")
+        (self.tree / "x64-Release" / "lib" / "zlib.lib").write_bytes(b"zlib 1.3.1")
+        self.publish("20260202")
+
+        self.assertTrue(self.sync(location, "20260202"))
+
+        self.assertEqual((location / "x64-Release" / "lib" / "zlib.lib").read_bytes(), b"zlib 1.3.1")
+        self.assertEqual((location / "x64-Release" / "lib" / "glib-2.0.lib").read_bytes(), b"glib 2.80")
+        [fetched] = self.fetched_layers()
+        index = json.loads((self.layers_dir / "20260202.json").read_text(encoding='utf-8'))
+        self.assertTrue(fetched.endswith(index["layers"][1][0] + ".tar.gz"))
+
+    def test_cached_layers_are_not_downloaded_again(self):
+        self.sync(self.root / "first", "20260101")
+        self.assertEqual(len(self.fetched_layers()), 2)
+
+        self.assertTrue(self.sync(self.root / "second", "20260101"))
+
+        self.assertEqual(self.fetched_layers(), [])
+        self.assertEqual((self.root / "second" / "x64-Release" / "lib" / "glib-2.0.lib").read_bytes(), b"glib 2.80")
+
+
+
+class PollingRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_HEAD(self):
+        status, headers = self.server.responses.pop(0) if self.server.responses else (404, {"ETag": "\"missing\""})
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class WaitTest(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), PollingRequestHandler)
+        self.server.responses = []
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.url = "http://127.0.0.1:{}/deps/sdk-windows-x86_64.exe".format(self.server.server_address[1])
+
+        self.now = 1000.0
+        self.delays = []
+
+        def sleep(delay: float):
+            self.delays.append(delay)
+            self.now += delay
+
+        patchers = [
+            mock.patch.object(deps.time, "time", lambda: self.now),
+            mock.patch.object(deps.time, "sleep", sleep),
+            mock.patch.object(deps.random, "uniform", lambda a, b: 1.0),
+            mock.patch("builtins.print"),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def missing(self, validator: str = "\"missing\""):
+        return (404, {"ETag": validator})
+
+    def test_interval_backs_off_until_the_bundle_appears(self):
+        self.server.responses = [self.missing()] * 4 + [(200, {})]
+
+        wait_for_url(self.url, self.now, None)
+
+        self.assertEqual(self.delays, [10, 15, 22.5, 33.75])
+
+    def test_interval_is_capped(self):
+        self.server.responses = [self.missing()] * 12 + [(200, {})]
+
+        wait_for_url(self.url, self.now, None)
+
+        self.assertEqual(self.delays[-3:], [deps.WAIT_MAX_INTERVAL] * 3)
+
+    def test_interval_resets_when_the_missing_object_changes(self):
+        self.server.responses = [self.missing(), self.missing(), self.missing("\"uploading\""), (200, {})]
+
+        wait_for_url(self.url, self.now, None)
+
+        self.assertEqual(self.delays, [10, 15, 10])
+
+    def test_retry_after_is_honoured(self):
+        self.server.responses = [(503, {"Retry-After": "60"}), (429, {"Retry-After": "5"}), (200, {})]
+
+        wait_for_url(self.url, self.now, None)
+
+        self.assertEqual(self.delays, [60, 15])
+
+    def test_deadline_cuts_the_last_delay_short(self):
+        with self.assertRaises(TimeoutError):
+            wait_for_url(self.url, self.now, self.now + 30)
+
+        self.assertEqual(self.delays, [10, 15, 5])
+
+
+
+class BenchmarkTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        root = Path(self.tempdir.name)
+        self.tree = root / "sdk"
+        for i in range(3):
+            path = self.tree / "x64-Release" / "include" / "header{}.h".format(i)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text("#define VALUE {}\n".format(i) * 1000, encoding='utf-8')
+        self.build_dir = root / "build"
+
+        patcher = mock.patch.object(deps, "BUILD_DIR", self.build_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def run_benchmark(self, *args) -> str:
+        stdout = io.StringIO()
+        with mock.patch.object(sys, "argv", ["deps.py", "benchmark", str(self.tree), *args]),                 contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(io.StringIO()):
+            deps.main()
+        return stdout.getvalue()
+
+    def test_each_format_is_round_tripped_and_measured(self):
+        rows = json.loads(self.run_benchmark("--formats", "indexed-zlib,indexed-bz2", "--threads", "2",
+                                             "--format", "json"))
+
+        self.assertEqual([row["format"] for row in rows], ["indexed-zlib", "indexed-bz2"])
+        for row in rows:
+            self.assertGreater(row["ratio"], 1)
+            self.assertGreater(row["size"], 0)
+            self.assertGreaterEqual(row["compress_time"], 0)
+            self.assertGreaterEqual(row["decompress_time"], 0)
+        self.assertEqual(list(self.build_dir.iterdir()), [])
+
+    def test_tsv_output_has_one_row_per_format(self):
+        lines = self.run_benchmark("--formats", "indexed-zlib").strip().split("\n")
+
+        self.assertEqual(lines[0].split("\t"), ["format", "compress_time", "decompress_time", "size", "ratio"])
+        self.assertEqual([line.split("\t")[0] for line in lines[1:]], ["indexed-zlib"])
+
+    def test_unknown_formats_are_rejected(self):
+        with self.assertRaises(ValueError):
+            self.run_benchmark("--formats", "indexed-zlib,rar")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+from pathlib import Path
+import subprocess
+import tempfile
+import unittest
+
+from gitsource import GitFetchMode, GitOptions, clone_git_repository, query_git_head
+
+
+def git(*args, cwd: Path) -> str:
+    return subprocess.run(["git", *args], cwd=cwd, check=True, stdout=subprocess.PIPE,
+                          stderr=subprocess.DEVNULL, encoding='utf-8').stdout.strip()
+
+
+class CloneGitRepositoryTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.root = Path(self.tempdir.name)
+
+        work_dir = self.root / "work"
+        work_dir.mkdir()
+        git("init", "-q", cwd=work_dir)
+        git("config", "user.name", "Test", cwd=work_dir)
+        git("config", "user.email", "test@example.com", cwd=work_dir)
+        self.commits = []
+        for i in range(3):
+            (work_dir / "file.txt").write_text("revision {}\n".format(i), encoding='utf-8')
+            git("add", "file.txt", cwd=work_dir)
+            git("commit", "-q", "-m", "Revision {}".format(i), cwd=work_dir)
+            self.commits.append(git("rev-parse", "HEAD", cwd=work_dir))
+
+        upstream_dir = self.root / "upstream.git"
+        upstream_dir.mkdir()
+        git("init", "-q", "--bare", cwd=upstream_dir)
+        git("config", "uploadpack.allowFilter", "true", cwd=upstream_dir)
+        git("config", "uploadpack.allowAnySHA1InWant", "true", cwd=upstream_dir)
+        git("push", "-q", str(upstream_dir), "HEAD:refs/heads/main", cwd=work_dir)
+        self.url = upstream_dir.as_uri()
+
+        self.deps_dir = self.root / "deps"
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_each_fetch_mode_checks_out_the_pinned_commit(self):
+        pinned = self.commits[1]
+        for mode in GitFetchMode:
+            with self.subTest(mode=mode):
+                repo_dir = self.deps_dir / mode.name.lower()
+
+                clone_git_repository(repo_dir, self.url, pinned, GitOptions(mode))
+
+                self.assertEqual(query_git_head(repo_dir), pinned)
+                self.assertEqual((repo_dir / "file.txt").read_text(encoding='utf-8'), "revision 1\n")
+                shallow = git("rev-parse", "--is-shallow-repository", cwd=repo_dir)
+                self.assertEqual(shallow, "true" if mode == GitFetchMode.SHALLOW else "false")
+                promisor = subprocess.run(["git", "config", "remote.origin.promisor"], cwd=repo_dir,
+                                          stdout=subprocess.PIPE, encoding='utf-8').stdout.strip()
+                self.assertEqual(promisor, "true" if mode == GitFetchMode.BLOBLESS else "")
+
+    def test_mirror_is_shared_through_alternates(self):
+        cache_dir = self.root / "cache"
+        options = GitOptions(cache_dir=cache_dir)
+
+        clone_git_repository(self.deps_dir / "first", self.url, self.commits[0], options)
+        clone_git_repository(self.deps_dir / "second", self.url, self.commits[2], options)
+
+        mirrors = list(cache_dir.glob("*.git"))
+        self.assertEqual(len(mirrors), 1)
+        mirror_dir = mirrors[0]
+        for commit in (self.commits[0], self.commits[2]):
+            self.assertEqual(git("rev-parse", "refs/pins/" + commit, cwd=mirror_dir), commit)
+        for name, commit in [("first", self.commits[0]), ("second", self.commits[2])]:
+            repo_dir = self.deps_dir / name
+            self.assertEqual(query_git_head(repo_dir), commit)
+            alternates = (repo_dir / ".git" / "objects" / "info" / "alternates").read_text(encoding='utf-8')
+            self.assertEqual(alternates.split(), [str(mirror_dir / "objects")])
+            self.assertEqual(git("count-objects", "-v", cwd=repo_dir).split("\n")[0], "count: 0")
+            self.assertEqual(list((repo_dir / ".git" / "objects" / "pack").glob("*.pack")), [])
+
+    def test_failed_fetch_leaves_nothing_behind(self):
+        repo_dir = self.deps_dir / "broken"
+
+        with self.assertRaises(subprocess.CalledProcessError):
+            clone_git_repository(repo_dir, self.url, "0" * 40, GitOptions())
+
+        self.assertFalse(repo_dir.exists())
+        self.assertEqual(list(self.deps_dir.iterdir()), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,175 @@
+import threading
+import time
+import unittest
+
+from deps import DependencyCycleError
+from scheduler import CoreBudget, Job, MemoryBudget, run_jobs
+
+
+class FakeRunner:
+    def __init__(self, duration: float = 0.01, failing: set = set()):
+        self.duration = duration
+        self.failing = failing
+        self.started = []
+        self.finished = []
+        self.active = 0
+        self.max_active = 0
+        self.running = []
+        self.concurrent = []
+        self.lock = threading.Lock()
+
+    def __call__(self, job: Job):
+        with self.lock:
+            self.started.append(job.id)
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+            self.running.append(job.id)
+            self.concurrent.append(list(self.running))
+        try:
+            time.sleep(self.duration)
+            if job.id in self.failing:
+                raise RuntimeError("{} failed".format(job.id))
+        finally:
+            with self.lock:
+                self.active -= 1
+                self.running.remove(job.id)
+                self.finished.append(job.id)
+
+
+class RunJobsTest(unittest.TestCase):
+    def test_dependencies_finish_before_dependents_start(self):
+        jobs = [
+            Job("glib", ["zlib", "libffi"]),
+            Job("zlib"),
+            Job("libffi"),
+            Job("json-glib", ["glib"]),
+            Job("libsoup", ["glib", "zlib"]),
+        ]
+        runner = FakeRunner()
+
+        run_jobs(jobs, runner, max_workers=4)
+
+        self.assertEqual(sorted(runner.finished), sorted([job.id for job in jobs]))
+        for job in jobs:
+            for dep in job.deps:
+                self.assertLess(runner.finished.index(dep), runner.started.index(job.id))
+
+    def test_concurrency_is_capped(self):
+        jobs = [Job("job{}".format(i)) for i in range(12)]
+        runner = FakeRunner(duration=0.02)
+
+        run_jobs(jobs, runner, max_workers=3)
+
+        self.assertEqual(runner.max_active, 3)
+        self.assertEqual(len(runner.finished), 12)
+
+    def test_independent_jobs_run_concurrently(self):
+        jobs = [Job("a"), Job("b"), Job("c", ["a", "b"])]
+        runner = FakeRunner(duration=0.05)
+
+        run_jobs(jobs, runner, max_workers=2)
+
+        self.assertEqual(runner.max_active, 2)
+        self.assertEqual(runner.started[-1], "c")
+
+    def test_failure_propagates_and_skips_dependents(self):
+        jobs = [Job("zlib"), Job("glib", ["zlib"]), Job("json-glib", ["glib"]), Job("capstone")]
+        runner = FakeRunner(failing={"zlib"})
+
+        with self.assertRaises(RuntimeError) as context:
+            run_jobs(jobs, runner, max_workers=1)
+
+        self.assertEqual(str(context.exception), "zlib failed")
+        self.assertNotIn("glib", runner.started)
+        self.assertNotIn("json-glib", runner.started)
+
+    def test_running_jobs_complete_after_a_failure(self):
+        jobs = [Job("fast"), Job("slow"), Job("after-slow", ["slow"])]
+        runner = FakeRunner(failing={"fast"})
+
+        def run(job: Job):
+            if job.id == "slow":
+                time.sleep(0.05)
+            runner(job)
+
+        with self.assertRaises(RuntimeError):
+            run_jobs(jobs, run, max_workers=2)
+
+        self.assertIn("slow", runner.finished)
+        self.assertNotIn("after-slow", runner.started)
+
+    def test_cycle_is_detected_before_running_anything(self):
+        jobs = [Job("a", ["c"]), Job("b", ["a"]), Job("c", ["b"]), Job("d")]
+        runner = FakeRunner()
+
+        with self.assertRaises(DependencyCycleError):
+            run_jobs(jobs, runner, max_workers=2)
+
+        self.assertEqual(runner.started, [])
+
+    def test_dependencies_outside_the_job_set_are_ignored(self):
+        jobs = [Job("glib", ["zlib"])]
+        runner = FakeRunner()
+
+        run_jobs(jobs, runner, max_workers=1)
+
+        self.assertEqual(runner.finished, ["glib"])
+
+
+class MemoryBudgetTest(unittest.TestCase):
+    def test_concurrent_demand_stays_within_budget(self):
+        demands = {"job{}".format(i): (i % 4 + 1) * 1024 for i in range(12)}
+        jobs = [Job(job_id) for job_id in demands.keys()]
+        runner = FakeRunner(duration=0.02)
+
+        run_jobs(jobs, runner, max_workers=6, admission=MemoryBudget(5 * 1024, demands))
+
+        self.assertEqual(sorted(runner.finished), sorted(demands.keys()))
+        for job_ids in runner.concurrent:
+            self.assertLessEqual(sum([demands[job_id] for job_id in job_ids]), 5 * 1024)
+        self.assertGreater(runner.max_active, 1)
+
+    def test_oversize_job_still_runs_on_its_own(self):
+        demands = {"v8": 12 * 1024, "zlib": 1024, "glib": 1024, "capstone": 1024}
+        jobs = [Job("zlib"), Job("v8"), Job("glib"), Job("capstone")]
+        runner = FakeRunner(duration=0.02)
+
+        run_jobs(jobs, runner, max_workers=4, priority=lambda job: demands[job.id],
+                 admission=MemoryBudget(8 * 1024, demands))
+
+        self.assertEqual(sorted(runner.finished), sorted(demands.keys()))
+        for job_ids in runner.concurrent:
+            if "v8" in job_ids:
+                self.assertEqual(job_ids, ["v8"])
+
+
+class CoreBudgetTest(unittest.TestCase):
+    def test_lone_job_gets_every_core(self):
+        jobs = [Job("glib"), Job("v8", ["glib"])]
+        cores = CoreBudget(16)
+        grants = {}
+
+        run_jobs(jobs, lambda job: grants.setdefault(job.id, cores.granted(job)), max_workers=16, cores=cores)
+
+        self.assertEqual(grants, {"glib": 16, "v8": 16})
+
+    def test_cores_are_split_between_concurrent_jobs(self):
+        jobs = [Job("job{}".format(i)) for i in range(8)]
+        cores = CoreBudget(16)
+        runner = FakeRunner(duration=0.02)
+        grants = {}
+
+        def run(job: Job):
+            grants[job.id] = cores.granted(job)
+            runner(job)
+
+        run_jobs(jobs, run, max_workers=4, cores=cores)
+
+        self.assertEqual([grants["job{}".format(i)] for i in range(4)], [4, 4, 4, 4])
+        for job_ids in runner.concurrent:
+            self.assertLessEqual(sum([grants[job_id] for job_id in job_ids]), 16)
+        self.assertEqual(cores.grants, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+from pathlib import Path
+import tempfile
+import unittest
+
+from timing import TIMING_HISTORY_VERSIONS, TimingHistory
+
+
+class TimingHistoryTest(unittest.TestCase):
+    def test_known_version_averages_its_samples(self):
+        history = TimingHistory()
+        history.record("glib", "2.80", "x64-Release-static", 100.0)
+        history.record("glib", "2.80", "x64-Release-static", 200.0)
+
+        self.assertEqual(history.estimate("glib", "2.80", "x64-Release-static"), 150.0)
+
+    def test_unknown_version_falls_back_to_the_most_recently_built_one(self):
+        history = TimingHistory({
+            "glib:x64-Release-static": {
+                "2.82": {"samples": [300.0], "updated": 2000.0},
+                "2.78": {"samples": [100.0], "updated": 1000.0},
+            },
+        })
+
+        self.assertEqual(history.estimate("glib", "2.84", "x64-Release-static"), 300.0)
+
+    def test_other_variants_are_not_used_as_a_fallback(self):
+        history = TimingHistory()
+        history.record("v8", "12.0", "x64-Release-static", 3000.0)
+        history.record_peak("v8", "x64-Release-static", 6 << 30)
+
+        self.assertIsNone(history.estimate("v8", "12.0", "x86-Debug-dynamic"))
+        self.assertIsNone(history.estimate_peak("v8", "x86-Debug-dynamic"))
+        self.assertEqual(history.estimate_peak("v8", "x64-Release-static"), 6 << 30)
+
+    def test_least_recently_built_versions_are_pruned(self):
+        history = TimingHistory({
+            "zlib:x64-Release-static": {
+                "1.3": {"samples": [10.0], "updated": 3000.0},
+                "1.1": {"samples": [10.0], "updated": 1000.0},
+                "1.2": {"samples": [10.0], "updated": 2000.0},
+            },
+        })
+
+        history.record("zlib", "1.4", "x64-Release-static", 12.0)
+
+        versions = history.variants["zlib:x64-Release-static"]
+        self.assertEqual(len(versions), TIMING_HISTORY_VERSIONS)
+        self.assertNotIn("1.1", versions)
+        self.assertEqual(history.estimate("zlib", "2.0", "x64-Release-static"), 12.0)
+
+    def test_history_survives_a_round_trip(self):
+        history = TimingHistory()
+        history.record("glib", "2.80", "x64-Release-static", 100.0)
+        history.record_phase("sync", 5.0)
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = Path(tempdir) / "history.json"
+            history.save(path)
+            loaded = TimingHistory.load(path)
+
+        self.assertEqual(loaded.estimate("glib", "2.80", "x64-Release-static"), 100.0)
+        self.assertEqual(loaded.estimate_phase("sync"), 5.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,390 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import hashlib
+import io
+import os
+from pathlib import Path
+import re
+import socket
+import tarfile
+import tempfile
+import threading
+import unittest
+from unittest import mock
+import urllib.request
+
+import transfer
+from transfer import ConnectionPool, DownloadCache, IntegrityError, RangedDownload, Segment, TeeReader, download_file, \
+        extract_tarball_stream, probe_remote_file, probe_urls
+
+
+class BundleRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_HEAD(self):
+        if self.path in self.server.files:
+            self.serve_file()
+            return
+        if self.path == "/deps/sdk-windows-any.exe":
+            self.send_response(200)
+            self.send_header("Content-Length", "1234")
+            self.send_header("ETag", "\"v1\"")
+        elif self.path == "/latest/sdk-windows-any.exe":
+            self.send_response(302)
+            self.send_header("Location", "/deps/sdk-windows-any.exe")
+            self.send_header("Content-Length", "0")
+        elif self.path == "/loop":
+            self.send_response(302)
+            self.send_header("Location", "/loop")
+            self.send_header("Content-Length", "0")
+        elif self.path == "/hang-up":
+            self.send_response(200)
+            self.send_header("Content-Length", "1")
+            # Drop the connection without announcing it, like an idle keep-alive timing out.
+            self.close_connection = True
+        else:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.send_header("Last-Modified", "Thu, 01 Jan 2026 00:00:00 GMT")
+        self.end_headers()
+
+    def do_GET(self):
+        self.serve_file()
+
+    def serve_file(self):
+        with self.server.lock:
+            self.server.requests.append((self.command, self.headers.get("Range"), self.headers.get("If-Range")))
+            if len(self.server.requests) == self.server.replace_at:
+                self.server.etag, self.server.files[self.path] = self.server.replacement
+            etag = self.server.etag
+            data = self.server.files[self.path]
+
+        match = re.fullmatch(r"bytes=(\d+)-(\d+)", self.headers.get("Range", ""))
+        if match is not None and self.server.accept_ranges and self.headers.get("If-Range", etag) == etag:
+            start, end = int(match.group(1)), int(match.group(2))
+            body = data[start:end + 1]
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes {}-{}/{}".format(start, end, len(data)))
+        else:
+            body = data
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        if self.server.accept_ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+        if self.command == "GET":
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server() -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), BundleRequestHandler)
+    server.lock = threading.Lock()
+    server.connections = 0
+    server.files = {}
+    server.etag = "\"v1\""
+    server.accept_ranges = True
+    server.requests = []
+    server.replace_at = None
+    server.replacement = None
+    server.thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server.thread.start()
+    return server
+
+
+def stop_server(server: ThreadingHTTPServer):
+    server.shutdown()
+    server.server_close()
+    server.thread.join()
+
+
+class ProbeTest(unittest.TestCase):
+    def setUp(self):
+        self.server = start_server()
+        self.base_url = "http://127.0.0.1:{}".format(self.server.server_address[1])
+
+    def tearDown(self):
+        stop_server(self.server)
+
+    def test_statuses_sizes_and_validators_are_reported(self):
+        urls = [self.base_url + path for path in ["/deps/sdk-windows-any.exe", "/deps/sdk-linux-x86_64.tar.bz2"]]
+
+        available, missing = probe_urls(urls, connections=2)
+
+        self.assertEqual((available.url, available.status, available.size, available.validator, available.error),
+                         (urls[0], 200, 1234, "\"v1\"", None))
+        self.assertEqual((missing.url, missing.status, missing.validator),
+                         (urls[1], 404, "Thu, 01 Jan 2026 00:00:00 GMT"))
+
+    def test_redirects_are_followed(self):
+        url = self.base_url + "/latest/sdk-windows-any.exe"
+
+        [result] = probe_urls([url])
+
+        self.assertEqual((result.url, result.status, result.size), (url, 200, 1234))
+
+    def test_redirect_loops_are_cut_short(self):
+        [result] = probe_urls([self.base_url + "/loop"])
+
+        self.assertIsNone(result.status)
+        self.assertEqual(result.error, "too many redirects")
+
+    def test_connection_errors_are_reported_per_url(self):
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            unused_port = s.getsockname()[1]
+        urls = ["http://127.0.0.1:{}/deps/sdk-windows-any.exe".format(unused_port),
+                self.base_url + "/deps/sdk-windows-any.exe"]
+
+        unreachable, available = probe_urls(urls, connections=2)
+
+        self.assertIsNone(unreachable.status)
+        self.assertIsNotNone(unreachable.error)
+        self.assertEqual(available.status, 200)
+
+    def test_connections_are_reused_across_probes(self):
+        urls = [self.base_url + "/deps/{}.exe".format(i) for i in range(16)]
+
+        results = probe_urls(urls, connections=2)
+
+        self.assertEqual([result.status for result in results], [404] * 16)
+        self.assertLessEqual(self.server.connections, 2)
+
+    def test_pool_reconnects_after_the_server_hangs_up(self):
+        pool = ConnectionPool()
+
+        self.assertEqual(pool.head(self.base_url + "/hang-up").status, 200)
+        self.assertEqual(pool.head(self.base_url + "/deps/sdk-windows-any.exe").status, 200)
+        self.assertEqual(self.server.connections, 2)
+
+
+
+class DownloadTest(unittest.TestCase):
+    def setUp(self):
+        self.server = start_server()
+        self.data = os.urandom(4096 + 100)
+        self.server.files["/deps/sdk-windows-any.exe"] = self.data
+        self.url = "http://127.0.0.1:{}/deps/sdk-windows-any.exe".format(self.server.server_address[1])
+
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.destination = Path(self.tempdir.name) / "sdk-windows-any.exe"
+        self.part_path = Path(self.tempdir.name) / "sdk-windows-any.exe.part"
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+        stop_server(self.server)
+
+    def ranged_requests(self):
+        return [(byte_range, validator) for method, byte_range, validator in self.server.requests if method == "GET"]
+
+    def test_large_files_are_split_into_segments(self):
+        progress = []
+
+        with mock.patch.object(transfer, "MIN_SEGMENT_SIZE", 1024):
+            stats = download_file(self.url, self.destination, connections=4,
+                                  on_progress=lambda received, total: progress.append((received, total)))
+
+        self.assertEqual(self.destination.read_bytes(), self.data)
+        self.assertEqual((stats.size, stats.transferred), (len(self.data), len(self.data)))
+        self.assertEqual(sorted(self.ranged_requests()), [
+            ("bytes=0-1048", "\"v1\""),
+            ("bytes=1049-2097", "\"v1\""),
+            ("bytes=2098-3146", "\"v1\""),
+            ("bytes=3147-4195", "\"v1\""),
+        ])
+        self.assertEqual(progress[-1], (len(self.data), len(self.data)))
+        self.assertEqual(list(self.destination.parent.iterdir()), [self.destination])
+
+    def test_partial_download_is_resumed(self):
+        self.part_path.write_bytes(self.data[:1000] + bytes(len(self.data) - 1000))
+        info = probe_remote_file(self.url)
+        RangedDownload(self.url, self.part_path, info, [Segment(0, len(self.data), 1000)], None).save_state()
+
+        stats = download_file(self.url, self.destination)
+
+        self.assertEqual(self.destination.read_bytes(), self.data)
+        self.assertEqual(stats.transferred, len(self.data) - 1000)
+        self.assertEqual(self.ranged_requests(), [("bytes=1000-4195", "\"v1\"")])
+        self.assertEqual(list(self.destination.parent.iterdir()), [self.destination])
+
+    def test_partial_download_of_an_older_version_is_discarded(self):
+        self.part_path.write_bytes(bytes(len(self.data)))
+        info = probe_remote_file(self.url)
+        RangedDownload(self.url, self.part_path, info, [Segment(0, len(self.data), 1000)], None).save_state()
+        self.server.etag = "\"v2\""
+
+        stats = download_file(self.url, self.destination)
+
+        self.assertEqual(self.destination.read_bytes(), self.data)
+        self.assertEqual(stats.transferred, len(self.data))
+        self.assertEqual(self.ranged_requests(), [("bytes=0-4195", "\"v2\"")])
+
+    def test_file_replaced_mid_download_is_fetched_again(self):
+        replacement = os.urandom(2048)
+        # The probe still sees the old file; the ranged request that follows does not.
+        self.server.replace_at = 2
+        self.server.replacement = ("\"v2\"", replacement)
+
+        stats = download_file(self.url, self.destination)
+
+        self.assertEqual(self.destination.read_bytes(), replacement)
+        self.assertEqual(stats.transferred, len(replacement))
+        self.assertEqual(self.ranged_requests(), [("bytes=0-4195", "\"v1\""), ("bytes=0-2047", "\"v2\"")])
+        self.assertEqual(list(self.destination.parent.iterdir()), [self.destination])
+
+    def test_servers_without_range_support_are_downloaded_sequentially(self):
+        self.server.accept_ranges = False
+
+        stats = download_file(self.url, self.destination, connections=4)
+
+        self.assertEqual(self.destination.read_bytes(), self.data)
+        self.assertEqual((stats.size, stats.transferred), (len(self.data), len(self.data)))
+        self.assertEqual(self.ranged_requests(), [(None, None)])
+        self.assertEqual(list(self.destination.parent.iterdir()), [self.destination])
+
+
+
+class DownloadCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.directory = Path(self.tempdir.name) / "cache"
+        self.cache = DownloadCache(self.directory, 10000)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def store(self, data: bytes) -> str:
+        sha256 = hashlib.sha256(data).hexdigest()
+        with self.cache.store(sha256) as f:
+            f.write(data)
+        return sha256
+
+    def test_stored_entries_are_found(self):
+        data = os.urandom(1000)
+        sha256 = hashlib.sha256(data).hexdigest()
+        self.assertIsNone(self.cache.lookup(sha256))
+
+        self.store(data)
+
+        path = self.cache.lookup(sha256)
+        self.assertEqual(path, self.cache.entry_path(sha256))
+        self.assertEqual(path.read_bytes(), data)
+
+    def test_corrupted_entries_are_dropped(self):
+        sha256 = self.store(os.urandom(1000))
+        self.cache.entry_path(sha256).write_bytes(os.urandom(1000))
+
+        self.assertIsNone(self.cache.lookup(sha256))
+        self.assertFalse(self.cache.entry_path(sha256).exists())
+
+    def test_downloads_that_do_not_match_their_digest_are_not_stored(self):
+        sha256 = hashlib.sha256(b"expected").hexdigest()
+
+        with self.assertRaises(IntegrityError):
+            with self.cache.store(sha256) as f:
+                f.write(b"truncated")
+
+        self.assertEqual(list(self.directory.iterdir()), [])
+
+    def test_least_recently_used_entries_are_evicted(self):
+        first = self.store(os.urandom(4000))
+        second = self.store(os.urandom(4000))
+        os.utime(self.cache.entry_path(first), (1000, 1000))
+        os.utime(self.cache.entry_path(second), (2000, 2000))
+        self.assertIsNotNone(self.cache.lookup(first))
+
+        third = self.store(os.urandom(4000))
+
+        self.assertEqual(sorted([path.name for path in self.directory.iterdir()]), sorted([first, third]))
+
+
+
+def make_tarball(members: list) -> bytes:
+    output = io.BytesIO()
+    with tarfile.open(fileobj=output, mode="w:gz") as archive:
+        for name, data in members:
+            info = tarfile.TarInfo(name)
+            if isinstance(data, str):
+                info.type = tarfile.LNKTYPE
+                info.linkname = data
+                archive.addfile(info)
+            else:
+                info.size = len(data)
+                archive.addfile(info, io.BytesIO(data))
+    return output.getvalue()
+
+
+class TarballStreamTest(unittest.TestCase):
+    def setUp(self):
+        self.server = start_server()
+        self.url = "http://127.0.0.1:{}/glib-2.80.tar.gz".format(self.server.server_address[1])
+
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.destination = Path(self.tempdir.name) / "incoming"
+        self.destination.mkdir()
+        self.cache = DownloadCache(Path(self.tempdir.name) / "cache", 1 << 20)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+        stop_server(self.server)
+
+    def fetch(self, sha256: str):
+        with urllib.request.urlopen(self.url) as response, self.cache.store(sha256) as cache_entry:
+            stream = TeeReader(response, cache_entry)
+            extract_tarball_stream(stream, self.destination, "glib")
+            stream.drain()
+
+    def test_members_are_extracted_without_their_top_level_directory(self):
+        tarball = make_tarball([
+            ("./glib-2.80/meson.build", b"project('glib')"),
+            ("./glib-2.80/gio/gio.h", b"#include <glib.h>"),
+            ("./glib-2.80/gio/gio-copy.h", "./glib-2.80/gio/gio.h"),
+            ("./pax_global_header", b""),
+            ("./zlib-1.3/zlib.h", b"#define ZLIB"),
+        ])
+
+        extract_tarball_stream(io.BytesIO(tarball), self.destination, "glib")
+
+        self.assertEqual(sorted([path.relative_to(self.destination).as_posix()
+                                 for path in self.destination.rglob("*") if path.is_file()]),
+                         ["gio/gio-copy.h", "gio/gio.h", "meson.build"])
+        self.assertEqual((self.destination / "gio" / "gio-copy.h").read_bytes(), b"#include <glib.h>")
+
+    def test_streamed_download_is_extracted_and_cached(self):
+        tarball = make_tarball([("glib-2.80/meson.build", b"project('glib')")])
+        self.server.files["/glib-2.80.tar.gz"] = tarball
+        sha256 = hashlib.sha256(tarball).hexdigest()
+
+        self.fetch(sha256)
+
+        self.assertEqual((self.destination / "meson.build").read_bytes(), b"project('glib')")
+        self.assertEqual(self.cache.lookup(sha256).read_bytes(), tarball)
+
+    def test_truncated_stream_fails_without_caching_anything(self):
+        tarball = make_tarball([("glib-2.80/glib.lib", os.urandom(200000))])
+        self.server.files["/glib-2.80.tar.gz"] = tarball[:len(tarball) // 2]
+
+        with self.assertRaises(tarfile.ReadError):
+            self.fetch(hashlib.sha256(tarball).hexdigest())
+
+        self.assertEqual(list(self.cache.directory.iterdir()), [])
+
+    def test_tarball_with_the_wrong_digest_fails_without_caching_anything(self):
+        tarball = make_tarball([("glib-2.80/meson.build", b"project('glib')")])
+        self.server.files["/glib-2.80.tar.gz"] = tarball
+
+        with self.assertRaises(IntegrityError):
+            self.fetch(hashlib.sha256(b"another tarball").hexdigest())
+
+        self.assertEqual(list(self.cache.directory.iterdir()), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,241 @@
+import hashlib
+import hmac
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os
+from pathlib import Path
+import re
+import tempfile
+import threading
+import unittest
+import urllib.parse
+
+from upload import MultipartUploadBackend, S3Backend, S3cmdBackend, UploadBackend, UploadError, upload_file
+
+
+ACCESS_KEY = "AKIDEXAMPLE"
+SECRET_KEY = "wJalrXUtnFEMI/K7MDENG+bPxRfiCYEXAMPLEKEY"
+REGION = "eu-west-1"
+BUCKET = "build.frida.re"
+
+
+class FakeS3RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_HEAD(self):
+        key, query, body = self.receive()
+        if key is None:
+            return
+        self.reply(200 if key in self.server.objects else 404)
+
+    def do_PUT(self):
+        key, query, body = self.receive()
+        if key is None:
+            return
+        with self.server.lock:
+            if "uploadId" in query:
+                upload = self.server.uploads.get(query["uploadId"], None)
+                if upload is None:
+                    self.reply(404, b"<Error><Code>NoSuchUpload</Code></Error>")
+                    return
+                number = int(query["partNumber"])
+                upload[number] = body
+                self.server.events.append(("part", number))
+                self.reply(200, headers={"ETag": "\"{}\"".format(hashlib.md5(body).hexdigest())})
+            else:
+                self.server.objects[key] = body
+                self.server.events.append(("put", key))
+                self.reply(200)
+
+    def do_POST(self):
+        key, query, body = self.receive()
+        if key is None:
+            return
+        with self.server.lock:
+            if "uploads" in query:
+                upload_id = "upload{}".format(len(self.server.events))
+                self.server.uploads[upload_id] = {}
+                self.server.events.append(("create", key))
+                self.reply(200, "<InitiateMultipartUploadResult><UploadId>{}</UploadId></InitiateMultipartUploadResult>"
+                           .format(upload_id).encode('utf-8'))
+                return
+
+            upload = self.server.uploads.pop(query["uploadId"], None)
+            parts = [(int(number), etag.decode('utf-8')) for number, etag in
+                     re.findall(rb"<Part><PartNumber>(\d+)</PartNumber><ETag>([^<]+)</ETag></Part>", body)]
+            if upload is None or [number for number, _ in parts] != list(range(1, len(upload) + 1)) \
+                    or any([etag != "\"{}\"".format(hashlib.md5(upload[number]).hexdigest()) for number, etag in parts]):
+                self.reply(200, b"<Error><Code>InvalidPart</Code></Error>")
+                return
+            self.server.objects[key] = b"".join([upload[number] for number, _ in parts])
+            self.server.events.append(("complete", key))
+            self.reply(200, b"<CompleteMultipartUploadResult></CompleteMultipartUploadResult>")
+
+    def do_DELETE(self):
+        key, query, body = self.receive()
+        if key is None:
+            return
+        with self.server.lock:
+            self.server.uploads.pop(query["uploadId"], None)
+            self.server.events.append(("abort", key))
+        self.reply(204)
+
+    def receive(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", "0")))
+        parts = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(parts.query, keep_blank_values=True))
+        if not self.verify_signature(parts.path, query, body):
+            self.reply(403, b"<Error><Code>SignatureDoesNotMatch</Code></Error>")
+            return (None, None, None)
+        bucket, _, key = urllib.parse.unquote(parts.path).lstrip("/").partition("/")
+        if bucket != BUCKET:
+            self.reply(404, b"<Error><Code>NoSuchBucket</Code></Error>")
+            return (None, None, None)
+        return (key, query, body)
+
+    def verify_signature(self, path: str, query: dict, body: bytes) -> bool:
+        match = re.fullmatch(r"AWS4-HMAC-SHA256 Credential=([^/]+)/(\d{8})/([^/]+)/s3/aws4_request, "
+                             r"SignedHeaders=([a-z0-9;-]+), Signature=([0-9a-f]{64})",
+                             self.headers.get("Authorization", ""))
+        if match is None:
+            return False
+        access_key, date, region, signed_headers, signature = match.groups()
+        payload_hash = self.headers.get("x-amz-content-sha256", "")
+        amz_date = self.headers.get("x-amz-date", "")
+        if access_key != ACCESS_KEY or region != REGION or not amz_date.startswith(date) \
+                or payload_hash != hashlib.sha256(body).hexdigest():
+            return False
+
+        header_names = signed_headers.split(";")
+        if not {"host", "x-amz-content-sha256", "x-amz-date"}.issubset(header_names):
+            return False
+        canonical_query = "&".join(["{}={}".format(urllib.parse.quote(k, safe="-_.~"), urllib.parse.quote(v, safe="-_.~"))
+                                    for k, v in sorted(query.items())])
+        canonical_request = "\n".join([
+            self.command,
+            path,
+            canonical_query,
+            "".join(["{}:{}\n".format(name, self.headers.get(name, "").strip()) for name in header_names]),
+            signed_headers,
+            payload_hash,
+        ])
+        string_to_sign = "\n".join([
+            "AWS4-HMAC-SHA256",
+            amz_date,
+            "{}/{}/s3/aws4_request".format(date, region),
+            hashlib.sha256(canonical_request.encode('utf-8')).hexdigest(),
+        ])
+        signing_key = ("AWS4" + SECRET_KEY).encode('utf-8')
+        for component in [date, region, "s3", "aws4_request"]:
+            signing_key = hmac.new(signing_key, component.encode('utf-8'), hashlib.sha256).digest()
+        expected = hmac.new(signing_key, string_to_sign.encode('utf-8'), hashlib.sha256).hexdigest()
+        return hmac.compare_digest(expected, signature)
+
+    def reply(self, status: int, body: bytes = b"", headers: dict = {}):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class S3BackendTest(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), FakeS3RequestHandler)
+        self.server.lock = threading.Lock()
+        self.server.objects = {}
+        self.server.uploads = {}
+        self.server.events = []
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.endpoint = "http://127.0.0.1:{}".format(self.server.server_address[1])
+        self.backend = S3Backend(self.endpoint, BUCKET, REGION, ACCESS_KEY, SECRET_KEY)
+
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.path = Path(self.tempdir.name) / "sdk-windows-any.exe"
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def test_small_files_are_put_in_one_signed_request(self):
+        self.path.write_bytes(b"MZ" + os.urandom(1000))
+
+        self.assertFalse(self.backend.exists("deps/20260101/sdk windows+any.exe"))
+        self.backend.put_file(self.path, "deps/20260101/sdk windows+any.exe")
+
+        self.assertTrue(self.backend.exists("deps/20260101/sdk windows+any.exe"))
+        self.assertEqual(self.server.objects["deps/20260101/sdk windows+any.exe"], self.path.read_bytes())
+        self.assertEqual(self.server.events, [("put", "deps/20260101/sdk windows+any.exe")])
+
+    def test_requests_signed_with_the_wrong_secret_are_rejected(self):
+        self.path.write_bytes(b"MZ")
+        backend = S3Backend(self.endpoint, BUCKET, REGION, ACCESS_KEY, "not-the-secret")
+
+        with self.assertRaises(UploadError):
+            backend.put_file(self.path, "deps/sdk.exe")
+
+        self.assertEqual(self.server.objects, {})
+
+    def test_large_files_are_assembled_from_parts(self):
+        data = os.urandom(10 * 1024 + 123)
+        self.path.write_bytes(data)
+
+        stats = upload_file(self.backend, self.path, "deps/sdk.exe", part_size=1024)
+
+        self.assertEqual(self.server.objects["deps/sdk.exe"], data)
+        self.assertEqual((stats.size, stats.parts, stats.reuploaded_parts), (len(data), 11, 0))
+        self.assertEqual(self.server.events[0], ("create", "deps/sdk.exe"))
+        self.assertEqual(sorted([event[1] for event in self.server.events if event[0] == "part"]), list(range(1, 12)))
+        self.assertEqual(self.server.events[-1], ("complete", "deps/sdk.exe"))
+        self.assertEqual(self.server.uploads, {})
+
+    def test_parts_rewritten_while_streaming_are_sent_again(self):
+        final = bytearray(os.urandom(4096 + 500))
+        self.path.write_bytes(bytes(final[:2048]))
+        polls = []
+
+        def poll_writer():
+            polls.append(None)
+            if len(polls) == 2:
+                # The writer goes back and patches its header, like 7z does once it knows the sizes.
+                final[:16] = b"\xff" * 16
+                self.path.write_bytes(bytes(final))
+                return True
+            return None
+
+        stats = upload_file(self.backend, self.path, "deps/sdk.exe", poll_writer, part_size=1024)
+
+        self.assertEqual(self.server.objects["deps/sdk.exe"], bytes(final))
+        self.assertEqual((stats.parts, stats.reuploaded_parts), (5, 1))
+
+    def test_failed_writer_aborts_the_upload(self):
+        self.path.write_bytes(os.urandom(4096))
+        polls = []
+
+        def poll_writer():
+            polls.append(None)
+            return None if len(polls) == 1 else False
+
+        with self.assertRaises(UploadError):
+            upload_file(self.backend, self.path, "deps/sdk.exe", poll_writer, part_size=1024)
+
+        self.assertEqual(self.server.events[-1], ("abort", "deps/sdk.exe"))
+        self.assertEqual(self.server.uploads, {})
+        self.assertNotIn("deps/sdk.exe", self.server.objects)
+
+    def test_only_s3_claims_multipart_support(self):
+        self.assertTrue(issubclass(S3Backend, MultipartUploadBackend))
+        self.assertFalse(issubclass(S3cmdBackend, MultipartUploadBackend))
+        with self.assertRaises(TypeError):
+            UploadBackend()
+
+
+if __name__ == '__main__':
+    unittest.main()
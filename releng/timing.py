@@ -0,0 +1,189 @@
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+import json
+import os
+from pathlib import Path
+import subprocess
+import tempfile
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional
+
+
+TIMING_HISTORY_FORMAT = 2
+TIMING_HISTORY_SAMPLES = 5
+TIMING_HISTORY_VERSIONS = 3
+
+
+@dataclass
+class TimingRecord:
+    name: str
+    package: Optional[str]
+    variant: Optional[str]
+    start: float
+    end: float
+    status: str
+    exit_code: Optional[int]
+    thread: str
+    details: Dict[str, Any] = field(default_factory=dict)
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+
+class TimingRecorder:
+    def __init__(self):
+        self.records: List[TimingRecord] = []
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def measure(self, name: str, package: Optional[str] = None,
+                variant: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+        start = time.time()
+        status = "ok"
+        exit_code = None
+        details = {}
+        try:
+            yield details
+        except subprocess.CalledProcessError as e:
+            status = "failed"
+            exit_code = e.returncode
+            raise
+        except:
+            status = "failed"
+            raise
+        finally:
+            self.add(TimingRecord(name, package, variant, start, time.time(), status, exit_code,
+                                  threading.current_thread().name, details))
+
+    def add(self, record: TimingRecord):
+        with self.lock:
+            self.records.append(record)
+
+    def snapshot(self) -> List[TimingRecord]:
+        with self.lock:
+            return sorted(self.records, key=lambda record: record.start)
+
+
+class TimingHistory:
+    def __init__(self, variants: Optional[Dict[str, Dict[str, Dict[str, Any]]]] = None,
+                 phases: Optional[Dict[str, List[float]]] = None,
+                 peaks: Optional[Dict[str, List[int]]] = None):
+        self.variants = variants if variants is not None else {}
+        self.phases = phases if phases is not None else {}
+        self.peaks = peaks if peaks is not None else {}
+
+    @staticmethod
+    def load(path: Path) -> 'TimingHistory':
+        try:
+            data = json.loads(path.read_text(encoding='utf-8'))
+            if data["format"] == TIMING_HISTORY_FORMAT:
+                return TimingHistory(data["variants"], data["phases"], data.get("peaks", {}))
+        except:
+            pass
+        return TimingHistory()
+
+    def save(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(mode="w", encoding='utf-8', dir=path.parent, suffix=".tmp", delete=False) as f:
+            json.dump({
+                "format": TIMING_HISTORY_FORMAT,
+                "variants": self.variants,
+                "phases": self.phases,
+                "peaks": self.peaks,
+            }, f, indent=2)
+        os.replace(f.name, path)
+
+    def record(self, package: str, version: str, variant: str, duration: float):
+        versions = self.variants.setdefault(compute_history_key(package, variant), {})
+        samples = versions.get(version, {"samples": []})["samples"]
+        versions[version] = {
+            "samples": (samples + [duration])[-TIMING_HISTORY_SAMPLES:],
+            "updated": time.time(),
+        }
+        for stale_version in sorted(versions.keys(), key=lambda v: versions[v]["updated"])[:-TIMING_HISTORY_VERSIONS]:
+            del versions[stale_version]
+
+    def record_phase(self, name: str, duration: float):
+        self.phases[name] = (self.phases.get(name, []) + [duration])[-TIMING_HISTORY_SAMPLES:]
+
+    def estimate(self, package: str, version: str, variant: str) -> Optional[float]:
+        versions = self.variants.get(compute_history_key(package, variant), {})
+        entry = versions.get(version, None)
+        if entry is None and versions:
+            # Other variants may differ wildly, so only fall back to the most recently built version of this one.
+            entry = max(versions.values(), key=lambda e: e["updated"])
+        if entry is None or not entry["samples"]:
+            return None
+        return sum(entry["samples"]) / len(entry["samples"])
+
+    def estimate_phase(self, name: str) -> Optional[float]:
+        samples = self.phases.get(name, [])
+        if not samples:
+            return None
+        return sum(samples) / len(samples)
+
+    def record_peak(self, package: str, variant: str, peak: int):
+        key = compute_history_key(package, variant)
+        self.peaks[key] = (self.peaks.get(key, []) + [peak])[-TIMING_HISTORY_SAMPLES:]
+
+    def estimate_peak(self, package: str, variant: str) -> Optional[int]:
+        samples = self.peaks.get(compute_history_key(package, variant), [])
+        if not samples:
+            return None
+        return max(samples)
+
+
+def compute_history_key(package: str, variant: str) -> str:
+    return package + ":" + variant
+
+
+def write_timing_records(records: List[TimingRecord], path: Path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with path.open("w", encoding='utf-8') as f:
+        for record in records:
+            data = asdict(record)
+            data["duration"] = record.duration
+            f.write(json.dumps(data) + "\n")
+
+
+def write_chrome_trace(records: List[TimingRecord], path: Path):
+    origin = min([record.start for record in records], default=0.0)
+    thread_ids: Dict[str, int] = {}
+    for record in records:
+        thread_ids.setdefault(record.thread, len(thread_ids) + 1)
+
+    pid = os.getpid()
+    events = [{
+        "name": "thread_name",
+        "ph": "M",
+        "pid": pid,
+        "tid": tid,
+        "args": {"name": thread},
+    } for thread, tid in thread_ids.items()]
+    for record in records:
+        label = record.name
+        if record.package is not None:
+            label += " " + record.package
+        if record.variant is not None:
+            label += " " + record.variant
+        events.append({
+            "name": label,
+            "cat": record.name,
+            "ph": "X",
+            "ts": round((record.start - origin) * 1e6),
+            "dur": round(record.duration * 1e6),
+            "pid": pid,
+            "tid": thread_ids[record.thread],
+            "args": {
+                "package": record.package,
+                "variant": record.variant,
+                "status": record.status,
+                "exit_code": record.exit_code,
+                **record.details,
+            },
+        })
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps({"traceEvents": events, "displayTimeUnit": "ms"}), encoding='utf-8')
@@ -0,0 +1,478 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+import hashlib
+import http.client
+import json
+import os
+from pathlib import Path
+import tarfile
+import tempfile
+import threading
+import time
+from typing import BinaryIO, Callable, Dict, Iterator, List, Optional, Tuple
+import urllib.parse
+import urllib.request
+
+
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+DOWNLOAD_STATE_SAVE_INTERVAL = 8 * 1024 * 1024
+MIN_SEGMENT_SIZE = 16 * 1024 * 1024
+MAX_DOWNLOAD_ATTEMPTS = 5
+MAX_PROBE_REDIRECTS = 3
+PROBE_TIMEOUT = 30
+RETRYABLE_DOWNLOAD_ERRORS = (OSError, http.client.HTTPException)
+
+ProgressCallback = Callable[[int, int], None]
+
+
+@dataclass
+class RemoteFileInfo:
+    size: Optional[int]
+    accepts_ranges: bool
+    validator: Optional[str]
+
+
+@dataclass
+class Segment:
+    start: int
+    end: int
+    received: int = 0
+
+    @property
+    def complete(self) -> bool:
+        return self.start + self.received >= self.end
+
+
+@dataclass
+class ProbeResult:
+    url: str
+    status: Optional[int]
+    size: Optional[int]
+    validator: Optional[str]
+    error: Optional[str] = None
+
+
+@dataclass
+class DownloadStats:
+    size: int
+    transferred: int
+    elapsed: float
+
+    @property
+    def throughput(self) -> float:
+        return self.transferred / self.elapsed if self.elapsed > 0 else 0.0
+
+
+class DownloadCache:
+    def __init__(self, directory: Path, max_size: int):
+        self.directory = directory
+        self.max_size = max_size
+        self.lock = threading.Lock()
+
+    def entry_path(self, sha256: str) -> Path:
+        return self.directory / sha256
+
+    def lookup(self, sha256: str) -> Optional[Path]:
+        path = self.entry_path(sha256)
+        try:
+            digest = compute_file_sha256(path)
+        except FileNotFoundError:
+            return None
+
+        if digest != sha256:
+            path.unlink(missing_ok=True)
+            return None
+
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    @contextmanager
+    def store(self, sha256: str) -> Iterator[BinaryIO]:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=self.directory, prefix=sha256, suffix=".tmp", delete=False) as f:
+            temp_path = Path(f.name)
+            writer = HashingWriter(f)
+            try:
+                yield writer
+            except:
+                f.close()
+                temp_path.unlink(missing_ok=True)
+                raise
+
+        digest = writer.sha256.hexdigest()
+        if digest != sha256:
+            temp_path.unlink(missing_ok=True)
+            raise IntegrityError("expected SHA-256 {}, got {}".format(sha256, digest))
+
+        os.replace(temp_path, self.entry_path(sha256))
+        self.evict(keep=sha256)
+
+    def evict(self, keep: Optional[str] = None):
+        with self.lock:
+            entries = []
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith(".tmp") or entry.name == keep:
+                    continue
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, Path(entry.path)))
+
+            total_size = sum([size for _, size, _ in entries])
+            if keep is not None:
+                try:
+                    total_size += self.entry_path(keep).stat().st_size
+                except FileNotFoundError:
+                    pass
+            for _, size, path in sorted(entries):
+                if total_size <= self.max_size:
+                    break
+                try:
+                    path.unlink(missing_ok=True)
+                except OSError:
+                    # Still open elsewhere on Windows; the next eviction will retry.
+                    continue
+                total_size -= size
+
+
+class DownloadProgress:
+    def __init__(self, name: str, total: int = 0):
+        self.name = name
+        self.total = total
+        self.received = 0
+        self.reported_percentage = 0
+        self.started_at = time.time()
+
+    def update(self, n: int):
+        self.report(self.received + n, self.total)
+
+    def report(self, received: int, total: int):
+        self.received = received
+        self.total = total
+        if total == 0:
+            return
+        percentage = (received * 100 // total) // 10 * 10
+        if percentage > self.reported_percentage:
+            self.reported_percentage = percentage
+            elapsed = time.time() - self.started_at
+            print("{}: {}% of {} ({}/s)".format(self.name, percentage, format_size(total),
+                                                format_size(received / elapsed if elapsed > 0 else 0)),
+                  flush=True)
+
+
+class HashingWriter:
+    def __init__(self, f: BinaryIO):
+        self.f = f
+        self.sha256 = hashlib.sha256()
+
+    def write(self, data: bytes) -> int:
+        self.sha256.update(data)
+        return self.f.write(data)
+
+
+class TeeReader:
+    def __init__(self, source: BinaryIO, sink: BinaryIO, on_progress: Optional[Callable[[int], None]] = None):
+        self.source = source
+        self.sink = sink
+        self.on_progress = on_progress
+
+    def read(self, n: int = -1) -> bytes:
+        data = self.source.read(n)
+        if len(data) > 0:
+            self.sink.write(data)
+            if self.on_progress is not None:
+                self.on_progress(len(data))
+        return data
+
+    def drain(self):
+        while len(self.read(1024 * 1024)) > 0:
+            pass
+
+
+class RangedDownload:
+    def __init__(self, url: str, part_path: Path, info: RemoteFileInfo, segments: List[Segment],
+                 on_progress: Optional[ProgressCallback]):
+        self.url = url
+        self.part_path = part_path
+        self.state_path = part_path.parent / (part_path.name + ".json")
+        self.info = info
+        self.segments = segments
+        self.on_progress = on_progress
+        self.lock = threading.Lock()
+        self.unsaved = 0
+
+    @property
+    def received(self) -> int:
+        return sum([segment.received for segment in self.segments])
+
+    def run(self):
+        with self.part_path.open("r+b" if self.part_path.exists() else "w+b") as f:
+            f.truncate(self.info.size)
+
+        pending = [segment for segment in self.segments if not segment.complete]
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, len(pending))) as executor:
+                for future in [executor.submit(self.fetch_segment, segment) for segment in pending]:
+                    future.result()
+        finally:
+            self.save_state()
+
+    def fetch_segment(self, segment: Segment):
+        attempt = 1
+        while not segment.complete:
+            request = urllib.request.Request(self.url)
+            request.add_header("Range", "bytes={}-{}".format(segment.start + segment.received, segment.end - 1))
+            if self.info.validator is not None:
+                request.add_header("If-Range", self.info.validator)
+            try:
+                with urllib.request.urlopen(request) as response, self.part_path.open("r+b") as f:
+                    if response.status != 206:
+                        raise ContentChangedError("{} changed while downloading it".format(self.url))
+                    f.seek(segment.start + segment.received)
+                    while not segment.complete:
+                        chunk = response.read(min(DOWNLOAD_CHUNK_SIZE, segment.end - segment.start - segment.received))
+                        if len(chunk) == 0:
+                            raise ConnectionError("connection closed prematurely")
+                        f.write(chunk)
+                        self.record_progress(segment, len(chunk), f)
+            except RETRYABLE_DOWNLOAD_ERRORS as e:
+                if isinstance(e, urllib.error.HTTPError) and e.code < 500:
+                    raise
+                if attempt == MAX_DOWNLOAD_ATTEMPTS:
+                    raise
+                time.sleep(min(2 ** attempt, 30))
+                attempt += 1
+
+    def record_progress(self, segment: Segment, n: int, f: BinaryIO):
+        with self.lock:
+            segment.received += n
+            self.unsaved += n
+            should_save = self.unsaved >= DOWNLOAD_STATE_SAVE_INTERVAL
+            received = self.received
+        if should_save:
+            f.flush()
+            self.save_state()
+        if self.on_progress is not None:
+            self.on_progress(received, self.info.size)
+
+    def save_state(self):
+        with self.lock:
+            self.unsaved = 0
+            blob = {
+                "url": self.url,
+                "info": asdict(self.info),
+                "segments": [asdict(segment) for segment in self.segments],
+            }
+            temp_path = self.state_path.parent / (self.state_path.name + ".tmp")
+            temp_path.write_text(json.dumps(blob), encoding='utf-8')
+            os.replace(temp_path, self.state_path)
+
+    @staticmethod
+    def load_state(url: str, part_path: Path, info: RemoteFileInfo) -> Optional[List[Segment]]:
+        state_path = part_path.parent / (part_path.name + ".json")
+        try:
+            blob = json.loads(state_path.read_text(encoding='utf-8'))
+            if blob["url"] != url or RemoteFileInfo(**blob["info"]) != info or not part_path.exists():
+                return None
+            return [Segment(**segment) for segment in blob["segments"]]
+        except:
+            return None
+
+
+class ConnectionPool:
+    def __init__(self):
+        self.local = threading.local()
+
+    def head(self, url: str) -> http.client.HTTPResponse:
+        response, _ = self.request("HEAD", url)
+        return response
+
+    def request(self, method: str, url: str, headers: Dict[str, str] = {},
+                body: Optional[bytes] = None) -> Tuple[http.client.HTTPResponse, bytes]:
+        parts = urllib.parse.urlsplit(url)
+        path = parts.path if parts.query == "" else parts.path + "?" + parts.query
+        attempt = 1
+        while True:
+            connection = self.connection_for(parts.scheme, parts.netloc)
+            try:
+                connection.request(method, path, body=body, headers=headers)
+                response = connection.getresponse()
+                body = response.read()
+                return (response, body)
+            except RETRYABLE_DOWNLOAD_ERRORS:
+                connection.close()
+                if attempt == 2:
+                    raise
+                attempt += 1
+
+    def connection_for(self, scheme: str, netloc: str) -> http.client.HTTPConnection:
+        connections: Dict[Tuple[str, str], http.client.HTTPConnection] = getattr(self.local, "connections", None)
+        if connections is None:
+            connections = {}
+            self.local.connections = connections
+
+        key = (scheme, netloc)
+        connection = connections.get(key, None)
+        if connection is None:
+            if scheme == "https":
+                connection = http.client.HTTPSConnection(netloc, timeout=PROBE_TIMEOUT)
+            else:
+                connection = http.client.HTTPConnection(netloc, timeout=PROBE_TIMEOUT)
+            connections[key] = connection
+        return connection
+
+
+class ContentChangedError(Exception):
+    pass
+
+
+class IntegrityError(Exception):
+    pass
+
+
+def compute_file_sha256(path: Path) -> str:
+    sha256 = hashlib.sha256()
+    with path.open("rb") as f:
+        while True:
+            chunk = f.read(1024 * 1024)
+            if len(chunk) == 0:
+                break
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def extract_tarball_stream(fileobj: BinaryIO, destination: Path, top_level_prefix: str = ""):
+    with tarfile.open(fileobj=fileobj, mode="r|*") as archive:
+        for member in archive:
+            path = member.name[2:] if member.name.startswith("./") else member.name
+            top_level, _, subpath = path.partition("/")
+            if subpath == "" or not top_level.startswith(top_level_prefix):
+                continue
+            member.name = subpath
+            if member.islnk():
+                linkname = member.linkname[2:] if member.linkname.startswith("./") else member.linkname
+                member.linkname = linkname.partition("/")[2]
+            if hasattr(tarfile, "data_filter"):
+                archive.extract(member, destination, filter="data")
+            else:
+                archive.extract(member, destination)
+
+
+def download_file(url: str, destination: Path, connections: int = 1,
+                  on_progress: Optional[ProgressCallback] = None) -> DownloadStats:
+    started_at = time.time()
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    part_path = destination.parent / (destination.name + ".part")
+    state_path = part_path.parent / (part_path.name + ".json")
+
+    info = probe_remote_file(url)
+    if info.size is None or not info.accepts_ranges:
+        size = download_file_sequentially(url, part_path, on_progress)
+        os.replace(part_path, destination)
+        return DownloadStats(size, size, time.time() - started_at)
+
+    segments = RangedDownload.load_state(url, part_path, info)
+    if segments is None:
+        segments = split_into_segments(info.size, connections)
+    already_received = sum([segment.received for segment in segments])
+
+    try:
+        RangedDownload(url, part_path, info, segments, on_progress).run()
+    except ContentChangedError:
+        state_path.unlink(missing_ok=True)
+        part_path.unlink(missing_ok=True)
+
+        info = probe_remote_file(url)
+        if info.size is None or not info.accepts_ranges:
+            raise
+        already_received = 0
+        RangedDownload(url, part_path, info, split_into_segments(info.size, connections), on_progress).run()
+
+    os.replace(part_path, destination)
+    state_path.unlink(missing_ok=True)
+
+    return DownloadStats(info.size, info.size - already_received, time.time() - started_at)
+
+
+def probe_remote_file(url: str) -> RemoteFileInfo:
+    request = urllib.request.Request(url, method="HEAD")
+    try:
+        with urllib.request.urlopen(request) as response:
+            headers = response.headers
+    except urllib.error.HTTPError as e:
+        if e.code in (403, 404):
+            raise
+        return RemoteFileInfo(None, False, None)
+
+    length = headers.get("Content-Length", None)
+    validator = headers.get("ETag", None)
+    if validator is None or validator.startswith("W/"):
+        validator = headers.get("Last-Modified", None)
+    return RemoteFileInfo(int(length) if length is not None else None,
+                          headers.get("Accept-Ranges", "none").strip().lower() == "bytes",
+                          validator)
+
+
+def probe_urls(urls: List[str], connections: int = 8) -> List[ProbeResult]:
+    pool = ConnectionPool()
+    with ThreadPoolExecutor(max_workers=max(1, min(connections, len(urls)))) as executor:
+        return list(executor.map(lambda url: probe_url(url, pool), urls))
+
+
+def probe_url(url: str, pool: ConnectionPool) -> ProbeResult:
+    location = url
+    try:
+        for _ in range(MAX_PROBE_REDIRECTS + 1):
+            response = pool.head(location)
+            if response.status in (301, 302, 303, 307, 308) and response.getheader("Location") is not None:
+                location = urllib.parse.urljoin(location, response.getheader("Location"))
+                continue
+            length = response.getheader("Content-Length")
+            validator = response.getheader("ETag") or response.getheader("Last-Modified")
+            return ProbeResult(url, response.status, int(length) if length is not None else None, validator)
+        return ProbeResult(url, None, None, None, "too many redirects")
+    except RETRYABLE_DOWNLOAD_ERRORS as e:
+        return ProbeResult(url, None, None, None, str(e))
+
+
+def split_into_segments(size: int, connections: int) -> List[Segment]:
+    count = max(1, min(connections, size // MIN_SEGMENT_SIZE))
+    boundaries = [size * i // count for i in range(count + 1)]
+    return [Segment(boundaries[i], boundaries[i + 1]) for i in range(count)]
+
+
+def download_file_sequentially(url: str, destination: Path, on_progress: Optional[ProgressCallback]) -> int:
+    attempt = 1
+    while True:
+        received = 0
+        try:
+            with urllib.request.urlopen(url) as response, destination.open("wb") as f:
+                length = response.headers.get("Content-Length", None)
+                total = int(length) if length is not None else 0
+                while True:
+                    chunk = response.read(DOWNLOAD_CHUNK_SIZE)
+                    if len(chunk) == 0:
+                        break
+                    f.write(chunk)
+                    received += len(chunk)
+                    if on_progress is not None:
+                        on_progress(received, total)
+                if length is not None and received != total:
+                    raise ConnectionError("connection closed prematurely")
+            return received
+        except RETRYABLE_DOWNLOAD_ERRORS as e:
+            if isinstance(e, urllib.error.HTTPError) and e.code < 500:
+                raise
+            if attempt == MAX_DOWNLOAD_ATTEMPTS:
+                raise
+            time.sleep(min(2 ** attempt, 30))
+            attempt += 1
+
+
+def format_size(size: float) -> str:
+    return "{:.1f} MiB".format(size / (1024 * 1024))
@@ -0,0 +1,326 @@
+from abc import ABC, abstractmethod
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+import hashlib
+import hmac
+import os
+from pathlib import Path
+import platform
+import re
+import subprocess
+import sys
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+import urllib.parse
+
+from transfer import ConnectionPool, MAX_DOWNLOAD_ATTEMPTS, RETRYABLE_DOWNLOAD_ERRORS
+
+
+UPLOAD_PART_SIZE = 16 * 1024 * 1024
+UPLOAD_CONCURRENCY = 4
+UPLOAD_POLL_INTERVAL = 1.0
+DEFAULT_S3_ENDPOINT = "https://s3.amazonaws.com"
+DEFAULT_S3_BUCKET = "build.frida.re"
+DEFAULT_S3_REGION = "us-east-1"
+
+WriterPoller = Callable[[], Optional[bool]]
+
+
+@dataclass
+class UploadStats:
+    size: int
+    elapsed: float
+    parts: int
+    reuploaded_parts: int
+    trailing: float
+
+
+class UploadBackend(ABC):
+    @abstractmethod
+    def exists(self, key: str) -> bool:
+        pass
+
+    @abstractmethod
+    def put_file(self, path: Path, key: str):
+        pass
+
+    @abstractmethod
+    def sync_directory(self, directory: Path, prefix: str):
+        pass
+
+
+class MultipartUploadBackend(UploadBackend):
+    @abstractmethod
+    def create_multipart_upload(self, key: str) -> str:
+        pass
+
+    @abstractmethod
+    def upload_part(self, key: str, upload_id: str, number: int, data: bytes) -> str:
+        pass
+
+    @abstractmethod
+    def complete_multipart_upload(self, key: str, upload_id: str, parts: List[Tuple[int, str]]):
+        pass
+
+    @abstractmethod
+    def abort_multipart_upload(self, key: str, upload_id: str):
+        pass
+
+
+class S3Backend(MultipartUploadBackend):
+    def __init__(self, endpoint: str, bucket: str, region: str, access_key: str, secret_key: str):
+        self.endpoint = endpoint.rstrip("/")
+        self.bucket = bucket
+        self.region = region
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.pool = ConnectionPool()
+
+    def exists(self, key: str) -> bool:
+        status, _, _ = self.request("HEAD", key)
+        if status == 404:
+            return False
+        if status != 200:
+            raise UploadError("unable to check {}: HTTP {}".format(key, status))
+        return True
+
+    def put_file(self, path: Path, key: str):
+        if path.stat().st_size > UPLOAD_PART_SIZE:
+            upload_file(self, path, key)
+            return
+        self.expect(200, "PUT", key, body=path.read_bytes())
+
+    def sync_directory(self, directory: Path, prefix: str):
+        files = [p for p in directory.rglob("*") if p.is_file() and not p.name.endswith(".tmp")]
+        keys = [prefix + p.relative_to(directory).as_posix() for p in files]
+        with ThreadPoolExecutor(max_workers=UPLOAD_CONCURRENCY) as executor:
+            for future in [executor.submit(lambda p, k: None if self.exists(k) else self.put_file(p, k), path, key)
+                           for path, key in zip(files, keys)]:
+                future.result()
+
+    def create_multipart_upload(self, key: str) -> str:
+        _, body = self.expect(200, "POST", key, {"uploads": ""})
+        match = re.search(rb"<UploadId>([^<]+)</UploadId>", body)
+        if match is None:
+            raise UploadError("unexpected response when creating upload of {}".format(key))
+        return match.group(1).decode('utf-8')
+
+    def upload_part(self, key: str, upload_id: str, number: int, data: bytes) -> str:
+        headers, _ = self.expect(200, "PUT", key, {"partNumber": str(number), "uploadId": upload_id}, body=data)
+        return headers["etag"]
+
+    def complete_multipart_upload(self, key: str, upload_id: str, parts: List[Tuple[int, str]]):
+        body = "".join(["<CompleteMultipartUpload>"] +
+                       ["<Part><PartNumber>{}</PartNumber><ETag>{}</ETag></Part>".format(number, etag)
+                        for number, etag in parts] +
+                       ["</CompleteMultipartUpload>"]).encode('utf-8')
+        _, response_body = self.expect(200, "POST", key, {"uploadId": upload_id}, body=body)
+        if b"<Error>" in response_body:
+            raise UploadError("unable to complete upload of {}: {}".format(key, response_body.decode('utf-8', 'replace')))
+
+    def abort_multipart_upload(self, key: str, upload_id: str):
+        self.request("DELETE", key, {"uploadId": upload_id})
+
+    def expect(self, expected_status: int, method: str, key: str, query: Dict[str, str] = {},
+               body: bytes = b"") -> Tuple[Dict[str, str], bytes]:
+        status, headers, response_body = self.request(method, key, query, body)
+        if status != expected_status:
+            raise UploadError("{} {} failed with HTTP {}: {}".format(method, key, status,
+                                                                     response_body[:512].decode('utf-8', 'replace')))
+        return (headers, response_body)
+
+    def request(self, method: str, key: str, query: Dict[str, str] = {},
+                body: bytes = b"") -> Tuple[int, Dict[str, str], bytes]:
+        path = "/{}/{}".format(self.bucket, urllib.parse.quote(key, safe="/-_.~"))
+        query_string = "&".join(["{}={}".format(urllib.parse.quote(k, safe="-_.~"), urllib.parse.quote(v, safe="-_.~"))
+                                 for k, v in sorted(query.items())])
+        url = self.endpoint + path + ("?" + query_string if query_string else "")
+
+        attempt = 1
+        while True:
+            headers = self.sign(method, url, body)
+            try:
+                response, response_body = self.pool.request(method, url, headers, body)
+                if response.status >= 500 and attempt < MAX_DOWNLOAD_ATTEMPTS:
+                    raise ConnectionError("HTTP {}".format(response.status))
+                return (response.status, {k.lower(): v for k, v in response.getheaders()}, response_body)
+            except RETRYABLE_DOWNLOAD_ERRORS:
+                if attempt == MAX_DOWNLOAD_ATTEMPTS:
+                    raise
+                time.sleep(min(2 ** attempt, 30))
+                attempt += 1
+
+    def sign(self, method: str, url: str, body: bytes) -> Dict[str, str]:
+        parts = urllib.parse.urlsplit(url)
+        amz_date = time.strftime("%Y%m%dT%H%M%SZ", time.gmtime())
+        date = amz_date[:8]
+        payload_hash = hashlib.sha256(body).hexdigest()
+
+        headers = {
+            "host": parts.netloc,
+            "x-amz-content-sha256": payload_hash,
+            "x-amz-date": amz_date,
+        }
+        signed_headers = ";".join(sorted(headers.keys()))
+        canonical_request = "\n".join([
+            method,
+            parts.path,
+            parts.query,
+            "".join(["{}:{}\n".format(name, headers[name]) for name in sorted(headers.keys())]),
+            signed_headers,
+            payload_hash,
+        ])
+
+        scope = "{}/{}/s3/aws4_request".format(date, self.region)
+        string_to_sign = "\n".join([
+            "AWS4-HMAC-SHA256",
+            amz_date,
+            scope,
+            hashlib.sha256(canonical_request.encode('utf-8')).hexdigest(),
+        ])
+        key = ("AWS4" + self.secret_key).encode('utf-8')
+        for component in [date, self.region, "s3", "aws4_request"]:
+            key = hmac.new(key, component.encode('utf-8'), hashlib.sha256).digest()
+        signature = hmac.new(key, string_to_sign.encode('utf-8'), hashlib.sha256).hexdigest()
+
+        headers["Authorization"] = "AWS4-HMAC-SHA256 Credential={}/{}, SignedHeaders={}, Signature={}".format(
+                self.access_key, scope, signed_headers, signature)
+        return headers
+
+
+class S3cmdBackend(UploadBackend):
+    def __init__(self, bucket: str):
+        self.bucket = bucket
+        if platform.system() == 'Windows':
+            self.s3cmd = [
+                "py", "-3",
+                Path(sys.executable).parent / "Scripts" / "s3cmd"
+            ]
+        else:
+            self.s3cmd = ["s3cmd"]
+
+    def exists(self, key: str) -> bool:
+        return "404" not in subprocess.run(self.s3cmd + ["info", self.url(key)], stdout=subprocess.PIPE,
+                                           stderr=subprocess.STDOUT, encoding='utf-8').stdout
+
+    def put_file(self, path: Path, key: str):
+        subprocess.run(self.s3cmd + ["put", path, self.url(key)], check=True)
+
+    def sync_directory(self, directory: Path, prefix: str):
+        subprocess.run(self.s3cmd + ["sync", "--skip-existing", str(directory) + "/", self.url(prefix)], check=True)
+
+    def url(self, key: str) -> str:
+        return "s3://{}/{}".format(self.bucket, key)
+
+
+class UploadError(Exception):
+    pass
+
+
+def create_upload_backend() -> UploadBackend:
+    bucket = os.environ.get("FRIDA_S3_BUCKET", DEFAULT_S3_BUCKET)
+    kind = os.environ.get("FRIDA_UPLOAD_BACKEND", "s3" if "AWS_ACCESS_KEY_ID" in os.environ else "s3cmd")
+    if kind == "s3":
+        return S3Backend(os.environ.get("FRIDA_S3_ENDPOINT", DEFAULT_S3_ENDPOINT),
+                         bucket,
+                         os.environ.get("AWS_REGION", DEFAULT_S3_REGION),
+                         os.environ["AWS_ACCESS_KEY_ID"],
+                         os.environ["AWS_SECRET_ACCESS_KEY"])
+    if kind == "s3cmd":
+        return S3cmdBackend(bucket)
+    raise ValueError("unsupported upload backend: {}".format(kind))
+
+
+def upload_file(backend: UploadBackend, path: Path, key: str, poll_writer: Optional[WriterPoller] = None,
+                part_size: int = UPLOAD_PART_SIZE, max_workers: int = UPLOAD_CONCURRENCY) -> UploadStats:
+    started_at = time.time()
+
+    if not isinstance(backend, MultipartUploadBackend):
+        wait_for_writer(poll_writer)
+        writer_done_at = time.time()
+        backend.put_file(path, key)
+        size = path.stat().st_size
+        finished_at = time.time()
+        return UploadStats(size, finished_at - started_at, 1, 0, finished_at - writer_done_at)
+
+    upload_id = None
+    uploaded: Dict[int, Future] = {}
+    next_offset = 0
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        try:
+            while True:
+                writer_done = poll_writer() if poll_writer is not None else True
+                if writer_done is False:
+                    raise UploadError("writer of {} failed".format(path))
+                size = path.stat().st_size if path.exists() else 0
+                while size - next_offset >= part_size:
+                    if upload_id is None:
+                        upload_id = backend.create_multipart_upload(key)
+                    number = next_offset // part_size + 1
+                    uploaded[number] = executor.submit(upload_part, backend, key, upload_id, path, number, part_size)
+                    next_offset += part_size
+                if writer_done:
+                    break
+                time.sleep(UPLOAD_POLL_INTERVAL)
+            writer_done_at = time.time()
+
+            if upload_id is None:
+                backend.put_file(path, key)
+                finished_at = time.time()
+                return UploadStats(size, finished_at - started_at, 1, 0, finished_at - writer_done_at)
+
+            part_count = max(1, (size + part_size - 1) // part_size)
+            digests = {number: future.result() for number, future in uploaded.items()}
+
+            reuploaded = 0
+            final_futures = {}
+            for number in range(1, part_count + 1):
+                previous = digests.get(number, None)
+                if previous is not None and compute_part_digest(path, number, part_size) == previous[0]:
+                    final_futures[number] = uploaded[number]
+                    continue
+                if previous is not None:
+                    reuploaded += 1
+                final_futures[number] = executor.submit(upload_part, backend, key, upload_id, path, number, part_size)
+
+            parts = [(number, final_futures[number].result()[1]) for number in range(1, part_count + 1)]
+            backend.complete_multipart_upload(key, upload_id, parts)
+        except:
+            if upload_id is not None:
+                for future in uploaded.values():
+                    future.cancel()
+                backend.abort_multipart_upload(key, upload_id)
+            raise
+
+    finished_at = time.time()
+    return UploadStats(size, finished_at - started_at, part_count, reuploaded, finished_at - writer_done_at)
+
+
+def wait_for_writer(poll_writer: Optional[WriterPoller]):
+    if poll_writer is None:
+        return
+    while True:
+        writer_done = poll_writer()
+        if writer_done is False:
+            raise UploadError("writer failed")
+        if writer_done:
+            return
+        time.sleep(UPLOAD_POLL_INTERVAL)
+
+
+def upload_part(backend: MultipartUploadBackend, key: str, upload_id: str, path: Path, number: int,
+                part_size: int) -> Tuple[str, str]:
+    data = read_part(path, number, part_size)
+    etag = backend.upload_part(key, upload_id, number, data)
+    return (hashlib.sha256(data).hexdigest(), etag)
+
+
+def compute_part_digest(path: Path, number: int, part_size: int) -> str:
+    return hashlib.sha256(read_part(path, number, part_size)).hexdigest()
+
+
+def read_part(path: Path, number: int, part_size: int) -> bytes:
+    with path.open("rb") as f:
+        f.seek((number - 1) * part_size)
+        return f.read(part_size)